@@ -0,0 +1,48 @@
+"""
+Configuración de Gunicorn para EvarisTools.
+
+Los endpoints combinan trabajo de CPU (PyMuPDF, Pillow, pikepdf) con esperas a
+procesos externos (LibreOffice, Ghostscript) y a LM Studio. Por eso se usan
+procesos pre-forkeados (uno por núcleo, para el trabajo de CPU) con varios hilos
+cada uno (para que las esperas de E/S no bloqueen el proceso completo).
+
+Todos los valores se pueden ajustar con variables de entorno.
+"""
+import multiprocessing
+import os
+
+# Dirección de escucha
+bind = os.environ.get('EVARIS_BIND', '0.0.0.0:5000')
+
+# Un proceso por núcleo para el trabajo de CPU (mínimo 2, para que el reciclaje
+# de un worker no deje el servidor sin atender solicitudes)
+workers = int(os.environ.get('EVARIS_WORKERS', max(2, multiprocessing.cpu_count())))
+
+# server.py reparte entre los workers los límites de concurrencia (EVARIS_LIMIT_*)
+os.environ.setdefault('EVARIS_WORKER_COUNT', str(workers))
+
+# Hilos por proceso para las esperas de subprocesos, disco y red
+worker_class = 'gthread'
+threads = int(os.environ.get('EVARIS_THREADS', '4'))
+
+# Cargar server.py (y sus bibliotecas) una sola vez en el proceso maestro:
+# los workers se crean por fork y comparten esas páginas de memoria
+preload_app = True
+
+# Las conversiones de documentos grandes pueden tardar varios minutos
+timeout = int(os.environ.get('EVARIS_TIMEOUT', '300'))
+graceful_timeout = 30
+keepalive = 5
+
+# Reciclar los workers periódicamente para acotar la fragmentación de memoria
+# que dejan las imágenes y documentos grandes
+max_requests = int(os.environ.get('EVARIS_MAX_REQUESTS', '1000'))
+max_requests_jitter = 100
+
+# Archivo de latido de los workers en memoria (evita bloqueos en discos lentos)
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('EVARIS_LOG_LEVEL', 'info')
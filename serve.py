@@ -0,0 +1,31 @@
+"""
+Lanzador de producción de EvarisTools.
+
+Usa Gunicorn (procesos pre-forkeados + hilos, ver gunicorn.conf.py) en Linux/macOS
+y Waitress (multihilo) en Windows, donde Gunicorn no está disponible.
+"""
+import multiprocessing
+import os
+import sys
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    if os.name != 'nt':
+        from gunicorn.app.wsgiapp import run
+        sys.argv = ['gunicorn', '-c', os.path.join(current_dir, 'gunicorn.conf.py'), 'wsgi:app']
+        sys.path.insert(0, current_dir)
+        run()
+    else:
+        from waitress import serve
+        from server import app, MAX_UPLOAD_MB
+        
+        host, _, port = os.environ.get('EVARIS_BIND', '0.0.0.0:5000').rpartition(':')
+        # Sin fork en Windows: un único proceso con más hilos
+        threads = int(os.environ.get('EVARIS_THREADS', multiprocessing.cpu_count() * 4))
+        print(f"Iniciando EvarisTools (Waitress, {threads} hilos) en http://{host}:{port}")
+        serve(app, host=host, port=int(port), threads=threads, channel_timeout=300,
+              max_request_body_size=MAX_UPLOAD_MB * 1024 * 1024)
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,83 @@
-from flask import Flask, request, send_file, jsonify, after_this_request
+from flask import Flask, Request, request, send_file, jsonify, after_this_request, has_request_context
 from flask_cors import CORS
 import os
 import subprocess
 import tempfile
 import uuid
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest, NotFound, RequestEntityTooLarge, TooManyRequests, UnsupportedMediaType
 import sys
 import shutil
 import threading
 import time
-import requests
 from datetime import datetime, timedelta
-import PyPDF2
 import json
 import zipfile
 import io
 import logging
-from PIL import Image, ImageDraw, ImageFont
-import pymupdf as fitz  # PyMuPDF
+import math
+import random
 import base64
+import bisect
+import collections
+import hashlib
+import importlib
+import re
+import types
+from contextlib import contextmanager
+from pathlib import Path
+
+class LazyModule(types.ModuleType):
+    """
+    Módulo que se importa la primera vez que se accede a uno de sus atributos.
+    Las bibliotecas pesadas (PyMuPDF, Pillow, PyPDF2, requests) no se cargan al
+    arrancar el servidor sino con la primera solicitud que las necesita.
+    """
+    
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_lock'] = threading.Lock()
+    
+    def __getattr__(self, attribute):
+        with self.__dict__['_lazy_lock']:
+            module = importlib.import_module(self.__name__)
+            # Copiar los atributos para que los siguientes accesos sean directos
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+requests = LazyModule('requests')
+PyPDF2 = LazyModule('PyPDF2')
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+ImageOps = LazyModule('PIL.ImageOps')
+fitz = LazyModule('pymupdf')  # PyMuPDF
+
+# Flujos binarios en ReportLab para todo el proceso: sin ASCII85 los JPEG incrustados
+# conservan sus bytes originales. Se fija con la variable que ReportLab lee al importarse
+# (RL_useA85) para no importarlo al arrancar
+os.environ.setdefault('RL_useA85', '0')
+
+def preload_engines():
+    """Importa por adelantado las bibliotecas pesadas (p. ej. en el maestro de Gunicorn)"""
+    for module in (requests, PyPDF2, Image, ImageDraw, ImageFont, ImageOps, fitz):
+        importlib.import_module(module.__name__)
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*"}})  # Permitir solicitudes CORS de cualquier origen
+CORS(
+    app,
+    supports_credentials=True,
+    resources={r"/*": {"origins": "*"}},  # Permitir solicitudes CORS de cualquier origen
+    # Cabeceras que el frontend necesita leer para reanudar descargas de artefactos
+    expose_headers=['Content-Disposition', 'Content-Range', 'Accept-Ranges', 'ETag', 'Server-Timing',
+                    'X-Artifact-Id', 'X-Artifact-Url', 'X-Artifact-Expires', 'X-Evaris-Profile-Id', 'Retry-After',
+                    'X-Evaris-Peak-RSS']
+)
 
 # Configuración de la carpeta temporal
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -86,6 +138,13 @@ def cleanup_temp_files():
                         count += 1
                     except Exception:
                         pass
+        
+        cleanup_chunked_uploads()
+        cleanup_artifacts()
+        cleanup_document_sessions()
+        cleanup_text_cache()
+        cleanup_ocr_cache()
+        cleanup_progress()
     except Exception:
         pass
 
@@ -109,35 +168,1286 @@ def delayed_file_cleanup(files_to_delete, delay_seconds=1):
     cleanup_thread.daemon = True  # El hilo se cerrará cuando el programa principal termine
     cleanup_thread.start()
 
+# Métricas del servidor en formato de texto de Prometheus (GET /metrics)
+METRICS_FOLDER = os.path.join(UPLOAD_FOLDER, 'metrics')
+METRICS_FLUSH_SECONDS = 2
+os.makedirs(METRICS_FOLDER, exist_ok=True)
+
+# Límites (en segundos) de los histogramas: desde consultas ligeras hasta conversiones largas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRIC_DEFINITIONS = {
+    'evaris_http_requests_total': ('counter', 'Solicitudes atendidas por ruta, método y código de estado'),
+    'evaris_http_request_duration_seconds': ('histogram', 'Duración de las solicitudes hasta enviar el último byte'),
+    'evaris_http_request_bytes_total': ('counter', 'Bytes recibidos en el cuerpo de las solicitudes'),
+    'evaris_http_response_bytes_total': ('counter', 'Bytes enviados en el cuerpo de las respuestas'),
+    'evaris_http_requests_in_flight': ('gauge', 'Solicitudes en curso'),
+    'evaris_tool_duration_seconds': ('histogram', 'Duración de las llamadas a herramientas externas (soffice, gs, LM Studio)'),
+    'evaris_admission_in_use': ('gauge', 'Unidades de trabajo ocupadas por clase de recurso'),
+    'evaris_admission_queued': ('gauge', 'Solicitudes esperando turno por clase de recurso'),
+    'evaris_admission_wait_seconds': ('histogram', 'Tiempo de espera en la cola de admisión'),
+    'evaris_admission_rejected_total': ('counter', 'Solicitudes rechazadas con 429 por cola llena o espera excesiva'),
+    'evaris_llm_in_flight': ('gauge', 'Llamadas en curso a LM Studio'),
+    'evaris_llm_queued': ('gauge', 'Llamadas esperando turno para LM Studio'),
+    'evaris_llm_queue_wait_seconds': ('histogram', 'Espera hasta obtener turno para llamar a LM Studio'),
+    'evaris_llm_time_to_first_token_seconds': ('histogram', 'Tiempo hasta el primer fragmento de las respuestas en streaming'),
+    'evaris_llm_tokens_total': ('counter', 'Tokens procesados por LM Studio por endpoint y tipo (prompt, completion)'),
+    'evaris_llm_generation_seconds_total': ('counter', 'Segundos generando tokens (tokens/s = tokens completion / segundos)'),
+    'evaris_llm_retries_total': ('counter', 'Reintentos de llamadas a LM Studio por fallo de conexión o 502/503/504'),
+    'evaris_llm_cache_requests_total': ('counter', 'Consultas a la caché de respuestas por tipo y resultado (hit, similar, miss)'),
+    'evaris_llm_cache_evictions_total': ('counter', 'Respuestas eliminadas de la caché por superar su tamaño máximo'),
+}
+
+class MetricsRegistry:
+    """
+    Contadores, indicadores e histogramas del proceso actual.
+    Con varios workers (Gunicorn) cada proceso vuelca su estado en METRICS_FOLDER y
+    /metrics suma el de todos. Los contadores de los workers que terminan (p. ej. al
+    reciclarse por max_requests) se acumulan en retired.json para que no retrocedan.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset()
+    
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.dirty = False
+    
+    def ensure_process(self):
+        """Empieza de cero en cada proceso hijo e inicia su volcado periódico"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.reset()
+            self.pid = os.getpid()
+        if os.name != 'nt':
+            threading.Thread(target=self.flush_loop, daemon=True).start()
+    
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.dirty = True
+    
+    def add(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+            self.dirty = True
+    
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            buckets = self.histograms.get(key)
+            if buckets is None:
+                # Un contador por límite, uno para +Inf y la suma de los valores
+                buckets = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            buckets[-1] += value
+            self.dirty = True
+    
+    def snapshot(self):
+        with self.lock:
+            self.dirty = False
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, labels, list(buckets)] for (name, labels), buckets in self.histograms.items()],
+            }
+    
+    def flush(self):
+        path = os.path.join(METRICS_FOLDER, f"{os.getpid()}.json")
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+    
+    def flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            if self.dirty:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.warning(f"No se pudieron guardar las métricas: {e}")
+
+metrics = MetricsRegistry()
+
+def merge_metrics(total, snapshot, include_gauges=True):
+    """Suma una instantánea de métricas sobre otra (las etiquetas llegan como listas desde JSON)"""
+    for kind in ('counters', 'gauges', 'histograms'):
+        if kind == 'gauges' and not include_gauges:
+            continue
+        section = total.setdefault(kind, {})
+        for name, labels, value in snapshot.get(kind, []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if kind == 'histograms':
+                current = section.get(key)
+                section[key] = [a + b for a, b in zip(current, value)] if current else list(value)
+            else:
+                section[key] = section.get(key, 0) + value
+    return total
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def retire_metrics(pid):
+    """Acumula los contadores de un worker terminado en retired.json"""
+    import fcntl
+    source = os.path.join(METRICS_FOLDER, f"{pid}.json")
+    claimed = f"{source}.retiring.{os.getpid()}"
+    try:
+        # Solo el proceso que consigue renombrar el archivo lo acumula
+        os.rename(source, claimed)
+    except OSError:
+        return
+    
+    retired_path = os.path.join(METRICS_FOLDER, 'retired.json')
+    with open(os.path.join(METRICS_FOLDER, 'retired.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            total = {}
+            for path in (retired_path, claimed):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        merge_metrics(total, json.load(f), include_gauges=False)
+                except (OSError, ValueError):
+                    pass
+            temp_path = retired_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    kind: [[name, labels, value] for (name, labels), value in total.get(kind, {}).items()]
+                    for kind in ('counters', 'histograms')
+                }, f)
+            os.replace(temp_path, retired_path)
+            os.remove(claimed)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def collect_metrics():
+    """Métricas de todos los procesos del servidor (en Windows, solo el actual)"""
+    metrics.ensure_process()
+    total = merge_metrics({}, metrics.snapshot())
+    if os.name == 'nt':
+        return total
+    
+    for filename in os.listdir(METRICS_FOLDER):
+        match = re.fullmatch(r'(\d+)\.json', filename)
+        if not match or int(match.group(1)) == os.getpid():
+            continue
+        if not process_alive(int(match.group(1))):
+            retire_metrics(int(match.group(1)))
+            continue
+        try:
+            with open(os.path.join(METRICS_FOLDER, filename), 'r', encoding='utf-8') as f:
+                merge_metrics(total, json.load(f))
+        except (OSError, ValueError):
+            pass
+    
+    try:
+        with open(os.path.join(METRICS_FOLDER, 'retired.json'), 'r', encoding='utf-8') as f:
+            merge_metrics(total, json.load(f), include_gauges=False)
+    except (OSError, ValueError):
+        pass
+    return total
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def render_metrics(total):
+    """Convierte las métricas acumuladas al formato de texto de Prometheus (0.0.4)"""
+    lines = []
+    for name, (kind, help_text) in METRIC_DEFINITIONS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            for (metric, labels), buckets in sorted(total.get('histograms', {}).items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {buckets[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        else:
+            section = total.get('counters' if kind == 'counter' else 'gauges', {})
+            for (metric, labels), value in sorted(section.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+# Tiempos por etapa dentro de cada operación (save_upload, open, process_pages,
+# serialize, send...). Se devuelven en la cabecera Server-Timing y en una línea de log
+# JSON por solicitud. EVARIS_TIMING_SAMPLE_RATE (0-1) limita las solicitudes medidas.
+TIMING_SAMPLE_RATE = float(os.environ.get('EVARIS_TIMING_SAMPLE_RATE', '1'))
+timing_logger = logging.getLogger('evaris.timing')
+
+def record_span(name, seconds):
+    """Suma la duración de una etapa a la solicitud actual (si está muestreada)"""
+    if not has_request_context():
+        return
+    spans = request.environ.get('evaris.spans')
+    if spans is not None:
+        spans[name] = spans.get(name, 0) + seconds
+
+@contextmanager
+def span(name):
+    """
+    Mide una etapa de la solicitud actual. Las etapas repetidas (p. ej. una por página)
+    se acumulan bajo el mismo nombre. Sin efecto si la solicitud no está muestreada.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+        sample_memory(MEMORY_SAMPLE_INTERVAL)
+
+@contextmanager
+def track_tool(tool):
+    """
+    Mide una llamada a una herramienta externa. El bloque puede marcar el resultado
+    como fallido con call['outcome'] = 'error' (p. ej. una respuesta HTTP 500).
+    Las respuestas en streaming que el cliente abandona se registran como 'aborted'.
+    """
+    call = {'outcome': 'ok'}
+    start = time.perf_counter()
+    try:
+        yield call
+    except GeneratorExit:
+        call['outcome'] = 'aborted'
+        raise
+    except BaseException:
+        call['outcome'] = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('evaris_tool_duration_seconds', (('tool', tool), ('outcome', call['outcome'])), elapsed)
+        record_span(tool, elapsed)
+
+def run_tool(tool, command, **kwargs):
+    """subprocess.run con medición de la duración de la herramienta"""
+    with track_tool(tool) as call:
+        result = subprocess.run(command, **kwargs)
+        if result.returncode != 0:
+            call['outcome'] = 'error'
+        return result
+
+class MetricsMiddleware:
+    """
+    Middleware WSGI que mide cada solicitud: duración hasta enviar el último byte,
+    bytes recibidos y enviados, y solicitudes en curso. La ruta (la regla de Flask,
+    no la URL, para no multiplicar las series) la anota el hook track_request_route.
+    """
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        metrics.ensure_process()
+        start = time.perf_counter()
+        state = environ['evaris.metrics'] = {
+            'start': start,
+            'route': 'unmatched',
+            'status': '500',
+            'content_length': None,
+            'sent': 0,
+            'in_flight': False,
+            'peak_rss': current_rss(),
+            'rss_sampled': start,
+        }
+        if TIMING_SAMPLE_RATE >= 1 or random.random() < TIMING_SAMPLE_RATE:
+            environ['evaris.spans'] = {}
+        
+        def capture_status(status, headers, exc_info=None):
+            state['status'] = status.split(' ', 1)[0]
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    state['content_length'] = int(value)
+            return start_response(status, headers, exc_info)
+        
+        try:
+            body = self.wsgi_app(environ, capture_status)
+        except BaseException:
+            self.finish(environ)
+            raise
+        
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Respuestas de send_file: se conserva el objeto para que el servidor pueda
+            # usar sendfile(); los bytes enviados se toman de Content-Length
+            original_close = getattr(body, 'close', None)
+            
+            def close():
+                try:
+                    if original_close:
+                        original_close()
+                finally:
+                    self.finish(environ)
+            
+            state['sent'] = state['content_length'] or 0
+            body.close = close
+            return body
+        return MetricsBody(body, environ['evaris.metrics'], lambda: self.finish(environ))
+    
+    def finish(self, environ):
+        state = environ['evaris.metrics']
+        if state.get('finished'):
+            return
+        state['finished'] = True
+        
+        route = (('route', state['route']),)
+        if state['in_flight']:
+            metrics.add('evaris_http_requests_in_flight', route, -1)
+        metrics.inc('evaris_http_requests_total',
+                    route + (('method', environ.get('REQUEST_METHOD', '')), ('status', state['status'])))
+        metrics.observe('evaris_http_request_duration_seconds', route, time.perf_counter() - state['start'])
+        
+        received = environ.get('CONTENT_LENGTH')
+        if received and received.isdigit():
+            metrics.inc('evaris_http_request_bytes_total', route, int(received))
+        if state['sent']:
+            metrics.inc('evaris_http_response_bytes_total', route, state['sent'])
+        
+        spans = environ.get('evaris.spans')
+        if spans is not None:
+            timing_logger.info(json.dumps({
+                'method': environ.get('REQUEST_METHOD'),
+                'route': state['route'],
+                'status': int(state['status']),
+                'duration_ms': round((time.perf_counter() - state['start']) * 1000, 1),
+                'bytes_in': int(received) if received and received.isdigit() else 0,
+                'bytes_out': state['sent'],
+                'peak_rss_mb': round(state['peak_rss'] / (1024 * 1024), 1) if state['peak_rss'] else None,
+                'spans_ms': {name: round(seconds * 1000, 1) for name, seconds in spans.items()},
+            }))
+
+class MetricsBody:
+    """Cuerpo de respuesta que cuenta los bytes enviados y cierra la medición en close()"""
+    
+    def __init__(self, body, state, on_close):
+        self.body = body
+        self.state = state
+        self.on_close = on_close
+    
+    def __iter__(self):
+        for chunk in self.body:
+            self.state['sent'] += len(chunk)
+            yield chunk
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close()
+
+# Presupuesto de memoria por operación: los endpoints que rasterizan o decodifican
+# imágenes estiman la memoria que necesitan (según el número de páginas y el tamaño de
+# las imágenes), procesan las páginas en ventanas que caben en EVARIS_MEMORY_BUDGET_MB
+# y escriben en disco los resultados que no caben. El pico de memoria residente del
+# proceso durante cada solicitud se devuelve en la cabecera X-Evaris-Peak-RSS.
+MEMORY_BUDGET_MB = int(os.environ.get('EVARIS_MEMORY_BUDGET_MB', '512'))
+MEMORY_BUDGET = MEMORY_BUDGET_MB * 1024 * 1024
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# Segundos mínimos entre dos mediciones de memoria al cerrar etapas de una misma
+# solicitud (las etapas por página pueden cerrarse miles de veces)
+MEMORY_SAMPLE_INTERVAL = 0.05
+
+def current_rss():
+    """Memoria residente del proceso en bytes (None si el sistema no permite medirla)"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Sin /proc (macOS) solo se conoce el máximo histórico: bytes en macOS, KB en Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def sample_memory(min_interval=0):
+    """
+    Actualiza el pico de memoria residente observado durante la solicitud actual. Con
+    min_interval no mide si la última medición de la solicitud es más reciente.
+    """
+    if not has_request_context():
+        return
+    state = request.environ.get('evaris.metrics')
+    if state is None:
+        return
+    now = time.perf_counter()
+    if min_interval and now - state.get('rss_sampled', 0) < min_interval:
+        return
+    state['rss_sampled'] = now
+    rss = current_rss()
+    if rss is not None:
+        state['peak_rss'] = max(state.get('peak_rss') or 0, rss)
+
+def memory_window(item_bytes, budget=None):
+    """Cuántos elementos de item_bytes caben a la vez en el presupuesto (al menos uno)"""
+    budget = budget or MEMORY_BUDGET
+    return max(1, int(budget // max(1, item_bytes)))
+
+def release_render_memory():
+    """Libera la caché de MuPDF y los objetos pendientes al terminar una ventana de páginas"""
+    import gc
+    fitz.TOOLS.store_shrink(100)
+    gc.collect()
+    sample_memory()
+
+def spooled_output(expected_bytes=0):
+    """
+    Archivo temporal para un resultado: en memoria mientras no supere el presupuesto
+    y en disco (dentro de la carpeta temporal) a partir de ahí.
+    """
+    if expected_bytes >= MEMORY_BUDGET:
+        return tempfile.TemporaryFile(dir=UPLOAD_FOLDER)
+    return tempfile.SpooledTemporaryFile(max_size=MEMORY_BUDGET, dir=UPLOAD_FOLDER)
+
+# Perfilado bajo demanda: una solicitud con las cabeceras X-Evaris-Profile: 1 y
+# X-Evaris-Admin-Token: <EVARIS_ADMIN_TOKEN> se ejecuta bajo cProfile y se guardan el
+# perfil, el cuerpo recibido y los datos de la solicitud en temp/diagnostics/<id>/
+ADMIN_TOKEN = os.environ.get('EVARIS_ADMIN_TOKEN', '')
+DIAGNOSTICS_FOLDER = os.path.join(UPLOAD_FOLDER, 'diagnostics')
+DIAGNOSTICS_MAX_CAPTURES = int(os.environ.get('EVARIS_DIAGNOSTICS_MAX', '20'))
+DIAGNOSTICS_FILES = ('meta.json', 'profile.prof', 'profile.txt', 'input.bin')
+
+def is_admin_token(token):
+    import hmac
+    return bool(ADMIN_TOKEN) and hmac.compare_digest((token or '').encode(), ADMIN_TOKEN.encode())
+
+class ProfilerMiddleware:
+    """
+    Middleware WSGI que perfila las solicitudes marcadas por un administrador, en
+    cualquier ruta. El cuerpo se copia a input.bin antes de pasarlo a la aplicación
+    para poder reproducir la solicitud aunque el servidor borre sus temporales.
+    """
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_X_EVARIS_PROFILE') != '1':
+            return self.wsgi_app(environ, start_response)
+        if not is_admin_token(environ.get('HTTP_X_EVARIS_ADMIN_TOKEN')):
+            logger.warning("Solicitud de perfilado rechazada: token de administrador inválido")
+            return self.wsgi_app(environ, start_response)
+        
+        import cProfile
+        capture_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        capture_dir = os.path.join(DIAGNOSTICS_FOLDER, capture_id)
+        os.makedirs(capture_dir, exist_ok=True)
+        
+        meta = {
+            'id': capture_id,
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'query': environ.get('QUERY_STRING', ''),
+            'content_type': environ.get('CONTENT_TYPE', ''),
+            'content_length': None,
+            'started': datetime.now().isoformat(),
+        }
+        input_file = self.capture_input(environ, capture_dir, meta)
+        
+        def capture_status(status, headers, exc_info=None):
+            meta['status'] = int(status.split(' ', 1)[0])
+            headers = list(headers) + [('X-Evaris-Profile-Id', capture_id)]
+            return start_response(status, headers, exc_info)
+        
+        state = {'sent': 0}
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        
+        def finish():
+            profiler.disable()
+            if input_file:
+                input_file.close()
+            meta['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            meta['bytes_out'] = state['sent']
+            self.save_capture(profiler, capture_dir, meta)
+        
+        profiler.enable()
+        try:
+            body = self.wsgi_app(environ, capture_status)
+        except BaseException:
+            meta['status'] = 500
+            finish()
+            raise
+        return MetricsBody(body, state, finish)
+    
+    def capture_input(self, environ, capture_dir, meta):
+        """Copia el cuerpo de la solicitud a input.bin y lo entrega a la aplicación desde ahí"""
+        length = environ.get('CONTENT_LENGTH')
+        if not length or not length.isdigit() or int(length) > app.config['MAX_CONTENT_LENGTH']:
+            return None
+        input_path = os.path.join(capture_dir, 'input.bin')
+        remaining = int(length)
+        with open(input_path, 'wb') as f:
+            while remaining > 0:
+                chunk = environ['wsgi.input'].read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        meta['content_length'] = int(length) - remaining
+        environ['CONTENT_LENGTH'] = str(meta['content_length'])
+        environ['wsgi.input'] = open(input_path, 'rb')
+        return environ['wsgi.input']
+    
+    def save_capture(self, profiler, capture_dir, meta):
+        import pstats
+        try:
+            profiler.dump_stats(os.path.join(capture_dir, 'profile.prof'))
+            with open(os.path.join(capture_dir, 'profile.txt'), 'w', encoding='utf-8') as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats('cumulative').print_stats(60)
+            with open(os.path.join(capture_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, indent=2)
+            logger.info(f"Perfil guardado: {capture_dir} ({meta['duration_ms']} ms)")
+        except Exception as e:
+            logger.error(f"Error al guardar el perfil {meta['id']}: {e}")
+        prune_diagnostics()
+
+def prune_diagnostics():
+    """Conserva solo las DIAGNOSTICS_MAX_CAPTURES capturas más recientes"""
+    try:
+        captures = sorted(os.listdir(DIAGNOSTICS_FOLDER))
+    except OSError:
+        return
+    for capture_id in captures[:-DIAGNOSTICS_MAX_CAPTURES or None]:
+        shutil.rmtree(os.path.join(DIAGNOSTICS_FOLDER, capture_id), ignore_errors=True)
+
+app.wsgi_app = MetricsMiddleware(ProfilerMiddleware(app.wsgi_app))
+
+@app.before_request
+def track_request_route():
+    """Anota la ruta de la solicitud para las métricas y la cuenta como en curso"""
+    state = request.environ.get('evaris.metrics')
+    if state is not None:
+        state['route'] = request.url_rule.rule if request.url_rule else 'unmatched'
+        state['in_flight'] = True
+        metrics.add('evaris_http_requests_in_flight', (('route', state['route']),), 1)
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Cabecera Server-Timing con las etapas medidas y el tiempo total de la aplicación,
+    y X-Evaris-Peak-RSS con el pico de memoria residente (bytes) durante la solicitud
+    """
+    spans = request.environ.get('evaris.spans')
+    state = request.environ.get('evaris.metrics')
+    if spans is not None and state is not None:
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans.items()]
+        entries.append(f"app;dur={(time.perf_counter() - state['start']) * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(entries)
+    if state is not None:
+        sample_memory()
+        if state['peak_rss']:
+            response.headers['X-Evaris-Peak-RSS'] = str(state['peak_rss'])
+    return response
+
+# Control de admisión: cada clase de recurso (herramientas externas, renderizado, edición
+# de PDF, LLM) admite un número limitado de unidades de trabajo a la vez. Una solicitud
+# ocupa una unidad por cada ADMISSION_UNIT_MB de cuerpo recibido o de subidas por partes
+# referenciadas (mínimo 1) y espera su turno en una cola acotada; si la cola está llena o
+# la espera supera el tiempo máximo, se responde 429 con Retry-After. Los límites de las
+# variables de entorno son para todo el servidor y se reparten entre los workers de
+# Gunicorn (EVARIS_WORKER_COUNT).
+ADMISSION_WORKERS = max(1, int(os.environ.get('EVARIS_WORKER_COUNT', '1')))
+ADMISSION_UNIT_MB = float(os.environ.get('EVARIS_LIMIT_UNIT_MB', '25'))
+ADMISSION_TIMEOUT = float(os.environ.get('EVARIS_QUEUE_TIMEOUT', '60'))
+
+# Clase de recurso: (capacidad por defecto para todo el servidor, descripción)
+ADMISSION_DEFAULTS = {
+    'external': (os.cpu_count() or 1, 'LibreOffice, Ghostscript y Tesseract (un proceso externo por unidad)'),
+    'render': (os.cpu_count() or 1, 'Renderizado e imágenes (uso intensivo de memoria)'),
+    'pdf': ((os.cpu_count() or 1) * 2, 'Edición de PDF'),
+    'llm': (2, 'Resúmenes y chat con LM Studio'),
+}
+
+# Endpoints sujetos a control de admisión y su clase de recurso
+ADMISSION_ROUTES = {
+    'convert_word_to_pdf': 'external',
+    'convert_excel_to_pdf': 'external',
+    'convert_powerpoint_to_pdf': 'external',
+    'pdf_to_pdfa': 'external',
+    'ocr_document': 'external',
+    'pdf_to_jpg': 'render',
+    'jpg_to_pdf': 'render',
+    'compress_pdf': 'render',
+    'get_pdf_thumbnails': 'render',
+    'preview_rotated_pdf': 'render',
+    'qr_batch': 'render',
+    'split_pdf': 'pdf',
+    'merge_pdf': 'pdf',
+    'sign_pdf': 'pdf',
+    'watermark_pdf': 'pdf',
+    'rotate_pdf': 'pdf',
+    'sort_pdf': 'pdf',
+    'add_page_numbers': 'pdf',
+    'protect_pdf': 'pdf',
+    'unlock_pdf': 'pdf',
+    'get_pdf_info': 'pdf',
+    'summarize_document': 'llm',
+    'document_chat': 'llm',
+}
+
+class AdmissionPool:
+    """
+    Semáforo con peso y cola FIFO acotada. Solo la solicitud al frente de la cola puede
+    entrar, para que las solicitudes grandes no esperen indefinidamente a las pequeñas.
+    """
+    
+    def __init__(self, name, capacity, max_queue, timeout):
+        self.name = name
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.waiting = collections.deque()
+        self.in_use = 0
+        self.active = 0
+        # Media móvil de la duración de cada solicitud, para estimar Retry-After
+        self.avg_seconds = 5.0
+    
+    def retry_after(self):
+        return max(1, math.ceil(self.avg_seconds * (len(self.waiting) + 1) / self.capacity))
+    
+    def reject(self, reason):
+        metrics.inc('evaris_admission_rejected_total', (('pool', self.name), ('reason', reason)))
+        raise TooManyRequests(
+            'El servidor está ocupado procesando otras solicitudes. Inténtelo de nuevo en unos segundos.',
+            retry_after=self.retry_after()
+        )
+    
+    def acquire(self, units):
+        """Espera hasta poder ocupar `units` unidades; devuelve las unidades ocupadas"""
+        units = max(1, min(units, self.capacity))
+        start = time.perf_counter()
+        with self.condition:
+            if self.waiting or self.in_use + units > self.capacity:
+                if len(self.waiting) >= self.max_queue:
+                    self.reject('queue_full')
+                
+                ticket = object()
+                self.waiting.append(ticket)
+                metrics.add('evaris_admission_queued', (('pool', self.name),), 1)
+                deadline = time.monotonic() + self.timeout
+                try:
+                    while self.waiting[0] is not ticket or self.in_use + units > self.capacity:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.reject('timeout')
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting.remove(ticket)
+                    metrics.add('evaris_admission_queued', (('pool', self.name),), -1)
+                    # El siguiente de la cola puede tener sitio
+                    self.condition.notify_all()
+            
+            self.in_use += units
+            self.active += 1
+        
+        waited = time.perf_counter() - start
+        metrics.add('evaris_admission_in_use', (('pool', self.name),), units)
+        metrics.observe('evaris_admission_wait_seconds', (('pool', self.name),), waited)
+        record_span('queue', waited)
+        return units
+    
+    def release(self, units, held_seconds):
+        with self.condition:
+            self.in_use -= units
+            self.active -= 1
+            self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * held_seconds
+            self.condition.notify_all()
+        metrics.add('evaris_admission_in_use', (('pool', self.name),), -units)
+    
+    def snapshot(self):
+        with self.condition:
+            return {
+                'capacity': self.capacity,
+                'in_use': self.in_use,
+                'active': self.active,
+                'queued': len(self.waiting),
+                'max_queue': self.max_queue,
+                'avg_seconds': round(self.avg_seconds, 2),
+            }
+
+def build_admission_pools():
+    pools = {}
+    for name, (default_capacity, _) in ADMISSION_DEFAULTS.items():
+        total = int(os.environ.get(f'EVARIS_LIMIT_{name.upper()}', default_capacity))
+        queue_total = int(os.environ.get(f'EVARIS_QUEUE_{name.upper()}', total * 4))
+        pools[name] = AdmissionPool(
+            name,
+            capacity=max(1, math.ceil(total / ADMISSION_WORKERS)),
+            max_queue=max(0, math.ceil(queue_total / ADMISSION_WORKERS)),
+            timeout=ADMISSION_TIMEOUT
+        )
+    return pools
+
+admission_pools = build_admission_pools()
+
+@app.before_request
+def admit_request():
+    """Ocupa unidades de la clase de recurso del endpoint antes de recibir el cuerpo"""
+    pool_name = ADMISSION_ROUTES.get(request.endpoint)
+    if pool_name is None or request.method == 'OPTIONS':
+        return
+    
+    pool = admission_pools[pool_name]
+    unit_bytes = ADMISSION_UNIT_MB * 1024 * 1024
+    work_bytes = request.content_length or 0
+    # Un cuerpo pequeño puede referenciar subidas por partes grandes (upload_id/upload_ids):
+    # se recibe antes de admitir para sumar el tamaño de esas subidas al peso
+    if (request.content_length is not None and request.content_length < unit_bytes
+            and request.endpoint in UPLOAD_RULES
+            and request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded')):
+        with span('receive'):
+            request.files
+        work_bytes += sum(
+            os.path.getsize(upload.path) for upload in request.upload_spools if isinstance(upload, StoredUpload)
+        )
+    units = pool.acquire(1 + int(work_bytes / unit_bytes))
+    request.environ['evaris.admission'] = (pool, units, time.perf_counter())
+
+@app.teardown_request
+def release_admission(exc=None):
+    admission = request.environ.pop('evaris.admission', None)
+    if admission:
+        pool, units, start = admission
+        pool.release(units, time.perf_counter() - start)
+
+@app.errorhandler(TooManyRequests)
+def server_busy(error):
+    """Rechazos del control de admisión: JSON con Retry-After"""
+    response = jsonify({'error': error.description, 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+# Tamaño máximo permitido para una solicitud con archivos (en MB)
+MAX_UPLOAD_MB = int(os.environ.get('EVARIS_MAX_UPLOAD_MB', '1024'))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
+# Bytes iniciales que se inspeccionan para validar la firma del archivo
+UPLOAD_SNIFF_BYTES = 4096
+
+# Firmas (magic bytes) esperadas según la extensión del archivo
+UPLOAD_SIGNATURES = {
+    '.pdf': (b'%PDF-',),
+    '.jpg': (b'\xff\xd8\xff',),
+    '.jpeg': (b'\xff\xd8\xff',),
+    '.png': (b'\x89PNG\r\n\x1a\n',),
+    '.gif': (b'GIF87a', b'GIF89a'),
+    '.bmp': (b'BM',),
+    '.tif': (b'II*\x00', b'MM\x00*'),
+    '.tiff': (b'II*\x00', b'MM\x00*'),
+    '.webp': (b'RIFF',),
+    '.docx': (b'PK\x03\x04',),
+    '.xlsx': (b'PK\x03\x04',),
+    '.pptx': (b'PK\x03\x04',),
+    '.ods': (b'PK\x03\x04',),
+    '.odp': (b'PK\x03\x04',),
+    '.doc': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    '.xls': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    '.ppt': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+}
+
+PDF_EXTENSIONS = ('.pdf',)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+# Extensiones aceptadas por cada endpoint. Los archivos con otra extensión se
+# rechazan en cuanto llegan las cabeceras de la parte, sin recibir su contenido.
+UPLOAD_RULES = {
+    'convert_word_to_pdf': ('.doc', '.docx'),
+    'convert_excel_to_pdf': ('.xls', '.xlsx', '.ods'),
+    'convert_powerpoint_to_pdf': ('.ppt', '.pptx', '.odp'),
+    'split_pdf': PDF_EXTENSIONS,
+    'merge_pdf': PDF_EXTENSIONS,
+    'compress_pdf': PDF_EXTENSIONS,
+    'pdf_to_jpg': PDF_EXTENSIONS,
+    'jpg_to_pdf': IMAGE_EXTENSIONS,
+    'pdf_to_pdfa': PDF_EXTENSIONS,
+    'sign_pdf': PDF_EXTENSIONS + IMAGE_EXTENSIONS,
+    'watermark_pdf': PDF_EXTENSIONS + IMAGE_EXTENSIONS,
+    'rotate_pdf': PDF_EXTENSIONS,
+    'sort_pdf': PDF_EXTENSIONS,
+    'get_pdf_info': PDF_EXTENSIONS,
+    'get_pdf_thumbnails': PDF_EXTENSIONS,
+    'preview_rotated_pdf': PDF_EXTENSIONS,
+    'add_page_numbers': PDF_EXTENSIONS,
+    'protect_pdf': PDF_EXTENSIONS,
+    'unlock_pdf': PDF_EXTENSIONS,
+    'summarize_document': ('.pdf', '.txt', '.md', '.html', '.doc', '.docx', '.rtf'),
+    'ocr_document': PDF_EXTENSIONS + IMAGE_EXTENSIONS,
+    'qr_batch': ('.csv', '.json', '.txt'),
+}
+
+class UploadSpool:
+    """
+    Destino de una parte multipart. Valida la extensión y los magic bytes a medida que
+    llegan los datos, calcula el SHA-256 del contenido y escribe directamente en la
+    carpeta temporal para que guardar el archivo sea solo un renombrado.
+    """
+    
+    def __init__(self, filename, allowed_extensions=None):
+        self.filename = filename or ''
+        self.extension = os.path.splitext(self.filename)[1].lower()
+        
+        # Rechazar la extensión antes de recibir cualquier byte del contenido
+        if allowed_extensions and self.extension not in allowed_extensions:
+            raise UnsupportedMediaType(
+                f'Tipo de archivo no permitido ({self.extension or "sin extensión"}). '
+                f'Extensiones aceptadas: {", ".join(allowed_extensions)}'
+            )
+        
+        self.path = os.path.join(UPLOAD_FOLDER, f"spool_{uuid.uuid4().hex}{self.extension}")
+        self.size = 0
+        self._file = open(self.path, 'w+b')
+        self._hash = hashlib.sha256()
+        self._head = b''
+        self._validated = self.extension not in UPLOAD_SIGNATURES
+    
+    @property
+    def sha256(self):
+        """Hash SHA-256 del contenido recibido"""
+        return self._hash.hexdigest()
+    
+    def _check_signature(self, final=False):
+        """Comprueba la firma del archivo cuando hay suficientes bytes para decidir"""
+        signatures = UPLOAD_SIGNATURES[self.extension]
+        if self.extension == '.pdf':
+            # La especificación PDF permite bytes basura antes de la cabecera %PDF-
+            valid = any(signature in self._head[:1024] for signature in signatures)
+            decided = valid or final or len(self._head) >= 1024
+        else:
+            longest = max(len(signature) for signature in signatures)
+            valid = any(self._head.startswith(signature) for signature in signatures)
+            decided = valid or final or len(self._head) >= longest
+        
+        if not decided:
+            return
+        if not valid:
+            self.discard()
+            raise UnsupportedMediaType(
+                f'El contenido de {self.filename} no corresponde a un archivo {self.extension}'
+            )
+        self._validated = True
+        self._head = b''
+    
+    def write(self, data):
+        self.size += len(data)
+        max_bytes = app.config.get('MAX_CONTENT_LENGTH')
+        if max_bytes and self.size > max_bytes:
+            self.discard()
+            raise RequestEntityTooLarge(f'El archivo supera el tamaño máximo de {MAX_UPLOAD_MB} MB')
+        
+        if not self._validated:
+            self._head += data[:UPLOAD_SNIFF_BYTES]
+            self._check_signature()
+        
+        self._hash.update(data)
+        return self._file.write(data)
+    
+    def seek(self, offset, whence=0):
+        # Werkzeug rebobina el archivo al terminar la parte: validar archivos muy pequeños
+        if not self._validated:
+            self._check_signature(final=True)
+        return self._file.seek(offset, whence)
+    
+    def move_to(self, destination):
+        """Mueve el archivo del spool a su ruta definitiva sin copiar el contenido"""
+        self._file.close()
+        os.replace(self.path, destination)
+        self.path = destination
+    
+    def discard(self):
+        """Cierra y elimina el archivo del spool"""
+        try:
+            self._file.close()
+            if self.path.startswith(os.path.join(UPLOAD_FOLDER, 'spool_')) and os.path.exists(self.path):
+                os.remove(self.path)
+        except Exception:
+            pass
+    
+    def __getattr__(self, name):
+        # read, readline, tell, close, etc. se delegan al archivo real
+        return getattr(self._file, name)
+
+class StoredUpload:
+    """Archivo de solo lectura que apunta a una subida por partes ya finalizada"""
+    
+    def __init__(self, path, sha256):
+        self.path = path
+        self.sha256 = sha256
+        self._file = open(path, 'rb')
+    
+    def discard(self):
+        """Cierra el archivo sin eliminarlo (la subida puede reutilizarse)"""
+        try:
+            self._file.close()
+        except Exception:
+            pass
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class EvarisRequest(Request):
+    """Solicitud que guarda los archivos subidos en UploadSpool a medida que llegan"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = UploadSpool(filename, UPLOAD_RULES.get(self.endpoint))
+        self.upload_spools.append(spool)
+        return spool
+    
+    def _load_form_data(self):
+        if 'form' in self.__dict__:
+            return
+        super()._load_form_data()
+        
+        # Sustituir los campos upload_id/upload_ids por los archivos de subidas por partes
+        upload_ids = []
+        if self.form.get('upload_id'):
+            upload_ids.append(('file', self.form['upload_id']))
+        if self.form.get('upload_ids'):
+            field = UPLOAD_MULTI_FIELDS.get(self.endpoint, 'files[]')
+            try:
+                ids = json.loads(self.form['upload_ids'])
+            except json.JSONDecodeError:
+                ids = self.form['upload_ids']
+            # Un valor suelto (un id o varios separados por comas) se trata como lista
+            if isinstance(ids, (str, int, float)) and not isinstance(ids, bool):
+                ids = [upload_id for upload_id in str(ids).split(',') if upload_id.strip()]
+            if not isinstance(ids, list):
+                raise BadRequest('upload_ids debe ser una lista de identificadores de subida')
+            upload_ids.extend((field, str(upload_id).strip()) for upload_id in ids)
+        
+        if upload_ids:
+            files = self.files.copy()
+            for field, upload_id in upload_ids:
+                files.add(field, open_stored_upload(upload_id, UPLOAD_RULES.get(self.endpoint), self.upload_spools))
+            self.__dict__['files'] = self.parameter_storage_class(files)
+    
+    @property
+    def upload_spools(self):
+        if 'upload_spools' not in self.__dict__:
+            self.__dict__['upload_spools'] = []
+        return self.__dict__['upload_spools']
+
+app.request_class = EvarisRequest
+
+# Campo de archivos múltiples que reciben los endpoints al usar upload_ids
+UPLOAD_MULTI_FIELDS = {
+    'merge_pdf': 'files[]',
+    'jpg_to_pdf': 'images',
+}
+
+# Subidas por partes (reanudables) para archivos muy grandes
+CHUNKED_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'uploads')
+CHUNKED_UPLOAD_MAX_MB = int(os.environ.get('EVARIS_CHUNKED_UPLOAD_MAX_MB', '4096'))
+CHUNKED_UPLOAD_CHUNK_MB = int(os.environ.get('EVARIS_CHUNKED_UPLOAD_CHUNK_MB', '8'))
+# Tiempo de vida de una subida por partes (en horas)
+CHUNKED_UPLOAD_TTL_HOURS = int(os.environ.get('EVARIS_CHUNKED_UPLOAD_TTL_HOURS', '24'))
+os.makedirs(CHUNKED_UPLOAD_FOLDER, exist_ok=True)
+
+def chunked_upload_paths(upload_id):
+    """Rutas de datos, metadatos y registro de partes de una subida por partes"""
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except (ValueError, TypeError, AttributeError):
+        return None
+    base = os.path.join(CHUNKED_UPLOAD_FOLDER, upload_id)
+    return {'data': base + '.bin', 'meta': base + '.json', 'parts': base + '.parts'}
+
+def read_chunked_upload(upload_id):
+    """Lee los metadatos de una subida por partes (None si no existe)"""
+    paths = chunked_upload_paths(upload_id)
+    if not paths or not os.path.exists(paths['meta']):
+        return None, None
+    with open(paths['meta'], 'r', encoding='utf-8') as f:
+        return json.load(f), paths
+
+def write_chunked_upload(paths, meta):
+    """Guarda los metadatos de forma atómica"""
+    temp_path = paths['meta'] + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, paths['meta'])
+
+def received_ranges(paths):
+    """Une los rangos recibidos registrados en el archivo .parts"""
+    ranges = []
+    if os.path.exists(paths['parts']):
+        with open(paths['parts'], 'r') as f:
+            for line in f:
+                try:
+                    start, length = map(int, line.split())
+                    ranges.append((start, start + length))
+                except ValueError:
+                    continue
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def open_stored_upload(upload_id, allowed_extensions, open_uploads):
+    """Devuelve un FileStorage para una subida por partes finalizada"""
+    meta, paths = read_chunked_upload(upload_id)
+    if not meta or not meta.get('completed'):
+        raise NotFound(f'La subida {upload_id} no existe o no ha sido finalizada')
+    
+    extension = os.path.splitext(meta['filename'])[1].lower()
+    if allowed_extensions and extension not in allowed_extensions:
+        raise UnsupportedMediaType(
+            f'Tipo de archivo no permitido ({extension or "sin extensión"}). '
+            f'Extensiones aceptadas: {", ".join(allowed_extensions)}'
+        )
+    
+    # Renovar el tiempo de vida de la subida al usarla
+    os.utime(paths['meta'])
+    stored = StoredUpload(paths['data'], meta['sha256'])
+    open_uploads.append(stored)
+    return FileStorage(stored, meta['filename'], content_type=meta.get('content_type'))
+
+def cleanup_chunked_uploads():
+    """Elimina las subidas por partes que superaron su tiempo de vida"""
+    cutoff = time.time() - CHUNKED_UPLOAD_TTL_HOURS * 3600
+    for filename in os.listdir(CHUNKED_UPLOAD_FOLDER):
+        if not filename.endswith('.json'):
+            continue
+        meta_path = os.path.join(CHUNKED_UPLOAD_FOLDER, filename)
+        try:
+            if os.path.getmtime(meta_path) < cutoff:
+                base = meta_path[:-len('.json')]
+                for path in (base + '.bin', base + '.parts', meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+        except Exception:
+            pass
+
+def save_upload(file, destination):
+    """Guarda un archivo subido en su ruta definitiva (renombrando el spool si es posible)"""
+    with span('save_upload'):
+        if isinstance(file.stream, UploadSpool):
+            file.stream.move_to(destination)
+        elif isinstance(file.stream, StoredUpload):
+            # Las subidas por partes se conservan para poder reutilizarse: enlace o copia
+            try:
+                os.link(file.stream.path, destination)
+            except OSError:
+                shutil.copyfile(file.stream.path, destination)
+        else:
+            file.save(destination)
+
+def spooled_upload_path(file):
+    """Ruta en disco del contenido de un archivo subido (None si solo está en memoria)"""
+    if isinstance(file.stream, (UploadSpool, StoredUpload)):
+        file.stream.flush()
+        return file.stream.path
+    return None
+
+def upload_sha256(file):
+    """Devuelve el SHA-256 de un archivo subido (calculado durante la recepción si es posible)"""
+    if isinstance(file.stream, (UploadSpool, StoredUpload)):
+        return file.stream.sha256
+    position = file.stream.tell()
+    file.stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+        digest.update(chunk)
+    file.stream.seek(position)
+    return digest.hexdigest()
+
+@app.before_request
+def parse_uploads_early():
+    """Procesa el cuerpo multipart antes del handler para rechazar archivos inválidos pronto"""
+    if request.endpoint in UPLOAD_RULES and request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        # Accede a request.files: los errores de UploadSpool se convierten en 413/415
+        with span('receive'):
+            request.files
+
+@app.teardown_request
+def discard_unclaimed_uploads(exc=None):
+    """Elimina los archivos del spool que el handler no movió a su ruta definitiva"""
+    for spool in request.upload_spools:
+        spool.discard()
+
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(error):
+    """Devuelve los rechazos de archivos en el mismo formato JSON que el resto de la API"""
+    return jsonify({'error': error.description}), 415
+
+@app.errorhandler(BadRequest)
+def bad_request(error):
+    """Campos de la solicitud mal formados, en el mismo formato JSON que el resto de la API"""
+    return jsonify({'error': error.description}), 400
+
+@app.errorhandler(NotFound)
+def not_found(error):
+    """Rutas o recursos (subidas, artefactos) inexistentes"""
+    return jsonify({'error': error.description}), 404
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    """Rechaza solicitudes que superan MAX_UPLOAD_MB (declaradas o detectadas al recibir)"""
+    return jsonify({'error': f'El archivo supera el tamaño máximo de {MAX_UPLOAD_MB} MB'}), 413
+
+# Artefactos generados: se conservan durante un tiempo para permitir descargas
+# reanudables (Range) y condicionales (ETag / If-None-Match) sin recalcularlos
+ARTIFACT_FOLDER = os.path.join(UPLOAD_FOLDER, 'artifacts')
+ARTIFACT_TTL_MINUTES = int(os.environ.get('EVARIS_ARTIFACT_TTL_MINUTES', '60'))
+os.makedirs(ARTIFACT_FOLDER, exist_ok=True)
+
+def store_artifact(source, download_name, mimetype):
+    """
+    Guarda un resultado en la carpeta de artefactos y devuelve su id.
+    source puede ser la ruta de un archivo (se mueve, sin copiar) o un buffer en memoria.
+    """
+    artifact_id = uuid.uuid4().hex
+    data_path = os.path.join(ARTIFACT_FOLDER, artifact_id)
+    
+    if isinstance(source, (str, os.PathLike)):
+        os.replace(source, data_path)
+    else:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        with open(data_path, 'wb') as f:
+            if isinstance(source, (bytes, bytearray)):
+                f.write(source)
+            else:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+    
+    meta = {
+        'download_name': download_name,
+        'mimetype': mimetype,
+        'size': os.path.getsize(data_path),
+        'created': datetime.now().isoformat()
+    }
+    with open(data_path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    
+    return artifact_id
+
+def send_stored_artifact(artifact_id):
+    """Envía un artefacto con soporte de Range, ETag e If-None-Match"""
+    if not re.fullmatch(r'[0-9a-f]{32}', artifact_id or ''):
+        raise NotFound('El archivo solicitado no existe o ha expirado')
+    data_path = os.path.join(ARTIFACT_FOLDER, artifact_id)
+    try:
+        with open(data_path + '.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        raise NotFound('El archivo solicitado no existe o ha expirado')
+    
+    response = send_file(
+        data_path,
+        as_attachment=True,
+        download_name=meta['download_name'],
+        mimetype=meta['mimetype'],
+        conditional=True,
+        etag=True,
+        max_age=ARTIFACT_TTL_MINUTES * 60
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['X-Artifact-Id'] = artifact_id
+    response.headers['X-Artifact-Url'] = f"/artifacts/{artifact_id}"
+    response.headers['X-Artifact-Expires'] = (
+        datetime.fromisoformat(meta['created']) + timedelta(minutes=ARTIFACT_TTL_MINUTES)
+    ).isoformat()
+    return response
+
+def send_artifact(source, download_name, mimetype):
+    """Registra un resultado como artefacto y lo envía en la misma respuesta"""
+    with span('send'):
+        return send_stored_artifact(store_artifact(source, download_name, mimetype))
+
+def cleanup_artifacts():
+    """Elimina los artefactos que superaron su tiempo de vida"""
+    cutoff = time.time() - ARTIFACT_TTL_MINUTES * 60
+    for filename in os.listdir(ARTIFACT_FOLDER):
+        if filename.endswith('.json'):
+            continue
+        data_path = os.path.join(ARTIFACT_FOLDER, filename)
+        try:
+            if os.path.getmtime(data_path) < cutoff:
+                os.remove(data_path)
+                if os.path.exists(data_path + '.json'):
+                    os.remove(data_path + '.json')
+        except Exception:
+            pass
+
+# Rutas candidatas de LibreOffice
+SOFFICE_CANDIDATES = [
+    "soffice",  # Versión estándar para sistemas con LibreOffice en PATH
+    "libreoffice",  # Alternativa para Linux
+    "/usr/bin/soffice",  # Ubicación común en Linux
+    "/usr/bin/libreoffice", 
+    "/opt/libreoffice/program/soffice",  # Instalación alternativa en Linux
+    "C:\\Program Files\\LibreOffice\\program\\soffice.exe",  # Windows (64-bit)
+    "C:\\Program Files (x86)\\LibreOffice\\program\\soffice.exe",  # Windows (32-bit)
+    "/Applications/LibreOffice.app/Contents/MacOS/soffice",  # macOS
+]
+
+# Rutas candidatas de Ghostscript
+GHOSTSCRIPT_CANDIDATES = [
+    "gs",  # Versión estándar para sistemas con Ghostscript en PATH
+    "gswin64c",  # Windows (64-bit)
+    "gswin32c",  # Windows (32-bit)
+    "/usr/bin/gs",  # Ubicación común en Linux
+    "C:\\Program Files\\gs\\gs*\\bin\\gswin64c.exe",  # Windows (64-bit) - ej. C:\Program Files\gs\gs9.56.1\bin\gswin64c.exe
+    "C:\\Program Files (x86)\\gs\\gs*\\bin\\gswin32c.exe",  # Windows (32-bit)
+]
+
+# Rutas candidatas de Tesseract (OCR)
+TESSERACT_CANDIDATES = [
+    "tesseract",  # Versión estándar para sistemas con Tesseract en PATH
+    "/usr/bin/tesseract",  # Ubicación común en Linux
+    "/usr/local/bin/tesseract",  # Homebrew (Intel) y compilaciones propias
+    "/opt/homebrew/bin/tesseract",  # Homebrew (Apple Silicon)
+    "C:\\Program Files\\Tesseract-OCR\\tesseract.exe",  # Windows (instalador de UB Mannheim)
+]
+
 # Detectar LibreOffice al inicio
 def find_libreoffice():
     """Busca la instalación de LibreOffice en el sistema"""
-    soffice_paths = [
-        "soffice",  # Versión estándar para sistemas con LibreOffice en PATH
-        "libreoffice",  # Alternativa para Linux
-        "/usr/bin/soffice",  # Ubicación común en Linux
-        "/usr/bin/libreoffice", 
-        "/opt/libreoffice/program/soffice",  # Instalación alternativa en Linux
-        "C:\\Program Files\\LibreOffice\\program\\soffice.exe",  # Windows (64-bit)
-        "C:\\Program Files (x86)\\LibreOffice\\program\\soffice.exe",  # Windows (32-bit)
-        "/Applications/LibreOffice.app/Contents/MacOS/soffice",  # macOS
-    ]
-    
-    for path in soffice_paths:
+    for path in SOFFICE_CANDIDATES:
         try:
             # Verificar si el archivo existe directamente
             if os.path.exists(path):
                 return path
                 
-            # Intentar encontrar el comando en PATH
+            # Intentar encontrar el comando en PATH (sin lanzar 'which'/'where')
             if path in ["soffice", "libreoffice"]:
-                result = subprocess.run(
-                    ["where", path] if os.name == 'nt' else ["which", path],
-                    capture_output=True,
-                    check=False
-                )
-                if result.returncode == 0:
-                    found_path = result.stdout.decode('utf-8').strip()
+                found_path = shutil.which(path)
+                if found_path:
                     return found_path
         except Exception:
             continue
@@ -147,16 +1457,7 @@ def find_libreoffice():
 # Detectar Ghostscript al inicio
 def find_ghostscript():
     """Busca la instalación de Ghostscript en el sistema"""
-    gs_paths = [
-        "gs",  # Versión estándar para sistemas con Ghostscript en PATH
-        "gswin64c",  # Windows (64-bit)
-        "gswin32c",  # Windows (32-bit)
-        "/usr/bin/gs",  # Ubicación común en Linux
-        "C:\\Program Files\\gs\\gs*\\bin\\gswin64c.exe",  # Windows (64-bit) - ej. C:\Program Files\gs\gs9.56.1\bin\gswin64c.exe
-        "C:\\Program Files (x86)\\gs\\gs*\\bin\\gswin32c.exe",  # Windows (32-bit)
-    ]
-    
-    for path in gs_paths:
+    for path in GHOSTSCRIPT_CANDIDATES:
         try:
             # Si el path contiene asterisco, buscar coincidencias
             if '*' in path:
@@ -170,35 +1471,118 @@ def find_ghostscript():
             if os.path.exists(path):
                 return path
                 
-            # Intentar encontrar el comando en PATH
+            # Intentar encontrar el comando en PATH (sin lanzar 'which'/'where')
             if path in ["gs", "gswin64c", "gswin32c"]:
-                result = subprocess.run(
-                    ["where", path] if os.name == 'nt' else ["which", path],
-                    capture_output=True,
-                    check=False
-                )
-                if result.returncode == 0:
-                    found_path = result.stdout.decode('utf-8').strip()
+                found_path = shutil.which(path)
+                if found_path:
                     return found_path
         except Exception:
             continue
     
     return None
 
-# Función para detectar LibreOffice y Ghostscript al inicio
-LIBREOFFICE_PATH = find_libreoffice()
-GHOSTSCRIPT_PATH = find_ghostscript()
+# Detectar Tesseract al inicio
+def find_tesseract():
+    """Busca la instalación de Tesseract en el sistema"""
+    for path in TESSERACT_CANDIDATES:
+        try:
+            if os.path.exists(path):
+                return path
+            if path == "tesseract":
+                found_path = shutil.which(path)
+                if found_path:
+                    return found_path
+        except Exception:
+            continue
+    
+    return None
 
-# Informar sobre la disponibilidad de las herramientas
-logger.info(f"LibreOffice encontrado: {'SI' if LIBREOFFICE_PATH else 'NO'}")
-logger.info(f"Ghostscript encontrado: {'SI' if GHOSTSCRIPT_PATH else 'NO'}")
+# Caché de la detección de herramientas, para que los workers arranquen sin buscar
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+TOOLS_CACHE_PATH = os.path.join(CACHE_FOLDER, 'tools.json')
+os.makedirs(CACHE_FOLDER, exist_ok=True)
 
-# Función genérica para procesar conversiones mediante LibreOffice
-def process_libreoffice_conversion(input_file, allowed_extensions, input_type_name):
-    """Función común para procesar conversiones con LibreOffice"""
-    # Verificar si LibreOffice está disponible
-    if not LIBREOFFICE_PATH:
-        return jsonify({'error': 'El servicio de conversión no está disponible en este momento.'}), 500
+def tools_fingerprint():
+    """
+    Huella de los lugares donde se buscan las herramientas: el PATH y la fecha de
+    modificación de cada directorio candidato (cambia al instalar o desinstalar).
+    """
+    directories = os.environ.get('PATH', '').split(os.pathsep)
+    for candidate in SOFFICE_CANDIDATES + GHOSTSCRIPT_CANDIDATES + TESSERACT_CANDIDATES:
+        if os.path.isabs(candidate):
+            directories.append(os.path.dirname(candidate.split('*')[0]))
+    
+    mtimes = {}
+    for directory in directories:
+        try:
+            mtimes[directory] = os.stat(directory).st_mtime
+        except OSError:
+            mtimes[directory] = None
+    return {'path': os.environ.get('PATH', ''), 'mtimes': mtimes}
+
+def discover_tools():
+    """
+    Devuelve las rutas de LibreOffice, Ghostscript y Tesseract, usando la caché si sigue
+    vigente. EVARIS_SOFFICE_PATH, EVARIS_GS_PATH y EVARIS_TESSERACT_PATH fijan una ruta
+    concreta sin buscar (p. ej. los ejecutables simulados de tools/stubs para pruebas de carga).
+    """
+    overrides = {
+        'libreoffice': os.environ.get('EVARIS_SOFFICE_PATH'),
+        'ghostscript': os.environ.get('EVARIS_GS_PATH'),
+        'tesseract': os.environ.get('EVARIS_TESSERACT_PATH'),
+    }
+    if all(overrides.values()):
+        return overrides
+    tools = find_tools_cached()
+    return {name: overrides[name] or path for name, path in tools.items()}
+
+TOOL_FINDERS = {
+    'libreoffice': find_libreoffice,
+    'ghostscript': find_ghostscript,
+    'tesseract': find_tesseract,
+}
+
+def find_tools_cached():
+    """Busca LibreOffice, Ghostscript y Tesseract o reutiliza la caché si el entorno no cambió"""
+    fingerprint = tools_fingerprint()
+    try:
+        with open(TOOLS_CACHE_PATH, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        tools = cache['tools']
+        if cache['fingerprint'] == fingerprint and set(tools) == set(TOOL_FINDERS) and all(
+            path is None or os.path.exists(path) for path in tools.values()
+        ):
+            return tools
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    tools = {name: finder() for name, finder in TOOL_FINDERS.items()}
+    try:
+        temp_path = f"{TOOLS_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': fingerprint, 'tools': tools}, f)
+        os.replace(temp_path, TOOLS_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"No se pudo guardar la caché de herramientas: {e}")
+    return tools
+
+# Función para detectar LibreOffice, Ghostscript y Tesseract al inicio
+_tools = discover_tools()
+LIBREOFFICE_PATH = _tools['libreoffice']
+GHOSTSCRIPT_PATH = _tools['ghostscript']
+TESSERACT_PATH = _tools['tesseract']
+
+# Informar sobre la disponibilidad de las herramientas
+logger.info(f"LibreOffice encontrado: {'SI' if LIBREOFFICE_PATH else 'NO'}")
+logger.info(f"Ghostscript encontrado: {'SI' if GHOSTSCRIPT_PATH else 'NO'}")
+logger.info(f"Tesseract encontrado: {'SI' if TESSERACT_PATH else 'NO'}")
+
+# Función genérica para procesar conversiones mediante LibreOffice
+def process_libreoffice_conversion(input_file, allowed_extensions, input_type_name):
+    """Función común para procesar conversiones con LibreOffice"""
+    # Verificar si LibreOffice está disponible
+    if not LIBREOFFICE_PATH:
+        return jsonify({'error': 'El servicio de conversión no está disponible en este momento.'}), 500
     
     # Verificar si se envió un archivo
     if 'file' not in request.files:
@@ -225,7 +1609,7 @@ def process_libreoffice_conversion(input_file, allowed_extensions, input_type_na
     
     # Guardar el archivo
     try:
-        file.save(input_path)
+        save_upload(file, input_path)
     except Exception as e:
         return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 500
     
@@ -238,16 +1622,20 @@ def process_libreoffice_conversion(input_file, allowed_extensions, input_type_na
     output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{pdf_filename}")
     
     try:
-        # Usar LibreOffice para convertir el documento
+        # Usar LibreOffice para convertir el documento. Cada hilo usa su propio perfil
+        # de usuario: LibreOffice no admite conversiones simultáneas con el mismo perfil
+        # (varios workers/hilos de gunicorn en producción)
+        profile_dir = os.path.join(tempfile.gettempdir(), f"evaris_lo_{os.getpid()}_{threading.get_ident()}")
         command = [
             LIBREOFFICE_PATH,
+            f"-env:UserInstallation={Path(profile_dir).as_uri()}",
             "--headless",
             "--convert-to", "pdf",
             "--outdir", UPLOAD_FOLDER,
             input_path
         ]
         
-        process = subprocess.run(command, capture_output=True, text=True)
+        process = run_tool('soffice', command, capture_output=True, text=True)
         
         if process.returncode != 0:
             return jsonify({
@@ -276,7 +1664,7 @@ def process_libreoffice_conversion(input_file, allowed_extensions, input_type_na
             }), 500
         
         # Lista de archivos a eliminar después de la descarga
-        files_to_delete = [input_path, output_path]
+        files_to_delete = [input_path]
         
         # Configurar limpieza retardada para eliminar archivos después de la descarga
         @after_this_request
@@ -286,11 +1674,8 @@ def process_libreoffice_conversion(input_file, allowed_extensions, input_type_na
                 delayed_file_cleanup(files_to_delete, delay_seconds=2)
             return response
         
-        # Enviar el archivo PDF como respuesta
-        return send_file(output_path, 
-                        as_attachment=True,
-                        download_name=pdf_filename,
-                        mimetype='application/pdf')
+        # Enviar el archivo PDF como respuesta (queda disponible como artefacto)
+        return send_artifact(output_path, pdf_filename, 'application/pdf')
         
     except Exception as e:
         return jsonify({'error': 'Error durante la conversión del documento.'}), 500
@@ -335,8 +1720,17 @@ def system_info():
                 'pdf_conversion': {
                     'available': bool(GHOSTSCRIPT_PATH),
                     'path': GHOSTSCRIPT_PATH if GHOSTSCRIPT_PATH else None
+                },
+                'ocr': {
+                    'available': bool(TESSERACT_PATH),
+                    'path': TESSERACT_PATH if TESSERACT_PATH else None
                 }
             },
+            'admission': {
+                'worker_pid': os.getpid(),
+                'pools': {name: pool.snapshot() for name, pool in admission_pools.items()}
+            },
+            'lm_studio': {**lm_studio.snapshot(), 'cache': llm_cache.snapshot()},
             'temp_dir': {
                 'path': UPLOAD_FOLDER,
                 'writable': os.access(UPLOAD_FOLDER, os.W_OK),
@@ -349,6 +1743,67 @@ def system_info():
     except Exception as e:
         return jsonify({'error': f'Error al obtener información del sistema: {str(e)}'}), 500
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métricas de solicitudes y herramientas externas en formato de texto de Prometheus"""
+    return app.response_class(
+        render_metrics(collect_metrics()),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+def admin_error():
+    """Respuesta de error si la solicitud no trae el token de administrador (None si lo trae)"""
+    if not ADMIN_TOKEN:
+        raise NotFound('Las herramientas de diagnóstico no están habilitadas (EVARIS_ADMIN_TOKEN)')
+    if not is_admin_token(request.headers.get('X-Evaris-Admin-Token')):
+        return jsonify({'error': 'Token de administrador inválido'}), 403
+    return None
+
+@app.route('/diagnostics/profiles', methods=['GET'])
+def list_profiles():
+    """Lista las solicitudes perfiladas, de la más reciente a la más antigua"""
+    error = admin_error()
+    if error:
+        return error
+    
+    profiles = []
+    if os.path.isdir(DIAGNOSTICS_FOLDER):
+        for capture_id in sorted(os.listdir(DIAGNOSTICS_FOLDER), reverse=True):
+            capture_dir = os.path.join(DIAGNOSTICS_FOLDER, capture_id)
+            try:
+                with open(os.path.join(capture_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                # Captura en curso o incompleta
+                continue
+            meta['files'] = {
+                filename: f"/diagnostics/profiles/{capture_id}/{filename}"
+                for filename in DIAGNOSTICS_FILES
+                if os.path.exists(os.path.join(capture_dir, filename))
+            }
+            profiles.append(meta)
+    
+    return jsonify({'profiles': profiles})
+
+@app.route('/diagnostics/profiles/<capture_id>/<filename>', methods=['GET'])
+def download_profile(capture_id, filename):
+    """Descarga un archivo de una captura (perfil, resumen, cuerpo recibido o metadatos)"""
+    error = admin_error()
+    if error:
+        return error
+    
+    if not re.fullmatch(r'\d{8}-\d{6}-[0-9a-f]{8}', capture_id) or filename not in DIAGNOSTICS_FILES:
+        raise NotFound('La captura solicitada no existe')
+    file_path = os.path.join(DIAGNOSTICS_FOLDER, capture_id, filename)
+    if not os.path.exists(file_path):
+        raise NotFound('La captura solicitada no existe')
+    
+    return send_file(
+        file_path,
+        as_attachment=True,
+        download_name=f"{capture_id}_{filename}"
+    )
+
 @app.route('/convert-word-to-pdf', methods=['POST'])
 def convert_word_to_pdf():
     """Convierte documentos Word a PDF usando LibreOffice"""
@@ -417,7 +1872,7 @@ def split_pdf():
     
     # Guardar el archivo
     try:
-        file.save(input_path)
+        save_upload(file, input_path)
     except Exception as e:
         return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 500
     
@@ -425,99 +1880,94 @@ def split_pdf():
     if not os.path.exists(input_path):
         return jsonify({'error': 'Error al procesar el archivo.'}), 500
     
-    # Lista para los archivos generados (que se eliminarán después)
-    output_files = []
-    output_files.append(input_path)  # Agregar el archivo original
+    # Temporales que se eliminan al terminar, también si la división falla
+    zip_path = None
+    output_path = None
     
     try:
         # Abrir el PDF
-        pdf_reader = PyPDF2.PdfReader(input_path)
-        num_pages = len(pdf_reader.pages)
+        with span('open'):
+            pdf_reader = PyPDF2.PdfReader(input_path)
+            num_pages = len(pdf_reader.pages)
         
         # Si no hay páginas, devolver error
         if num_pages == 0:
             return jsonify({'error': 'El PDF está vacío o dañado.'}), 400
         
-        # Preparar el archivo ZIP para la respuesta
-        zip_buffer = io.BytesIO()
+        # El ZIP se escribe directamente en la carpeta temporal y se mueve (sin copiarlo) a
+        # los artefactos: las páginas ocupan aproximadamente lo mismo que el original
+        base_filename = os.path.splitext(filename)[0]
+        zip_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{base_filename}_dividido.zip")
         
         # Crear archivo ZIP
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            base_filename = os.path.splitext(filename)[0]
-            
-            if split_mode == 'all':
-                # Dividir todas las páginas individualmente
-                for i in range(num_pages):
-                    pdf_writer = PyPDF2.PdfWriter()
-                    pdf_writer.add_page(pdf_reader.pages[i])
-                    
-                    # Nombre del archivo individual
-                    page_filename = f"{base_filename}_pagina_{i+1}.pdf"
-                    output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{page_filename}")
-                    
-                    # Guardar la página individual
-                    with open(output_path, 'wb') as output_pdf:
-                        pdf_writer.write(output_pdf)
-                    
-                    # Agregar al ZIP y a la lista de archivos a eliminar
-                    zip_file.write(output_path, page_filename)
-                    output_files.append(output_path)
-                    
-            elif split_mode == 'range':
-                # Dividir por rangos específicos
-                for i, range_info in enumerate(split_ranges):
-                    start_page = max(1, int(range_info.get('start', 1)))
-                    end_page = min(num_pages, int(range_info.get('end', num_pages)))
-                    
-                    # Ajustar a base 0 para PyPDF2
-                    start_page_idx = start_page - 1
-                    end_page_idx = end_page - 1
-                    
-                    if start_page_idx > end_page_idx or start_page_idx < 0 or end_page_idx >= num_pages:
-                        continue
-                    
-                    pdf_writer = PyPDF2.PdfWriter()
-                    
-                    # Añadir páginas en el rango
-                    for j in range(start_page_idx, end_page_idx + 1):
-                        pdf_writer.add_page(pdf_reader.pages[j])
-                    
-                    # Nombre del archivo individual
-                    range_filename = f"{base_filename}_paginas_{start_page}-{end_page}.pdf"
-                    output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{range_filename}")
-                    
-                    # Guardar el archivo de rango
-                    with open(output_path, 'wb') as output_pdf:
-                        pdf_writer.write(output_pdf)
-                    
-                    # Agregar al ZIP y a la lista de archivos a eliminar
-                    zip_file.write(output_path, range_filename)
-                    output_files.append(output_path)
-        
-        # Cerrar el buffer del ZIP y preparar para enviar
-        zip_buffer.seek(0)
+        with span('process_pages'):
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                if split_mode == 'all':
+                    # Dividir todas las páginas individualmente
+                    for i in range(num_pages):
+                        pdf_writer = PyPDF2.PdfWriter()
+                        pdf_writer.add_page(pdf_reader.pages[i])
+                        
+                        # Nombre del archivo individual
+                        page_filename = f"{base_filename}_pagina_{i+1}.pdf"
+                        output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{page_filename}")
+                        
+                        # Guardar la página individual
+                        with span('serialize'), open(output_path, 'wb') as output_pdf:
+                            pdf_writer.write(output_pdf)
+                        
+                        # Agregar al ZIP y eliminar la página temporal
+                        zip_file.write(output_path, page_filename)
+                        os.remove(output_path)
+                
+                elif split_mode == 'range':
+                    # Dividir por rangos específicos
+                    for i, range_info in enumerate(split_ranges):
+                        start_page = max(1, int(range_info.get('start', 1)))
+                        end_page = min(num_pages, int(range_info.get('end', num_pages)))
+                        
+                        # Ajustar a base 0 para PyPDF2
+                        start_page_idx = start_page - 1
+                        end_page_idx = end_page - 1
+                        
+                        if start_page_idx > end_page_idx or start_page_idx < 0 or end_page_idx >= num_pages:
+                            continue
+                        
+                        pdf_writer = PyPDF2.PdfWriter()
+                        
+                        # Añadir páginas en el rango
+                        for j in range(start_page_idx, end_page_idx + 1):
+                            pdf_writer.add_page(pdf_reader.pages[j])
+                        
+                        # Nombre del archivo individual
+                        range_filename = f"{base_filename}_paginas_{start_page}-{end_page}.pdf"
+                        output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{range_filename}")
+                        
+                        # Guardar el archivo de rango
+                        with span('serialize'), open(output_path, 'wb') as output_pdf:
+                            pdf_writer.write(output_pdf)
+                        
+                        # Agregar al ZIP y eliminar la página temporal
+                        zip_file.write(output_path, range_filename)
+                        os.remove(output_path)
         
         # Nombre del archivo ZIP a descargar
         zip_filename = f"{base_filename}_dividido.zip"
         
-        # Configurar limpieza retardada para eliminar archivos después de la descarga
-        @after_this_request
-        def cleanup_after_request(response):
-            # Solo iniciar el hilo de limpieza si la respuesta es exitosa
-            if response.status_code == 200:
-                delayed_file_cleanup(output_files, delay_seconds=2)
-            return response
-        
-        # Enviar el archivo ZIP como respuesta
-        return send_file(
-            io.BytesIO(zip_buffer.getvalue()),
-            as_attachment=True,
-            download_name=zip_filename,
-            mimetype='application/zip'
-        )
+        # Enviar el archivo ZIP como respuesta (queda disponible como artefacto)
+        return send_artifact(zip_path, zip_filename, 'application/zip')
         
     except Exception as e:
         return jsonify({'error': f'Error al dividir el PDF: {str(e)}'}), 500
+    
+    finally:
+        # El ZIP enviado ya se movió a los artefactos: aquí solo quedan los de un error
+        for path in (input_path, zip_path, output_path):
+            try:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
 
 @app.route('/clean-temp', methods=['GET'])
 def clean_temp():
@@ -551,6 +2001,198 @@ def clean_temp():
             "message": f"Error al limpiar la carpeta temporal: {str(e)}"
         }), 500
 
+@app.route('/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Inicia una subida por partes y preasigna el archivo de destino"""
+    cleanup_temp_files()
+    
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(data.get('filename', ''))
+    if not filename:
+        return jsonify({'error': 'Se requiere el nombre del archivo'}), 400
+    
+    extension = os.path.splitext(filename)[1].lower()
+    allowed_extensions = set(ext for rule in UPLOAD_RULES.values() for ext in rule)
+    if extension not in allowed_extensions:
+        return jsonify({'error': f'Tipo de archivo no permitido ({extension or "sin extensión"})'}), 415
+    
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'El tamaño del archivo no es válido'}), 400
+    if size <= 0:
+        return jsonify({'error': 'El tamaño del archivo no es válido'}), 400
+    if size > CHUNKED_UPLOAD_MAX_MB * 1024 * 1024:
+        return jsonify({'error': f'El archivo supera el tamaño máximo de {CHUNKED_UPLOAD_MAX_MB} MB'}), 413
+    
+    upload_id = uuid.uuid4().hex
+    paths = chunked_upload_paths(upload_id)
+    
+    # Preasignar el archivo completo para escribir cada parte en su posición
+    try:
+        with open(paths['data'], 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+    except OSError as e:
+        if os.path.exists(paths['data']):
+            os.remove(paths['data'])
+        return jsonify({'error': f'No hay espacio suficiente para la subida: {str(e)}'}), 507
+    
+    meta = {
+        'upload_id': upload_id,
+        'filename': filename,
+        'content_type': data.get('content_type'),
+        'size': size,
+        'expected_sha256': (data.get('sha256') or '').lower() or None,
+        'sha256': None,
+        'completed': False,
+        'created': datetime.now().isoformat()
+    }
+    write_chunked_upload(paths, meta)
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'size': size,
+        'chunk_size': CHUNKED_UPLOAD_CHUNK_MB * 1024 * 1024
+    }), 201
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Recibe una parte de una subida y la escribe en su posición del archivo"""
+    meta, paths = read_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'La subida no existe o ha expirado'}), 404
+    if meta['completed']:
+        return jsonify({'error': 'La subida ya fue finalizada'}), 409
+    
+    # La posición se indica con ?offset=N o con la cabecera Content-Range
+    content_range = request.headers.get('Content-Range')
+    try:
+        if 'offset' in request.args:
+            offset = int(request.args['offset'])
+        elif content_range and content_range.startswith('bytes '):
+            offset = int(content_range[len('bytes '):].split('-')[0])
+        else:
+            offset = 0
+    except ValueError:
+        return jsonify({'error': 'Posición de la parte no válida'}), 400
+    
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': 'Se requiere la cabecera Content-Length'}), 411
+    if offset < 0 or offset + length > meta['size']:
+        return jsonify({'error': 'La parte excede el tamaño declarado del archivo'}), 416
+    
+    written = 0
+    with open(paths['data'], 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            chunk = request.stream.read(min(1024 * 1024, length - written))
+            if not chunk:
+                break
+            
+            # Validar la firma del archivo con la primera parte
+            if offset == 0 and written == 0:
+                extension = os.path.splitext(meta['filename'])[1].lower()
+                signatures = UPLOAD_SIGNATURES.get(extension)
+                head = chunk[:1024]
+                if signatures and not any(
+                    (signature in head) if extension == '.pdf' else head.startswith(signature)
+                    for signature in signatures
+                ):
+                    return jsonify({'error': f'El contenido no corresponde a un archivo {extension}'}), 415
+            
+            f.write(chunk)
+            written += len(chunk)
+    
+    # Registrar el rango recibido (una línea por parte, escritura en modo append)
+    if written:
+        with open(paths['parts'], 'a') as f:
+            f.write(f"{offset} {written}\n")
+    
+    received = sum(end - start for start, end in received_ranges(paths))
+    return jsonify({'upload_id': meta['upload_id'], 'received': received, 'size': meta['size']})
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Devuelve el estado de una subida para poder reanudarla"""
+    meta, paths = read_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'La subida no existe o ha expirado'}), 404
+    
+    ranges = received_ranges(paths)
+    missing = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < meta['size']:
+        missing.append([position, meta['size']])
+    
+    return jsonify({
+        'upload_id': meta['upload_id'],
+        'filename': meta['filename'],
+        'size': meta['size'],
+        'received': sum(end - start for start, end in ranges),
+        'missing': missing,
+        'completed': meta['completed'],
+        'sha256': meta['sha256']
+    })
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Finaliza una subida verificando que esté completa y su hash de integridad"""
+    meta, paths = read_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'La subida no existe o ha expirado'}), 404
+    if meta['completed']:
+        return jsonify({'upload_id': meta['upload_id'], 'sha256': meta['sha256'], 'size': meta['size']})
+    
+    ranges = received_ranges(paths)
+    if ranges != [[0, meta['size']]]:
+        received = sum(end - start for start, end in ranges)
+        return jsonify({'error': f'La subida está incompleta ({received} de {meta["size"]} bytes)'}), 409
+    
+    # Calcular el hash del archivo completo en el servidor
+    digest = hashlib.sha256()
+    with open(paths['data'], 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    
+    data = request.get_json(silent=True) or request.form
+    expected = (data.get('sha256') or meta['expected_sha256'] or '').lower()
+    if expected and expected != sha256:
+        return jsonify({'error': 'El hash del archivo no coincide. Vuelva a enviar las partes.', 'sha256': sha256}), 422
+    
+    meta['sha256'] = sha256
+    meta['completed'] = True
+    write_chunked_upload(paths, meta)
+    
+    return jsonify({'upload_id': meta['upload_id'], 'sha256': sha256, 'size': meta['size']})
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_chunked_upload(upload_id):
+    """Cancela una subida y elimina sus archivos"""
+    meta, paths = read_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'La subida no existe o ha expirado'}), 404
+    for path in (paths['data'], paths['parts'], paths['meta']):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
+    return jsonify({'status': 'success'})
+
+@app.route('/artifacts/<artifact_id>', methods=['GET'])
+def get_artifact(artifact_id):
+    """Descarga (o reanuda la descarga de) un resultado generado anteriormente"""
+    return send_stored_artifact(artifact_id)
+
 @app.route('/merge-pdf', methods=['POST'])
 def merge_pdf():
     """Fusiona múltiples archivos PDF en uno solo"""
@@ -571,76 +2213,226 @@ def merge_pdf():
         if not file.filename.endswith('.pdf'):
             return jsonify({'error': 'Todos los archivos deben ser documentos PDF (.pdf)'}), 400
     
-    # Lista de archivos temporales (para limpieza posterior)
-    temp_files = []
-    
     # Ruta para el archivo de salida
     temp_id = str(uuid.uuid4())
     output_filename = f"{temp_id}_merged.pdf"
     output_path = os.path.join(UPLOAD_FOLDER, output_filename)
     
     try:
-        # Crear un nuevo PDF para la fusión
-        pdf_merger = PyPDF2.PdfMerger()
+        # Crear un nuevo PDF para la fusión (PyMuPDF copia las páginas sin re-serializar
+        # cada documento por separado, a diferencia de PyPDF2.PdfMerger)
+        merged_document = fitz.open()
+        
+        # Tabla de contenido: un marcador por archivo de entrada
+        merged_toc = []
         
-        # Procesar cada archivo
+        # Abrir cada archivo desde su spool en disco, sin copiarlo ni cargarlo entero en
+        # memoria (solo los archivos que no están en disco se leen a memoria)
         for file in files:
-            # Crear un nombre único para el archivo temporal
             filename = secure_filename(file.filename)
-            temp_file_id = str(uuid.uuid4())
-            input_path = os.path.join(UPLOAD_FOLDER, f"{temp_file_id}_{filename}")
             
-            # Guardar el archivo
             try:
-                file.save(input_path)
-                temp_files.append(input_path)  # Agregarlo a la lista para limpieza
+                with span('open'):
+                    source_path = spooled_upload_path(file)
+                    if source_path:
+                        source_document = fitz.open(source_path, filetype='pdf')
+                    else:
+                        source_document = fitz.open(stream=file.read(), filetype='pdf')
             except Exception as e:
-                return jsonify({'error': f'Error al procesar el archivo {filename}: {str(e)}'}), 500
-            
-            # Verificar que el archivo se guardó correctamente
-            if not os.path.exists(input_path):
-                return jsonify({'error': f'Error al procesar el archivo {filename}'}), 500
+                merged_document.close()
+                return jsonify({'error': f'Error al fusionar el archivo {filename}. El archivo puede estar dañado o protegido: {str(e)}'}), 400
             
-            # Añadir el PDF al merger
             try:
-                pdf_merger.append(input_path)
+                if source_document.needs_pass:
+                    merged_document.close()
+                    return jsonify({'error': f'Error al fusionar el archivo {filename}. El archivo está protegido con contraseña.'}), 400
+                
+                # Página inicial (base 1) del archivo dentro del documento fusionado
+                start_page = merged_document.page_count + 1
+                
+                # Añadir las páginas al documento fusionado
+                with span('process_pages'):
+                    merged_document.insert_pdf(source_document)
+                
+                # Marcador para el archivo y sus propios marcadores anidados debajo
+                merged_toc.append([1, os.path.splitext(file.filename)[0], start_page])
+                for level, title, page in source_document.get_toc(simple=True):
+                    if page > 0:
+                        merged_toc.append([level + 1, title, page + start_page - 1])
             except Exception as e:
+                merged_document.close()
                 return jsonify({'error': f'Error al fusionar el archivo {filename}. El archivo puede estar dañado o protegido: {str(e)}'}), 400
+            finally:
+                # Liberar el documento de origen antes de leer el siguiente
+                source_document.close()
         
-        # Guardar el PDF fusionado
-        pdf_merger.write(output_path)
-        pdf_merger.close()
-        
-        # Agregar el archivo de salida a la lista de limpieza
-        temp_files.append(output_path)
+        try:
+            merged_document.set_toc(merged_toc)
+        except Exception as e:
+            # Si algún marcador heredado es inválido, conservar solo uno por archivo
+            logger.warning(f"Marcadores de entrada inválidos, se omiten: {e}")
+            merged_document.set_toc([entry for entry in merged_toc if entry[0] == 1])
         
-        # Configurar limpieza retardada para eliminar archivos después de la descarga
-        @after_this_request
-        def cleanup_after_request(response):
-            # Solo iniciar el hilo de limpieza si la respuesta es exitosa
-            if response.status_code == 200:
-                delayed_file_cleanup(temp_files, delay_seconds=2)
-            return response
+        # Guardar el PDF fusionado. garbage=4 elimina objetos sin uso y fusiona los
+        # objetos y streams idénticos (fuentes e imágenes repetidas entre documentos
+        # generados con la misma plantilla) comparando su contenido.
+        with span('serialize'):
+            merged_document.save(output_path, garbage=4, deflate=True)
+        merged_document.close()
         
-        # Enviar el archivo PDF fusionado como respuesta
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name="documentos_fusionados.pdf",
-            mimetype='application/pdf'
-        )
+        # Enviar el archivo PDF fusionado como respuesta (queda disponible como artefacto)
+        return send_artifact(output_path, "documentos_fusionados.pdf", 'application/pdf')
         
     except Exception as e:
-        # Limpiar archivos temporales en caso de error
-        for file_path in temp_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except:
-                pass
+        # Limpiar el archivo de salida en caso de error
+        try:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        except:
+            pass
         
         return jsonify({'error': f'Error al fusionar PDFs: {str(e)}'}), 500
 
+# Clasificación de páginas sin rasterizarlas: una página tiene texto nativo si contiene
+# suficientes caracteres legibles (visibles o invisibles, como los de una capa de OCR) y
+# está dominada por imágenes si estas cubren buena parte de su superficie. Con esto el OCR
+# y el resumen solo reconocen las páginas escaneadas y la compresión solo aplica la
+# recompresión agresiva a las imágenes de esas páginas.
+PAGE_TEXT_MIN_CHARS = 20
+# Con menos caracteres que esto, una página dominada por imágenes se reconoce igualmente
+# (p. ej. un escaneo con una cabecera o un número de página añadidos)
+PAGE_TEXT_FULL_CHARS = 200
+PAGE_IMAGE_DOMINANT = 0.5
+# Fuente de las capas de texto invisibles de Tesseract y OCRmyPDF
+OCR_LAYER_FONT = 'GlyphLessFont'
+
+def readable_chars(text):
+    """Caracteres de un texto extraído que no son espacios ni caracteres sin mapear (U+FFFD)"""
+    return sum(1 for char in text if not char.isspace() and char != '\ufffd')
+
+def page_image_coverage(page):
+    """
+    Fracción de la página cubierta por imágenes (las superposiciones se cuentan dos veces,
+    con un máximo de 1). Solo localiza las imágenes de los recursos, sin decodificarlas;
+    una imagen dibujada varias veces en la página cuenta una vez.
+    """
+    if page.rect.is_empty:
+        return 0.0
+    covered = 0.0
+    for image in page.get_images(full=True):
+        try:
+            bbox = page.get_image_bbox(image)
+        except ValueError:
+            continue
+        # Las imágenes de los recursos que la página no dibuja no tienen posición
+        if bbox.is_infinite or bbox.is_empty:
+            continue
+        covered += abs(bbox & page.rect)
+    return min(1.0, covered / abs(page.rect))
+
+def classify_page(page, text=None):
+    """
+    Clasifica una página de PyMuPDF: 'text' (texto nativo), 'scanned' (imágenes sin texto
+    utilizable), 'mixed' (texto sobre imágenes dominantes) o 'empty' (ni texto ni imágenes).
+    text es el texto de la página si ya se extrajo. needs_ocr indica si hay que reconocerla.
+    """
+    if text is None:
+        text = page.get_text()
+    chars = readable_chars(text)
+    coverage = page_image_coverage(page)
+    ocr_layer = chars > 0 and any(OCR_LAYER_FONT in font[3] for font in page.get_fonts())
+    
+    if chars < PAGE_TEXT_MIN_CHARS:
+        kind = 'scanned' if coverage > 0 else 'empty'
+    elif coverage >= PAGE_IMAGE_DOMINANT:
+        kind = 'mixed'
+    else:
+        kind = 'text'
+    needs_ocr = kind == 'scanned' or (kind == 'mixed' and not ocr_layer and chars < PAGE_TEXT_FULL_CHARS)
+    return {'kind': kind, 'chars': chars, 'image_coverage': round(coverage, 3),
+            'ocr_layer': ocr_layer, 'needs_ocr': needs_ocr}
+
+def image_dominated_xrefs(path):
+    """Números de objeto de las imágenes que aparecen en páginas dominadas por imágenes"""
+    xrefs = set()
+    with fitz.open(path) as document:
+        for page in document:
+            if page_image_coverage(page) >= PAGE_IMAGE_DOMINANT:
+                xrefs.update(image[0] for image in page.get_images(full=True))
+    return xrefs
+
+# Lado máximo (en píxeles) de las imágenes recomprimidas por /compress-pdf
+COMPRESS_MAX_IMAGE_SIDE = 2000
+
+def recompress_pdf_image(image, image_quality, aggressive=False):
+    """
+    Recomprime una imagen de un PDF (objeto de pikepdf) como JPEG si así ocupa menos.
+    Las imágenes JPEG se decodifican directamente a escala reducida (draft) cuando se van
+    a redimensionar; el resto solo se decodifica si cabe en el presupuesto de memoria.
+    Con aggressive (imágenes de páginas escaneadas) se usa una calidad más baja.
+    Devuelve True si se reemplazó la imagen.
+    """
+    from pikepdf import Name, PdfImage
+    
+    if image.get('/ImageMask') or '/Decode' in image:
+        return False
+    pdf_image = PdfImage(image)
+    if pdf_image.bits_per_component != 8:
+        return False
+    
+    width, height = pdf_image.width, pdf_image.height
+    # Calidad más agresiva para las páginas escaneadas, donde la imagen es la página
+    if aggressive:
+        quality = max(15, image_quality - 20)
+    else:
+        quality = image_quality
+    scale = min(1, COMPRESS_MAX_IMAGE_SIDE / max(width, height))
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    
+    raw_data = image.read_raw_bytes()
+    raw_size = len(raw_data)
+    if pdf_image.filters == ['/DCTDecode']:
+        img = Image.open(io.BytesIO(raw_data))
+        if img.mode not in ('RGB', 'L'):
+            return False
+        img.draft(img.mode, target)
+    else:
+        if width * height * 4 > MEMORY_BUDGET:
+            logger.warning(f"Imagen de {width}x{height} demasiado grande para el presupuesto de memoria; se conserva")
+            return False
+        img = pdf_image.as_pil_image()
+    raw_data = None
+    
+    try:
+        colorspace = None
+        if img.mode == 'CMYK':
+            img = img.convert('RGB')
+            colorspace = Name.DeviceRGB
+        elif img.mode not in ('RGB', 'L'):
+            return False
+        if img.size != target:
+            img = img.resize(target, Image.LANCZOS)
+        
+        out = io.BytesIO()
+        with span('jpeg_encode'):
+            img.save(out, format='JPEG', quality=quality, optimize=True)
+        sample_memory()
+    finally:
+        img.close()
+    
+    data = out.getvalue()
+    if len(data) >= raw_size:
+        return False
+    
+    image.write(data, filter=Name.DCTDecode)
+    if '/DecodeParms' in image:
+        del image.DecodeParms
+    image.Width, image.Height = target
+    image.BitsPerComponent = 8
+    if colorspace is not None:
+        image.ColorSpace = colorspace
+    return True
+
 @app.route('/compress-pdf', methods=['POST'])
 def compress_pdf():
     """Comprime un archivo PDF según el nivel de compresión seleccionado"""
@@ -672,7 +2464,7 @@ def compress_pdf():
     
     # Guardar el archivo
     try:
-        file.save(input_path)
+        save_upload(file, input_path)
     except Exception as e:
         return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 500
     
@@ -698,71 +2490,44 @@ def compress_pdf():
     try:
         # Usar pikepdf para comprimir el PDF
         import pikepdf
-        import copy
-        from pikepdf import PdfImage, Name, PdfError
+        from pikepdf import Name, PdfError
         
         print(f"Comprimiendo {input_path} con nivel {compression_level}")
         input_size = os.path.getsize(input_path)
         print(f"Tamaño original: {input_size / 1024:.2f} KB")
         
+        # Imágenes de páginas escaneadas, que admiten una recompresión más agresiva
+        with span('classify'):
+            aggressive_xrefs = image_dominated_xrefs(input_path)
+        
         # Abrir el PDF con pikepdf
-        with pikepdf.open(input_path) as pdf:
-            # Modificador de imágenes - versión muy agresiva
-            for page_num, page in enumerate(pdf.pages):
-                try:
-                    contents_key = Name.Contents
-                    if contents_key not in page:
-                        continue
+        with span('open'):
+            pdf = pikepdf.open(input_path)
+        with pdf:
+            # Recomprimir las imágenes de cada página. Los objetos se recorren por referencia
+            # y cada imagen se decodifica, recodifica y libera antes de pasar a la siguiente;
+            # las imágenes compartidas entre páginas se procesan una sola vez.
+            processed = set()
+            with span('process_pages'):
+                for page_num, page in enumerate(pdf.pages):
+                    try:
+                        resources = page.obj.get('/Resources')
+                        xobjects = resources.get('/XObject') if resources is not None else None
+                        if xobjects is None:
+                            continue
                         
-                    for image_key in ('/XObject', '/Resources/XObject'):
-                        try:
-                            xobjects = page.get_inheritable(Name('/XObject'))
-                            if xobjects is None:
+                        for key in list(xobjects.keys()):
+                            image = xobjects[key]
+                            if image.objgen in processed or image.get('/Subtype') != Name.Image:
                                 continue
-                                
-                            for k, v in dict(xobjects).items():
-                                try:
-                                    pim = PdfImage(v)
-                                    
-                                    if pim.image is not None and hasattr(pim.image, 'mode'):
-                                        # Reducir la calidad solo para imágenes a color o escala de grises
-                                        if pim.image.mode in ('RGB', 'RGBA', 'CMYK', 'L'):
-                                            format = 'JPEG'
-                                            # Usar una calidad agresiva para ciertas imágenes
-                                            if pim.width > 1000 or pim.height > 1000:
-                                                quality = max(15, image_quality - 20)  # Muy agresivo para imágenes grandes
-                                            else:
-                                                quality = image_quality
-                                            
-                                            try:
-                                                import io
-                                                
-                                                # Convertir a RGB si es CMYK
-                                                img = pim.image
-                                                if img.mode == 'CMYK':
-                                                    img = img.convert('RGB')
-                                                
-                                                # Para imágenes muy grandes, redimensionar
-                                                if pim.width > 2000 or pim.height > 2000:
-                                                    ratio = min(2000 / pim.width, 2000 / pim.height)
-                                                    new_width = int(pim.width * ratio)
-                                                    new_height = int(pim.height * ratio)
-                                                    img = img.resize((new_width, new_height), Image.LANCZOS)
-                                                
-                                                out = io.BytesIO()
-                                                img.save(out, format=format, quality=quality, optimize=True)
-                                                out.seek(0)
-                                                
-                                                # Reemplazar la imagen original
-                                                xobjects[k] = pdf.make_stream(out.read())
-                                            except Exception as img_err:
-                                                print(f"Error procesando imagen: {img_err}")
-                                except PdfError:
-                                    continue
-                        except Exception as e:
-                            print(f"Error procesando recursos de página {page_num}: {e}")
-                except Exception as e:
-                    print(f"Error procesando página {page_num}: {e}")
+                            processed.add(image.objgen)
+                            try:
+                                recompress_pdf_image(image, image_quality, image.objgen[0] in aggressive_xrefs)
+                            except (PdfError, OSError, ValueError, NotImplementedError) as img_err:
+                                print(f"Error procesando imagen {key} de la página {page_num}: {img_err}")
+                    except Exception as e:
+                        print(f"Error procesando página {page_num}: {e}")
+                    sample_memory()
             
             # Configuraciones específicas para optimizar el PDF por completo
             save_options = {
@@ -773,7 +2538,8 @@ def compress_pdf():
             }
             
             # Guardar el PDF comprimido
-            pdf.save(output_path, **save_options)
+            with span('serialize'):
+                pdf.save(output_path, **save_options)
             
         output_size = os.path.getsize(output_path)
         print(f"Tamaño comprimido: {output_size / 1024:.2f} KB")
@@ -794,7 +2560,8 @@ def compress_pdf():
         try:
             import PyPDF2
             
-            reader = PyPDF2.PdfReader(input_path)
+            with span('open'):
+                reader = PyPDF2.PdfReader(input_path)
             writer = PyPDF2.PdfWriter()
             
             # Copiar cada página
@@ -806,7 +2573,7 @@ def compress_pdf():
             writer._compress_streams = True
                 
             # Guardar el PDF comprimido
-            with open(output_path, 'wb') as output_file:
+            with span('serialize'), open(output_path, 'wb') as output_file:
                 writer.write(output_file)
                 
             output_size = os.path.getsize(output_path)
@@ -834,7 +2601,7 @@ def compress_pdf():
     print(f"Compresión final: {compression_info}")
     
     # Lista de archivos a eliminar después de la descarga
-    files_to_delete = [input_path, output_path]
+    files_to_delete = [input_path]
     
     # Configurar limpieza retardada para eliminar archivos después de la descarga
     @after_this_request
@@ -844,13 +2611,8 @@ def compress_pdf():
             delayed_file_cleanup(files_to_delete, delay_seconds=2)
         return response
     
-    # Enviar el archivo PDF comprimido
-    return send_file(
-        output_path, 
-        as_attachment=True,
-        download_name=output_filename,
-        mimetype='application/pdf'
-    )
+    # Enviar el archivo PDF comprimido (queda disponible como artefacto)
+    return send_artifact(output_path, output_filename, 'application/pdf')
 
 @app.route('/pdf-to-jpg', methods=['POST'])
 def pdf_to_jpg():
@@ -888,7 +2650,7 @@ def pdf_to_jpg():
         
         # Guardar el archivo subido temporalmente
         upload_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{file.filename}")
-        file.save(upload_path)
+        save_upload(file, upload_path)
         filename = file.filename
         
         # Preparar ruta para guardar las imágenes
@@ -901,7 +2663,8 @@ def pdf_to_jpg():
         with zipfile.ZipFile(zip_path, 'w') as zip_file:
             try:
                 # Abrir el PDF
-                pdf_document = fitz.open(upload_path)
+                with span('open'):
+                    pdf_document = fitz.open(upload_path)
                 
                 # Determinar las páginas a procesar
                 if page_range == 'all':
@@ -926,28 +2689,46 @@ def pdf_to_jpg():
                 # Convertir las páginas a JPG y añadirlas al ZIP
                 dpi = 300  # Resolución de la imagen (mayor para mejor calidad)
                 
+                # Memoria por página: el mapa de píxeles RGB más su copia en Pillow.
+                # Las páginas se procesan en ventanas que caben en el presupuesto y al final de
+                # cada ventana se libera la caché de MuPDF.
+                def page_footprint(page, dpi):
+                    return int(page.rect.width * dpi / 72) * int(page.rect.height * dpi / 72) * 3 * 2
+                
+                window = memory_window(max(
+                    (page_footprint(pdf_document[p], dpi) for p in pages_to_process[:50]), default=1
+                ))
+                
                 # Procesar cada página seleccionada
-                for page_num in pages_to_process:
+                for index, page_num in enumerate(pages_to_process):
                     page = pdf_document.load_page(page_num)
                     
-                    # Renderizar página a imagen con la resolución deseada
-                    pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72))
-                    
-                    # Crear un archivo temporal para la imagen JPG
-                    img_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_page_{page_num}.jpg")
-                    
-                    # Guardar la imagen como JPG
-                    pix.save(img_path)
+                    # Una página que por sí sola no cabe en el presupuesto se renderiza a menos resolución
+                    page_dpi = dpi
+                    footprint = page_footprint(page, dpi)
+                    if footprint > MEMORY_BUDGET:
+                        page_dpi = max(72, int(dpi * math.sqrt(MEMORY_BUDGET / footprint)))
+                        logger.warning(f"Página {page_num + 1} demasiado grande para el presupuesto de memoria: "
+                                       f"se renderiza a {page_dpi} DPI")
                     
-                    # Optimizar la imagen con PIL si es necesario
-                    img = Image.open(img_path)
-                    img.save(img_path, format='JPEG', quality=quality, optimize=True)
+                    # Renderizar página a imagen con la resolución deseada
+                    with span('render'):
+                        pix = page.get_pixmap(matrix=fitz.Matrix(page_dpi/72, page_dpi/72))
                     
-                    # Añadir la imagen al ZIP
-                    zip_file.write(img_path, f"page_{page_num}.jpg")
+                    # Pasar los píxeles a Pillow sin la copia intermedia de pix.samples y liberar
+                    # el mapa de píxeles antes de codificar
+                    with span('jpeg_encode'):
+                        img = Image.frombuffer('RGB', (pix.width, pix.height), pix.samples_mv, 'raw', 'RGB', pix.stride, 1)
+                        pix = None
+                        page = None
+                        
+                        # Guardar la imagen como JPG directamente en el ZIP
+                        with zip_file.open(f"page_{page_num}.jpg", 'w') as entry:
+                            img.save(entry, format='JPEG', quality=quality, optimize=True)
+                        img.close()
                     
-                    # Eliminar el archivo temporal de la imagen
-                    os.remove(img_path)
+                    if (index + 1) % window == 0:
+                        release_render_memory()
                 
                 pdf_document.close()
                 
@@ -958,18 +2739,128 @@ def pdf_to_jpg():
         # Eliminar el archivo PDF temporal
         os.remove(upload_path)
         
-        # Devolver el archivo ZIP
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f"{os.path.splitext(filename)[0]}_images.zip",
-            mimetype='application/zip'
-        )
+        # Devolver el archivo ZIP (queda disponible como artefacto)
+        return send_artifact(zip_path, f"{os.path.splitext(filename)[0]}_images.zip", 'application/zip')
     
     except Exception as e:
         logger.error(f"Error en conversión PDF a JPG: {e}")
         return jsonify({'error': f'Error al procesar la solicitud: {str(e)}'}), 500
 
+# Hilos para decodificar y normalizar imágenes (Pillow libera el GIL al decodificar,
+# redimensionar y codificar). Se comparten entre solicitudes y se crean en cada proceso.
+IMAGE_WORKERS = int(os.environ.get('EVARIS_IMAGE_WORKERS', str(os.cpu_count() or 1)))
+_image_pool = None
+_image_pool_pid = None
+_image_pool_lock = threading.Lock()
+
+# Orientaciones EXIF que intercambian el ancho y el alto
+EXIF_TRANSPOSED = (5, 6, 7, 8)
+
+def image_pool():
+    global _image_pool, _image_pool_pid
+    with _image_pool_lock:
+        if _image_pool is None or _image_pool_pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            _image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='evaris-image')
+            _image_pool_pid = os.getpid()
+    return _image_pool
+
+def bounded_map(function, items, window=None, pool=None):
+    """
+    Ejecuta function(item) en el pool de imágenes (u otro pool) y devuelve los futuros en
+    el orden de items, con como mucho window tareas pendientes (por defecto, dos por hilo)
+    para que la memoria no crezca con el tamaño del lote. items puede ser un generador:
+    cada elemento se produce en el hilo que consume los resultados, justo antes de enviarlo.
+    """
+    window = window or IMAGE_WORKERS * 2
+    pool = pool or image_pool()
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def exif_orientation(img):
+    try:
+        return img.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+
+def oriented_image_size(path):
+    """Tamaño de una imagen una vez aplicada su orientación EXIF (solo lee las cabeceras)"""
+    with Image.open(path) as img:
+        width, height = img.size
+        if exif_orientation(img) in EXIF_TRANSPOSED:
+            return height, width
+        return width, height
+
+def jpeg_passthrough_size(path):
+    """
+    Tamaño (ancho, alto) de un JPEG secuencial en RGB o escala de grises y sin rotación
+    EXIF, que reportlab puede incrustar byte a byte como DCTDecode. None para el resto
+    de imágenes. Solo se leen las cabeceras del archivo.
+    """
+    # reportlab reconoce los JPEG por la extensión del archivo
+    if os.path.splitext(path)[1].lower() not in ('.jpg', '.jpeg'):
+        return None
+    try:
+        with Image.open(path) as img:
+            if (img.format == 'JPEG' and img.mode in ('RGB', 'L') and 'progression' not in img.info
+                    and exif_orientation(img) == 1):
+                return img.size
+    except Exception:
+        pass
+    return None
+
+def normalize_image(path, max_size=None):
+    """
+    Prepara una imagen para /jpg-to-pdf (se ejecuta en el pool de imágenes).
+    Devuelve (tamaño, origen, tiempos): origen es la ruta del JPEG si puede incrustarse
+    tal cual, o un búfer JPEG con la imagen orientada según EXIF, sin transparencia
+    (fondo blanco) y, con max_size, reducida para no superar esos píxeles.
+    """
+    timings = {}
+    size = jpeg_passthrough_size(path)
+    if size and (max_size is None or (size[0] <= max_size[0] and size[1] <= max_size[1])):
+        return size, path, timings
+    
+    start = time.perf_counter()
+    with Image.open(path) as original:
+        img = original
+        if max_size and img.format == 'JPEG':
+            # Decodificar los JPEG directamente a una escala cercana a la final
+            target = max_size[::-1] if exif_orientation(img) in EXIF_TRANSPOSED else max_size
+            img.draft(img.mode, target)
+        img = ImageOps.exif_transpose(img)
+        
+        # Fondo blanco para las imágenes con transparencia
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        
+        if max_size:
+            img.thumbnail(max_size, Image.LANCZOS)
+    timings['image_decode'] = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=95)
+    buffer.seek(0)
+    timings['jpeg_encode'] = time.perf_counter() - start
+    size = img.size
+    img.close()
+    return size, buffer, timings
+
 @app.route('/jpg-to-pdf', methods=['POST'])
 def jpg_to_pdf():
     """Convierte imágenes JPG a un archivo PDF"""
@@ -1004,9 +2895,6 @@ def jpg_to_pdf():
         from reportlab.pdfgen import canvas
         from reportlab.lib.units import mm
         from reportlab.lib.utils import ImageReader
-        from PIL import Image
-        import io
-        import os
         
         # Determinar el tamaño de página para el PDF
         page_size_map = {
@@ -1032,7 +2920,7 @@ def jpg_to_pdf():
             # Solo procesar archivos de imagen válidos
             if img_file and img_file.filename != '':
                 img_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_img_{i}_{img_file.filename}")
-                img_file.save(img_path)
+                save_upload(img_file, img_path)
                 temp_image_paths.append(img_path)
                 logger.info(f"Imagen guardada: {img_path}")
         
@@ -1042,12 +2930,12 @@ def jpg_to_pdf():
         # Si se seleccionó "fit", determinar el tamaño de página según la primera imagen
         if page_size == 'fit' and temp_image_paths:
             try:
-                with Image.open(temp_image_paths[0]) as img:
-                    # Convertir de píxeles a mm (asumiendo 300 DPI)
-                    width_mm = img.width / dpi * 25.4
-                    height_mm = img.height / dpi * 25.4
-                    custom_page_size = (width_mm * mm, height_mm * mm)
-                    logger.info(f"Tamaño de página personalizado: {width_mm}mm x {height_mm}mm")
+                # Convertir de píxeles a mm (asumiendo 300 DPI), con la orientación EXIF aplicada
+                width_px, height_px = oriented_image_size(temp_image_paths[0])
+                width_mm = width_px / dpi * 25.4
+                height_mm = height_px / dpi * 25.4
+                custom_page_size = (width_mm * mm, height_mm * mm)
+                logger.info(f"Tamaño de página personalizado: {width_mm}mm x {height_mm}mm")
             except Exception as e:
                 logger.error(f"Error al calcular tamaño personalizado: {e}")
                 custom_page_size = page_size_map.get(page_size, A4)
@@ -1055,6 +2943,16 @@ def jpg_to_pdf():
             custom_page_size = page_size_map.get(page_size, A4)
             logger.info(f"Usando tamaño de página predefinido: {page_size}")
         
+        # Con downscale=true, las imágenes con más píxeles de los necesarios para ocupar
+        # el área útil de la página a 300 DPI se reducen antes de incrustarlas
+        max_size = None
+        if request.form.get('downscale', 'false').lower() == 'true':
+            margin_mm = 10 * mm
+            max_size = (
+                max(1, math.ceil((custom_page_size[0] - 2 * margin_mm) / 72 * dpi)),
+                max(1, math.ceil((custom_page_size[1] - 2 * margin_mm) / 72 * dpi)),
+            )
+        
         # Crear el PDF con reportlab
         try:
             c = canvas.Canvas(pdf_path, pagesize=custom_page_size)
@@ -1064,18 +2962,18 @@ def jpg_to_pdf():
             c.setAuthor("EvariScan")
             c.setSubject("Imágenes convertidas a PDF")
             
-            # Procesar cada imagen
-            for img_path in temp_image_paths:
+            # Las imágenes se decodifican y normalizan en el pool de imágenes (los JPEG RGB
+            # o en escala de grises sin rotación se incrustan tal cual, como DCTDecode) y se
+            # añaden al PDF en el orden de subida desde este hilo
+            normalized = bounded_map(lambda path: normalize_image(path, max_size), temp_image_paths)
+            for img_path, future in zip(temp_image_paths, normalized):
                 try:
-                    img = Image.open(img_path)
-                    
-                    # Si es PNG con transparencia, convertir a RGB con fondo blanco
-                    if img.mode == 'RGBA':
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[3])  # 3 es el canal alpha
-                        img = background
-                    elif img.mode != 'RGB':
-                        img = img.convert('RGB')
+                    img_size, image_source, timings = future.result()
+                    # Tiempo de los hilos del pool (puede superar la duración de la solicitud)
+                    for name, seconds in timings.items():
+                        record_span(name, seconds)
+                    if not isinstance(image_source, str):
+                        image_source = ImageReader(image_source)
                     
                     # Obtener el tamaño de página actual
                     page_width, page_height = custom_page_size
@@ -1086,8 +2984,8 @@ def jpg_to_pdf():
                     max_height = page_height - (2 * margin_mm)
                     
                     # Calcular la escala para ajustar la imagen dentro de los márgenes
-                    img_width_pt = img.width / dpi * 72
-                    img_height_pt = img.height / dpi * 72
+                    img_width_pt = img_size[0] / dpi * 72
+                    img_height_pt = img_size[1] / dpi * 72
                     
                     # Determinar el factor de escala
                     width_ratio = max_width / img_width_pt
@@ -1102,24 +3000,16 @@ def jpg_to_pdf():
                     x_pos = (page_width - final_width) / 2
                     y_pos = (page_height - final_height) / 2
                     
-                    logger.info(f"Procesando imagen {img_path}: {img.width}x{img.height} -> {final_width}x{final_height}")
-                    
-                    # Guardar la imagen temporalmente en un formato que reportlab pueda manejar
-                    img_buffer = io.BytesIO()
-                    img.save(img_buffer, format='JPEG', quality=95)
-                    img_buffer.seek(0)
+                    logger.info(f"Procesando imagen {img_path}: {img_size[0]}x{img_size[1]} -> {final_width}x{final_height}")
                     
                     # Añadir la imagen al PDF
                     c.drawImage(
-                        ImageReader(img_buffer), 
+                        image_source, 
                         x_pos, y_pos, 
                         width=final_width, 
                         height=final_height
                     )
                     
-                    # Cerrar el buffer
-                    img_buffer.close()
-                    
                     # Añadir una nueva página para la siguiente imagen
                     c.showPage()
                     
@@ -1128,7 +3018,8 @@ def jpg_to_pdf():
                     # Continuar con la siguiente imagen si hay un error
             
             # Guardar el PDF
-            c.save()
+            with span('serialize'):
+                c.save()
             logger.info(f"PDF creado exitosamente: {pdf_path}")
             
             # Eliminar las imágenes temporales
@@ -1143,22 +3034,9 @@ def jpg_to_pdf():
                 logger.error("El archivo PDF no se creó correctamente")
                 return jsonify({'error': 'Error al crear el PDF'}), 500
                 
-            # Configurar limpieza automática del archivo después de la descarga
-            @after_this_request
-            def cleanup_after_request(response):
-                # Solo iniciar el hilo de limpieza si la respuesta es exitosa
-                if response.status_code == 200:
-                    delayed_file_cleanup([pdf_path], delay_seconds=5)
-                return response
-            
-            # Devolver el PDF generado
+            # Devolver el PDF generado (queda disponible como artefacto)
             logger.info("Enviando PDF al cliente")
-            return send_file(
-                pdf_path,
-                as_attachment=True,
-                download_name=f"{document_title.replace(' ', '_')}.pdf",
-                mimetype='application/pdf'
-            )
+            return send_artifact(pdf_path, f"{document_title.replace(' ', '_')}.pdf", 'application/pdf')
             
         except Exception as canvas_err:
             logger.error(f"Error al crear el canvas del PDF: {canvas_err}")
@@ -1206,7 +3084,7 @@ def pdf_to_pdfa():
         
         # Guardar el archivo subido temporalmente
         upload_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{file.filename}")
-        file.save(upload_path)
+        save_upload(file, upload_path)
         filename = file.filename
         
         logger.info(f"Archivo guardado temporalmente: {upload_path}")
@@ -1249,7 +3127,7 @@ def pdf_to_pdfa():
             
             # Ejecutar el comando
             logger.info(f"Ejecutando Ghostscript con comando: {' '.join(gs_command)}")
-            result = subprocess.run(gs_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = run_tool('gs', gs_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             
             # Verificar que la conversión fue exitosa
             if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
@@ -1263,17 +3141,12 @@ def pdf_to_pdfa():
             def cleanup_after_request(response):
                 # Solo iniciar el hilo de limpieza si la respuesta es exitosa
                 if response.status_code == 200:
-                    delayed_file_cleanup([upload_path, output_path], delay_seconds=5)
+                    delayed_file_cleanup([upload_path], delay_seconds=5)
                 return response
             
-            # Devolver el PDF/A generado
+            # Devolver el PDF/A generado (queda disponible como artefacto)
             logger.info(f"Enviando PDF/A al cliente: {output_filename}")
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=output_filename,
-                mimetype='application/pdf'
-            )
+            return send_artifact(output_path, output_filename, 'application/pdf')
             
         except subprocess.CalledProcessError as e:
             logger.error(f"Error de GhostScript: {e.stderr.decode() if e.stderr else 'No hay mensaje de error'}")
@@ -1293,34 +3166,434 @@ def pdf_to_pdfa():
         logger.error(f"Error en conversión PDF a PDF/A: {e}")
         return jsonify({'error': f'Error al procesar la solicitud: {str(e)}'}), 500
 
-@app.route('/sign-pdf', methods=['POST'])
-def sign_pdf():
-    """Añade una firma a un documento PDF"""
+# OCR en el servidor con Tesseract: las páginas de los PDF se rasterizan con PyMuPDF en el
+# hilo de la solicitud y se reconocen en paralelo, un proceso de Tesseract por página.
+# Cada página se reconoce una sola vez para los tres formatos de salida (texto, hOCR y PDF
+# solo con texto) y el resultado se guarda por hash del archivo, página, resolución, idioma
+# y modo de segmentación.
+OCR_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'ocr')
+OCR_CACHE_DAYS = int(os.environ.get('EVARIS_OCR_CACHE_DAYS', '30'))
+OCR_WORKERS = int(os.environ.get('EVARIS_OCR_WORKERS', str(os.cpu_count() or 1)))
+OCR_DEFAULT_DPI = 300
+# Idioma por defecto de /ocr y del OCR de las páginas escaneadas al resumir
+OCR_LANGUAGE = os.environ.get('EVARIS_OCR_LANGUAGE', 'spa')
+OCR_MIN_DPI = 150
+OCR_MAX_DPI = 600
+# Las páginas muy grandes (planos, A0) se rasterizan con menos resolución
+OCR_MAX_PIXELS = 40_000_000
+OCR_PAGE_TIMEOUT = int(os.environ.get('EVARIS_OCR_PAGE_TIMEOUT', '300'))
+OCR_FORMATS = ('text', 'hocr', 'pdf')
+# Modos de segmentación de página (--psm) que devuelven texto: 0 solo detecta la
+# orientación y 2 no está implementado en Tesseract
+OCR_PSM_MODES = (1, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13)
+OCR_DEFAULT_PSM = 3
+OCR_OUTPUTS = ('txt', 'hocr', 'pdf')
+# Cambiar al modificar las opciones de Tesseract para no reutilizar resultados antiguos
+OCR_CACHE_VERSION = '1'
+os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
+_ocr_pool = None
+_ocr_pool_pid = None
+_ocr_pool_lock = threading.Lock()
+
+class OCRError(Exception):
+    """Tesseract no pudo reconocer una página"""
+
+def ocr_pool():
+    """
+    Hilos que lanzan y esperan los procesos de Tesseract: cada hilo ocupa un proceso,
+    así que OCR_WORKERS limita los procesos de OCR simultáneos del worker.
+    """
+    global _ocr_pool, _ocr_pool_pid
+    with _ocr_pool_lock:
+        if _ocr_pool is None or _ocr_pool_pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            _ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='evaris-ocr')
+            _ocr_pool_pid = os.getpid()
+    return _ocr_pool
+
+def ocr_cache_base(sha256, page_number, dpi, language, psm=OCR_DEFAULT_PSM):
+    """Ruta base (sin extensión) del resultado de una página en la caché de OCR"""
+    key = hashlib.sha256(f"{OCR_CACHE_VERSION}:{sha256}:{page_number}:{dpi}:{language}:{psm}".encode()).hexdigest()
+    return os.path.join(OCR_CACHE_FOLDER, key)
+
+def ocr_cached(base):
+    """True si la página ya está reconocida; renueva la fecha de sus archivos"""
     try:
-        logger.info("Iniciando proceso de firma de PDF")
-        
-        # Verificar si hay un archivo en la petición
-        if 'file' not in request.files:
-            logger.error("No se ha proporcionado un archivo PDF")
-            return jsonify({'error': 'No se ha proporcionado un archivo PDF'}), 400
-        
-        pdf_file = request.files['file']
-        
-        # Verificar si se seleccionó un archivo
-        if pdf_file.filename == '':
-            logger.error("No se ha seleccionado un archivo")
-            return jsonify({'error': 'No se ha seleccionado un archivo'}), 400
-        
-        # Verificar si el archivo es un PDF
-        if not pdf_file.filename.endswith('.pdf'):
-            logger.error("El archivo debe ser un PDF")
-            return jsonify({'error': 'El archivo debe ser un PDF'}), 400
-        
-        # Obtener parámetros de la firma
-        signature_type = request.form.get('signatureType', 'text')  # 'text' o 'draw'
-        signature_name = request.form.get('signatureName', '')  # para firma de texto
-        signature_position = request.form.get('signaturePosition', 'bottom-right')
-        signature_image = None
+        for extension in OCR_OUTPUTS:
+            os.utime(f"{base}.{extension}")
+        return True
+    except OSError:
+        return False
+
+def image_resolution(img):
+    """Resolución declarada por una imagen, o OCR_DEFAULT_DPI si falta o no es razonable"""
+    try:
+        dpi = int(round(float(img.info.get('dpi', (0, 0))[0])))
+    except (TypeError, ValueError, IndexError):
+        dpi = 0
+    return dpi if 70 <= dpi <= 1200 else OCR_DEFAULT_DPI
+
+def render_ocr_page(page, dpi, destination):
+    """Rasteriza una página en escala de grises para Tesseract; devuelve la resolución usada"""
+    pixels = page.rect.width * page.rect.height * (dpi / 72) ** 2
+    if pixels > OCR_MAX_PIXELS:
+        dpi = max(72, int(dpi * math.sqrt(OCR_MAX_PIXELS / pixels)))
+    with span('render'):
+        pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72), colorspace=fitz.csGRAY, alpha=False)
+        pix.save(destination)
+        del pix
+    return dpi
+
+def prepare_ocr_image(path, frame, destination, mode='L'):
+    """
+    Guarda un fotograma de una imagen subida como PNG orientado según EXIF y sin
+    transparencia (fondo blanco); devuelve su resolución
+    """
+    with span('image_decode'):
+        with Image.open(path) as original:
+            original.seek(frame)
+            dpi = image_resolution(original)
+            img = ImageOps.exif_transpose(original)
+            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
+            img.convert(mode).save(destination, format='PNG', compress_level=1)
+    return dpi
+
+def ocr_page_image(image_path, base, dpi, language, psm=OCR_DEFAULT_PSM):
+    """
+    Reconoce una imagen con Tesseract (se ejecuta en el pool de OCR) y guarda el texto,
+    el hOCR y el PDF solo con texto en base.txt, base.hocr y base.pdf. Elimina la imagen.
+    """
+    temp_base = f"{base}.{os.getpid()}.{threading.get_ident()}"
+    command = [TESSERACT_PATH, image_path, temp_base, '-l', language, '--dpi', str(dpi),
+               '--psm', str(psm), '-c', 'textonly_pdf=1', *OCR_OUTPUTS]
+    # Un hilo por proceso de Tesseract: el paralelismo es entre páginas
+    env = dict(os.environ, OMP_THREAD_LIMIT='1')
+    try:
+        try:
+            result = run_tool('tesseract', command, capture_output=True, text=True, errors='replace',
+                              env=env, timeout=OCR_PAGE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise OCRError(f"Tesseract superó el tiempo máximo de {OCR_PAGE_TIMEOUT} s por página")
+        if result.returncode != 0:
+            raise OCRError(result.stderr.strip() or f"Tesseract terminó con el código {result.returncode}")
+        for extension in OCR_OUTPUTS:
+            os.replace(f"{temp_base}.{extension}", f"{base}.{extension}")
+    finally:
+        for path in [image_path] + [f"{temp_base}.{extension}" for extension in OCR_OUTPUTS]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def recognize_pages(document, input_path, bases, numbers, dpi, language, work_dir, on_page=None,
+                    psm=OCR_DEFAULT_PSM):
+    """
+    Reconoce con Tesseract las páginas numbers de un PDF abierto (document) o los fotogramas
+    de una imagen (input_path, si document es None) y deja el resultado en bases[página].
+    Cada página se rasteriza cuando hay hueco en la ventana de bounded_map y on_page() se
+    llama al terminar cada una.
+    """
+    def page_images():
+        for number in numbers:
+            image_path = os.path.join(work_dir, f"page_{number}.png")
+            if document is not None:
+                page_dpi = render_ocr_page(document[number], dpi, image_path)
+            else:
+                page_dpi = prepare_ocr_image(input_path, number, image_path)
+            yield image_path, bases[number], page_dpi
+    
+    with span('ocr'):
+        for future in bounded_map(lambda item: ocr_page_image(*item, language, psm), page_images(),
+                                  window=OCR_WORKERS * 2, pool=ocr_pool()):
+            future.result()
+            if on_page:
+                on_page()
+
+def ocr_scanned_pages(path, pages, sha256, job_id=None):
+    """
+    Sustituye el texto de las páginas escaneadas de un PDF (pages, el texto nativo de cada
+    página) por su OCR, si Tesseract está disponible. Solo se clasifican las páginas con
+    poco texto. Si el OCR falla se conserva el texto nativo.
+    """
+    if not TESSERACT_PATH:
+        return pages
+    candidates = [number for number, text in enumerate(pages) if readable_chars(text) < PAGE_TEXT_FULL_CHARS]
+    if not candidates:
+        return pages
+    
+    work_dir = os.path.join(UPLOAD_FOLDER, f"ocr_{uuid.uuid4().hex}")
+    try:
+        with fitz.open(path) as document:
+            with span('classify'):
+                numbers = [number for number in candidates if classify_page(document[number], pages[number])['needs_ocr']]
+            bases = {number: ocr_cache_base(sha256, number, OCR_DEFAULT_DPI, OCR_LANGUAGE) for number in numbers}
+            pending = [number for number in numbers if not ocr_cached(bases[number])]
+            if pending:
+                os.makedirs(work_dir)
+                completed = 0
+                
+                def page_done():
+                    nonlocal completed
+                    completed += 1
+                    report_progress(job_id, 'ocr', completed, len(pending))
+                
+                report_progress(job_id, 'ocr', 0, len(pending))
+                recognize_pages(document, path, bases, pending, OCR_DEFAULT_DPI, OCR_LANGUAGE, work_dir, page_done)
+        
+        if numbers:
+            logger.info(f"OCR de {len(numbers)} páginas escaneadas de {len(pages)} ({len(numbers) - len(pending)} en caché)")
+        pages = list(pages)
+        for number in numbers:
+            pages[number] = read_ocr_text(bases[number]) + '\n'
+        return pages
+    except Exception as e:
+        logger.warning(f"No se pudo reconocer el texto de las páginas escaneadas: {e}")
+        return pages
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def read_ocr_text(base):
+    with open(f"{base}.txt", 'r', encoding='utf-8', errors='replace') as f:
+        return f.read().replace('\f', '').strip()
+
+def combine_hocr(bases, filename):
+    """
+    Une el hOCR de cada página en un solo documento: Tesseract numera todo como página 1,
+    así que se renumeran los identificadores y ppageno, y se oculta la ruta temporal.
+    """
+    head = None
+    bodies = []
+    for number, base in enumerate(bases, 1):
+        with open(f"{base}.hocr", 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+        start = content.find('<body>') + len('<body>')
+        end = content.rfind('</body>')
+        if head is None:
+            head = content[:start]
+        body = content[start:end]
+        body = re.sub(r"""id=(['"])(\w+?)_1(?=[_'"])""", lambda m: f"id={m.group(1)}{m.group(2)}_{number}", body)
+        body = re.sub(r'ppageno \d+', f'ppageno {number - 1}', body)
+        body = re.sub(r'image "[^"]*"', lambda m: f'image "{filename}"', body)
+        bodies.append(body)
+    return (head or '') + ''.join(bodies) + '</body>\n</html>\n'
+
+def build_searchable_pdf(document, input_path, bases, work_dir, destination):
+    """
+    Añade la capa de texto invisible de Tesseract sobre cada página del PDF original
+    (document) o, para una imagen, sobre una página del tamaño de cada fotograma. Las
+    páginas con base None ya tienen texto y se dejan como están.
+    """
+    if document is None:
+        document = fitz.open()
+        for frame in range(len(bases)):
+            if len(bases) == 1 and jpeg_passthrough_size(input_path):
+                # El JPEG se incrusta tal cual, sin recomprimir
+                image_path = input_path
+                with Image.open(image_path) as img:
+                    dpi = image_resolution(img)
+                    width, height = img.size
+            else:
+                image_path = os.path.join(work_dir, f"frame_{frame}.png")
+                dpi = prepare_ocr_image(input_path, frame, image_path, mode='RGB')
+                with Image.open(image_path) as img:
+                    width, height = img.size
+            page = document.new_page(width=width * 72 / dpi, height=height * 72 / dpi)
+            page.insert_image(page.rect, filename=image_path)
+    
+    for page, base in zip(document, bases):
+        if base is None:
+            continue
+        # La capa está en coordenadas de la página tal como se ve: colocarla sin rotación
+        # y girarla como la página
+        rotation = page.rotation
+        with fitz.open(f"{base}.pdf") as layer:
+            page.set_rotation(0)
+            page.show_pdf_page(page.rect, layer, 0, overlay=True, rotate=rotation)
+            page.set_rotation(rotation)
+    document.save(destination, garbage=3, deflate=True)
+    document.close()
+
+def cleanup_ocr_cache():
+    """Elimina los resultados de OCR que no se han usado en OCR_CACHE_DAYS días"""
+    cutoff = time.time() - OCR_CACHE_DAYS * 86400
+    for filename in os.listdir(OCR_CACHE_FOLDER):
+        path = os.path.join(OCR_CACHE_FOLDER, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except Exception:
+            pass
+
+@app.route('/ocr', methods=['POST'])
+def ocr_document():
+    """
+    Reconoce el texto de un PDF escaneado o de una imagen con Tesseract. Según format
+    devuelve el texto por páginas (JSON), el hOCR o un PDF con una capa de texto invisible.
+    Salvo con skip_text=false, las páginas de los PDF que ya tienen texto no se reconocen.
+    """
+    cleanup_temp_files()
+    
+    if not TESSERACT_PATH:
+        logger.error("Tesseract no está disponible para el OCR")
+        return jsonify({'error': 'El OCR no está disponible en el servidor (Tesseract no está instalado).'}), 503
+    
+    if 'file' not in request.files:
+        return jsonify({'error': 'No se ha proporcionado ningún archivo'}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No se ha seleccionado ningún archivo'}), 400
+    
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in PDF_EXTENSIONS + IMAGE_EXTENSIONS:
+        return jsonify({'error': 'Formato no soportado. Se admiten PDF e imágenes (JPG, PNG, TIFF, BMP, GIF, WebP).'}), 400
+    
+    language = request.form.get('language', OCR_LANGUAGE)
+    if not re.fullmatch(r'[A-Za-z_]+(\+[A-Za-z_]+)*', language):
+        return jsonify({'error': 'Idioma no válido. Use códigos de Tesseract como "spa" o "spa+eng".'}), 400
+    output_format = request.form.get('format', 'text').lower()
+    if output_format not in OCR_FORMATS:
+        return jsonify({'error': f'Formato de salida no válido. Use: {", ".join(OCR_FORMATS)}'}), 400
+    try:
+        dpi = min(OCR_MAX_DPI, max(OCR_MIN_DPI, int(request.form.get('dpi', OCR_DEFAULT_DPI))))
+    except ValueError:
+        return jsonify({'error': 'La resolución (dpi) debe ser un número entero'}), 400
+    try:
+        psm = int(request.form.get('psm', OCR_DEFAULT_PSM))
+    except ValueError:
+        psm = None
+    if psm not in OCR_PSM_MODES:
+        return jsonify({'error': f'Modo de segmentación (psm) no válido. Use: {", ".join(map(str, OCR_PSM_MODES))}'}), 400
+    skip_text = request.form.get('skip_text', 'true').lower() != 'false'
+    job_id = request.form.get('job_id')
+    
+    work_dir = os.path.join(UPLOAD_FOLDER, f"ocr_{uuid.uuid4().hex}")
+    os.makedirs(work_dir)
+    input_path = os.path.join(work_dir, f"input{extension}")
+    document = None
+    try:
+        file_sha256 = upload_sha256(file)
+        save_upload(file, input_path)
+        
+        if extension in PDF_EXTENSIONS:
+            with span('open'):
+                document = fitz.open(input_path)
+            if document.needs_pass:
+                return jsonify({'error': 'El PDF está protegido con contraseña'}), 400
+            page_count = len(document)
+            # La resolución solo cambia el resultado de los PDF
+            key_dpi = dpi
+        else:
+            with Image.open(input_path) as img:
+                page_count = getattr(img, 'n_frames', 1)
+            key_dpi = 0
+        if page_count == 0:
+            return jsonify({'error': 'El documento no tiene páginas'}), 400
+        
+        logger.info(f"OCR de {file.filename}: {page_count} páginas, idioma {language}, psm {psm}, formato {output_format}")
+        bases = [ocr_cache_base(file_sha256, number, key_dpi, language, psm) for number in range(page_count)]
+        
+        # Las páginas con texto nativo se extraen en lugar de reconocerse (salvo para el hOCR,
+        # que necesita el resultado de Tesseract de todas las páginas)
+        native = {}
+        if document is not None and skip_text and output_format != 'hocr':
+            with span('classify'):
+                for number, page in enumerate(document):
+                    text = page.get_text()
+                    if not classify_page(page, text)['needs_ocr']:
+                        native[number] = text.strip()
+        targets = [number for number in range(page_count) if number not in native]
+        pending = [number for number in targets if not ocr_cached(bases[number])]
+        cached_pages = len(targets) - len(pending)
+        completed = cached_pages
+        report_progress(job_id, 'ocr', completed, len(targets), cached=cached_pages, text_pages=len(native))
+        
+        def page_done():
+            nonlocal completed
+            completed += 1
+            report_progress(job_id, 'ocr', completed, len(targets), cached=cached_pages, text_pages=len(native))
+        
+        recognize_pages(document, input_path, bases, pending, dpi, language, work_dir, page_done, psm)
+        
+        name = os.path.splitext(file.filename)[0]
+        if output_format == 'text':
+            texts = [native[number] if number in native else read_ocr_text(bases[number]) for number in range(page_count)]
+            report_progress(job_id, 'done', len(targets), len(targets))
+            return jsonify({
+                'text': '\n\n'.join(text for text in texts if text),
+                'pages': [
+                    {'page': number + 1, 'text': text, 'source': 'text' if number in native else 'ocr'}
+                    for number, text in enumerate(texts)
+                ],
+                'page_count': page_count,
+                'ocr_pages': len(targets),
+                'text_pages': len(native),
+                'cached_pages': cached_pages,
+                'language': language
+            })
+        
+        if output_format == 'hocr':
+            with span('serialize'):
+                content = combine_hocr(bases, file.filename).encode('utf-8')
+            report_progress(job_id, 'done', len(targets), len(targets))
+            return send_artifact(io.BytesIO(content), f"{name}.hocr", 'text/html')
+        
+        output_path = os.path.join(work_dir, 'output.pdf')
+        with span('serialize'):
+            layers = [None if number in native else bases[number] for number in range(page_count)]
+            build_searchable_pdf(document, input_path, layers, work_dir, output_path)
+            document = None
+        report_progress(job_id, 'done', len(targets), len(targets))
+        return send_artifact(output_path, f"{name}_ocr.pdf", 'application/pdf')
+    
+    except OCRError as e:
+        report_progress(job_id, 'error')
+        message = str(e)
+        if 'load' in message.lower() and 'language' in message.lower():
+            logger.error(f"Idioma de OCR no instalado ({language}): {message}")
+            return jsonify({'error': f'El idioma "{language}" no está instalado en Tesseract'}), 400
+        logger.error(f"Error de Tesseract: {message}")
+        return jsonify({'error': f'Error al reconocer el texto: {message}'}), 500
+    except Exception as e:
+        report_progress(job_id, 'error')
+        logger.error(f"Error en el OCR: {e}")
+        return jsonify({'error': f'Error al procesar la solicitud: {str(e)}'}), 500
+    finally:
+        if document is not None:
+            document.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+@app.route('/sign-pdf', methods=['POST'])
+def sign_pdf():
+    """Añade una firma a un documento PDF"""
+    try:
+        logger.info("Iniciando proceso de firma de PDF")
+        
+        # Verificar si hay un archivo en la petición
+        if 'file' not in request.files:
+            logger.error("No se ha proporcionado un archivo PDF")
+            return jsonify({'error': 'No se ha proporcionado un archivo PDF'}), 400
+        
+        pdf_file = request.files['file']
+        
+        # Verificar si se seleccionó un archivo
+        if pdf_file.filename == '':
+            logger.error("No se ha seleccionado un archivo")
+            return jsonify({'error': 'No se ha seleccionado un archivo'}), 400
+        
+        # Verificar si el archivo es un PDF
+        if not pdf_file.filename.endswith('.pdf'):
+            logger.error("El archivo debe ser un PDF")
+            return jsonify({'error': 'El archivo debe ser un PDF'}), 400
+        
+        # Obtener parámetros de la firma
+        signature_type = request.form.get('signatureType', 'text')  # 'text' o 'draw'
+        signature_name = request.form.get('signatureName', '')  # para firma de texto
+        signature_position = request.form.get('signaturePosition', 'bottom-right')
+        signature_image = None
         
         # Si es firma dibujada, obtener la imagen
         if signature_type == 'draw' and 'signatureImage' in request.files:
@@ -1332,7 +3605,7 @@ def sign_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_firmado_{pdf_file.filename}")
         
         # Guardar el PDF original
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         # Crear firma según el tipo
         signature_img_path = None
@@ -1373,7 +3646,7 @@ def sign_pdf():
             elif signature_type == 'draw' and signature_image:
                 # Guardar la imagen de la firma dibujada
                 signature_img_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_signature.png")
-                signature_image.save(signature_img_path)
+                save_upload(signature_image, signature_img_path)
             else:
                 return jsonify({'error': 'Tipo de firma no válido o falta imagen de firma'}), 400
             
@@ -1410,7 +3683,8 @@ def sign_pdf():
             new_pdf = PdfReader(packet)
             
             # Leer el PDF original
-            existing_pdf = PdfReader(pdf_path)
+            with span('open'):
+                existing_pdf = PdfReader(pdf_path)
             writer = PdfWriter()
             
             # Añadir la firma a la última página
@@ -1426,13 +3700,13 @@ def sign_pdf():
                     writer.add_page(existing_pdf.pages[i])
             
             # Escribir el PDF resultante
-            with open(output_path, 'wb') as output_file:
+            with span('serialize'), open(output_path, 'wb') as output_file:
                 writer.write(output_file)
             
             logger.info(f"PDF firmado correctamente: {output_path}")
             
             # Lista de archivos temporales para limpiar
-            temp_files = [pdf_path, output_path]
+            temp_files = [pdf_path]
             if signature_img_path:
                 temp_files.append(signature_img_path)
             
@@ -1444,13 +3718,8 @@ def sign_pdf():
                     delayed_file_cleanup(temp_files, delay_seconds=5)
                 return response
             
-            # Devolver el PDF firmado
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=f"firmado_{pdf_file.filename}",
-                mimetype='application/pdf'
-            )
+            # Devolver el PDF firmado (queda disponible como artefacto)
+            return send_artifact(output_path, f"firmado_{pdf_file.filename}", 'application/pdf')
             
         except Exception as e:
             logger.error(f"Error al firmar el PDF: {str(e)}")
@@ -1498,7 +3767,7 @@ def watermark_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_watermark_{pdf_file.filename}")
         
         # Guardar el PDF original
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         # Crear marca de agua según el tipo
         watermark_img_path = None
@@ -1578,7 +3847,7 @@ def watermark_pdf():
                 # Guardar la imagen de la marca de agua
                 watermark_image = request.files['watermarkImage']
                 watermark_img_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_watermark.png")
-                watermark_image.save(watermark_img_path)
+                save_upload(watermark_image, watermark_img_path)
                 
                 try:
                     # Procesar la imagen con Pillow para ajustar opacidad
@@ -1629,105 +3898,107 @@ def watermark_pdf():
             import io
             
             # Leer el PDF original
-            existing_pdf = PdfReader(pdf_path)
+            with span('open'):
+                existing_pdf = PdfReader(pdf_path)
             writer = PdfWriter()
             
             # Aplicar marca de agua a cada página
-            for page_num in range(len(existing_pdf.pages)):
-                page = existing_pdf.pages[page_num]
-                
-                # Obtener dimensiones de la página
-                page_width = float(page.mediabox.width)
-                page_height = float(page.mediabox.height)
-                
-                # Crear un PDF temporal con la marca de agua
-                packet = io.BytesIO()
-                can = canvas.Canvas(packet, pagesize=(page_width, page_height))
-                
-                # Ajustar dimensiones de la marca de agua según la posición
-                if watermark_position == 'tile':
-                    # Para mosaico, usar dimensiones más pequeñas
-                    watermark_width = page_width * 0.3
-                    watermark_height = page_height * 0.3
-                    
-                    # Calcular cuántas marcas se necesitan para cubrir la página
-                    columns = int(page_width / watermark_width) + 1
-                    rows = int(page_height / watermark_height) + 1
-                    
-                    # Dibujar la marca de agua en un patrón de mosaico
-                    for row in range(rows):
-                        for col in range(columns):
-                            x = col * watermark_width
-                            y = row * watermark_height
-                            can.drawImage(
-                                watermark_img_path, 
-                                x, y, 
-                                width=watermark_width, 
-                                height=watermark_height, 
-                                mask='auto'
-                            )
-                else:
-                    # Para posiciones específicas, ajustar tamaño según ubicación
-                    if watermark_position == 'center':
-                        # Marca de agua grande en el centro
-                        watermark_width = page_width * 0.7
-                        watermark_height = page_height * 0.7
-                        x = page_width / 2 - watermark_width / 2
-                        y = page_height / 2 - watermark_height / 2
-                    elif watermark_position in ['top-left', 'top-right', 'bottom-left', 'bottom-right']:
-                        # Marca de agua más pequeña en las esquinas
+            with span('process_pages'):
+                for page_num in range(len(existing_pdf.pages)):
+                    page = existing_pdf.pages[page_num]
+                
+                    # Obtener dimensiones de la página
+                    page_width = float(page.mediabox.width)
+                    page_height = float(page.mediabox.height)
+                
+                    # Crear un PDF temporal con la marca de agua
+                    packet = io.BytesIO()
+                    can = canvas.Canvas(packet, pagesize=(page_width, page_height))
+                
+                    # Ajustar dimensiones de la marca de agua según la posición
+                    if watermark_position == 'tile':
+                        # Para mosaico, usar dimensiones más pequeñas
                         watermark_width = page_width * 0.3
                         watermark_height = page_height * 0.3
+                    
+                        # Calcular cuántas marcas se necesitan para cubrir la página
+                        columns = int(page_width / watermark_width) + 1
+                        rows = int(page_height / watermark_height) + 1
+                    
+                        # Dibujar la marca de agua en un patrón de mosaico
+                        for row in range(rows):
+                            for col in range(columns):
+                                x = col * watermark_width
+                                y = row * watermark_height
+                                can.drawImage(
+                                    watermark_img_path, 
+                                    x, y, 
+                                    width=watermark_width, 
+                                    height=watermark_height, 
+                                    mask='auto'
+                                )
+                    else:
+                        # Para posiciones específicas, ajustar tamaño según ubicación
+                        if watermark_position == 'center':
+                            # Marca de agua grande en el centro
+                            watermark_width = page_width * 0.7
+                            watermark_height = page_height * 0.7
+                            x = page_width / 2 - watermark_width / 2
+                            y = page_height / 2 - watermark_height / 2
+                        elif watermark_position in ['top-left', 'top-right', 'bottom-left', 'bottom-right']:
+                            # Marca de agua más pequeña en las esquinas
+                            watermark_width = page_width * 0.3
+                            watermark_height = page_height * 0.3
                         
-                        # Establecer posición según la esquina seleccionada
-                        margin = min(page_width, page_height) * 0.05  # Margen del 5%
+                            # Establecer posición según la esquina seleccionada
+                            margin = min(page_width, page_height) * 0.05  # Margen del 5%
                         
-                        if watermark_position == 'top-left':
-                            x, y = margin, page_height - watermark_height - margin
-                        elif watermark_position == 'top-right':
-                            x, y = page_width - watermark_width - margin, page_height - watermark_height - margin
-                        elif watermark_position == 'bottom-left':
-                            x, y = margin, margin
-                        elif watermark_position == 'bottom-right':
-                            x, y = page_width - watermark_width - margin, margin
-                    else:
-                        # Centro por defecto
-                        watermark_width = page_width * 0.7
-                        watermark_height = page_height * 0.7
-                        x = page_width / 2 - watermark_width / 2
-                        y = page_height / 2 - watermark_height / 2
+                            if watermark_position == 'top-left':
+                                x, y = margin, page_height - watermark_height - margin
+                            elif watermark_position == 'top-right':
+                                x, y = page_width - watermark_width - margin, page_height - watermark_height - margin
+                            elif watermark_position == 'bottom-left':
+                                x, y = margin, margin
+                            elif watermark_position == 'bottom-right':
+                                x, y = page_width - watermark_width - margin, margin
+                        else:
+                            # Centro por defecto
+                            watermark_width = page_width * 0.7
+                            watermark_height = page_height * 0.7
+                            x = page_width / 2 - watermark_width / 2
+                            y = page_height / 2 - watermark_height / 2
                     
-                    # Añadir la imagen al canvas en la posición calculada
-                    can.drawImage(
-                        watermark_img_path, 
-                        x, y, 
-                        width=watermark_width, 
-                        height=watermark_height, 
-                        mask='auto'
-                    )
+                        # Añadir la imagen al canvas en la posición calculada
+                        can.drawImage(
+                            watermark_img_path, 
+                            x, y, 
+                            width=watermark_width, 
+                            height=watermark_height, 
+                            mask='auto'
+                        )
                 
-                can.save()
+                    can.save()
                 
-                # Mover al comienzo del StringIO buffer
-                packet.seek(0)
+                    # Mover al comienzo del StringIO buffer
+                    packet.seek(0)
                 
-                # Crear un nuevo PDF con la marca de agua
-                new_pdf = PdfReader(packet)
+                    # Crear un nuevo PDF con la marca de agua
+                    new_pdf = PdfReader(packet)
                 
-                # Fusionar la página original con la marca de agua
-                page.merge_page(new_pdf.pages[0])
+                    # Fusionar la página original con la marca de agua
+                    page.merge_page(new_pdf.pages[0])
                 
-                # Añadir la página al nuevo documento
-                writer.add_page(page)
+                    # Añadir la página al nuevo documento
+                    writer.add_page(page)
             
             # Escribir el PDF resultante
-            with open(output_path, 'wb') as output_file:
+            with span('serialize'), open(output_path, 'wb') as output_file:
                 writer.write(output_file)
             
             logger.info(f"PDF con marca de agua creado correctamente: {output_path}")
             
             # Lista de archivos temporales para limpiar
-            temp_files = [pdf_path, output_path]
+            temp_files = [pdf_path]
             if watermark_img_path:
                 temp_files.append(watermark_img_path)
             
@@ -1739,13 +4010,8 @@ def watermark_pdf():
                     delayed_file_cleanup(temp_files, delay_seconds=5)
                 return response
             
-            # Devolver el PDF con marca de agua
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=f"watermark_{pdf_file.filename}",
-                mimetype='application/pdf'
-            )
+            # Devolver el PDF con marca de agua (queda disponible como artefacto)
+            return send_artifact(output_path, f"watermark_{pdf_file.filename}", 'application/pdf')
             
         except Exception as e:
             logger.error(f"Error al añadir marca de agua al PDF: {str(e)}")
@@ -1791,14 +4057,15 @@ def rotate_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_rotado_{pdf_file.filename}")
         
         # Guardar el PDF original
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         try:
             # Procesar el PDF para rotar sus páginas
             from PyPDF2 import PdfReader, PdfWriter
             
             # Leer el PDF original
-            reader = PdfReader(pdf_path)
+            with span('open'):
+                reader = PdfReader(pdf_path)
             writer = PdfWriter()
             
             # Determinar qué páginas rotar
@@ -1844,17 +4111,18 @@ def rotate_pdf():
                     return jsonify({'error': 'No se encontraron páginas válidas en el rango especificado'}), 400
             
             # Aplicar rotación a las páginas seleccionadas
-            for i in range(len(reader.pages)):
-                page = reader.pages[i]
+            with span('process_pages'):
+                for i in range(len(reader.pages)):
+                    page = reader.pages[i]
                 
-                if i in pages_to_rotate:
-                    # Aplicar rotación (PyPDF2 usa 90 grados en sentido horario)
-                    page.rotate(rotation_angle)
+                    if i in pages_to_rotate:
+                        # Aplicar rotación (PyPDF2 usa 90 grados en sentido horario)
+                        page.rotate(rotation_angle)
                 
-                writer.add_page(page)
+                    writer.add_page(page)
             
             # Escribir el PDF resultante
-            with open(output_path, 'wb') as output_file:
+            with span('serialize'), open(output_path, 'wb') as output_file:
                 writer.write(output_file)
             
             logger.info(f"PDF rotado correctamente: {output_path}")
@@ -1864,16 +4132,11 @@ def rotate_pdf():
             def cleanup_after_request(response):
                 # Solo iniciar el hilo de limpieza si la respuesta es exitosa
                 if response.status_code == 200:
-                    delayed_file_cleanup([pdf_path, output_path], delay_seconds=5)
+                    delayed_file_cleanup([pdf_path], delay_seconds=5)
                 return response
             
-            # Devolver el PDF rotado
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=f"rotado_{pdf_file.filename}",
-                mimetype='application/pdf'
-            )
+            # Devolver el PDF rotado (queda disponible como artefacto)
+            return send_artifact(output_path, f"rotado_{pdf_file.filename}", 'application/pdf')
             
         except Exception as e:
             logger.error(f"Error al rotar el PDF: {str(e)}")
@@ -1947,14 +4210,15 @@ def sort_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_reordenado_{pdf_file.filename}")
         
         # Guardar el PDF original
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         try:
             # Procesar el PDF para reordenar sus páginas
             from PyPDF2 import PdfReader, PdfWriter
             
             # Leer el PDF original
-            reader = PdfReader(pdf_path)
+            with span('open'):
+                reader = PdfReader(pdf_path)
             writer = PdfWriter()
             
             # Verificar que los índices sean válidos
@@ -1967,7 +4231,7 @@ def sort_pdf():
                 writer.add_page(reader.pages[page_idx])
             
             # Escribir el PDF resultante
-            with open(output_path, 'wb') as output_file:
+            with span('serialize'), open(output_path, 'wb') as output_file:
                 writer.write(output_file)
             
             logger.info(f"PDF reordenado correctamente: {output_path}")
@@ -1977,16 +4241,11 @@ def sort_pdf():
             def cleanup_after_request(response):
                 # Solo iniciar el hilo de limpieza si la respuesta es exitosa
                 if response.status_code == 200:
-                    delayed_file_cleanup([pdf_path, output_path], delay_seconds=5)
+                    delayed_file_cleanup([pdf_path], delay_seconds=5)
                 return response
             
-            # Devolver el PDF reordenado
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=f"reordenado_{pdf_file.filename}",
-                mimetype='application/pdf'
-            )
+            # Devolver el PDF reordenado (queda disponible como artefacto)
+            return send_artifact(output_path, f"reordenado_{pdf_file.filename}", 'application/pdf')
             
         except Exception as e:
             logger.error(f"Error al reordenar el PDF: {str(e)}")
@@ -2024,13 +4283,14 @@ def get_pdf_info():
         pdf_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{pdf_file.filename}")
         
         # Guardar el PDF
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         try:
             # Obtener información del PDF
             from PyPDF2 import PdfReader
             
-            reader = PdfReader(pdf_path)
+            with span('open'):
+                reader = PdfReader(pdf_path)
             page_count = len(reader.pages)
             
             # Información básica del documento
@@ -2084,7 +4344,7 @@ def get_pdf_thumbnails():
         pdf_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{pdf_file.filename}")
         
         # Guardar el PDF
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         try:
             # Generar miniaturas de cada página
@@ -2095,7 +4355,8 @@ def get_pdf_thumbnails():
             import io
             
             # Leer el PDF con PyMuPDF (fitz)
-            pdf_document = fitz.open(pdf_path)
+            with span('open'):
+                pdf_document = fitz.open(pdf_path)
             page_count = len(pdf_document)
             
             # Preparar array para las miniaturas
@@ -2184,7 +4445,7 @@ def preview_rotated_pdf():
         pdf_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_{pdf_file.filename}")
         
         # Guardar el PDF original
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         try:
             # Usar PyMuPDF (fitz) para todo el proceso en lugar de PyPDF2
@@ -2194,7 +4455,8 @@ def preview_rotated_pdf():
             from PIL import Image, ImageDraw, ImageFont
             
             # Abrir el PDF con PyMuPDF
-            pdf_document = fitz.open(pdf_path)
+            with span('open'):
+                pdf_document = fitz.open(pdf_path)
             
             # Determinar qué páginas rotar
             pages_to_rotate_indices = []
@@ -2252,7 +4514,8 @@ def preview_rotated_pdf():
             pdf_document.close()
             
             # Reabrir el documento para verificar y generar miniaturas
-            pdf_document = fitz.open(temp_output_path)
+            with span('open'):
+                pdf_document = fitz.open(temp_output_path)
             
             # Verificar los ángulos después de rotar
             logger.info("Ángulos después de rotar:")
@@ -2444,11 +4707,12 @@ def preview_rotated_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"{temp_id}_recortado_{pdf_file.filename}")
         
         # Guardar el PDF original
-        pdf_file.save(pdf_path)
+        save_upload(pdf_file, pdf_path)
         
         try:
             # Procesar el PDF para recortar sus páginas usando PyMuPDF (fitz)
-            doc = fitz.open(pdf_path)
+            with span('open'):
+                doc = fitz.open(pdf_path)
             
             # Determinar qué páginas recortar
             pages_to_crop = []
@@ -2565,7 +4829,8 @@ def preview_rotated_pdf():
                         # Continuar con la siguiente página
             
             # Guardar el PDF recortado
-            doc.save(output_path)
+            with span('serialize'):
+                doc.save(output_path)
             doc.close()
             
             
@@ -2574,16 +4839,11 @@ def preview_rotated_pdf():
             def cleanup_after_request(response):
                 # Solo iniciar el hilo de limpieza si la respuesta es exitosa
                 if response.status_code == 200:
-                    delayed_file_cleanup([pdf_path, output_path], delay_seconds=5)
+                    delayed_file_cleanup([pdf_path], delay_seconds=5)
                 return response
             
-            # Devolver el PDF recortado
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=f"recortado_{pdf_file.filename}",
-                mimetype='application/pdf'
-            )
+            # Devolver el PDF recortado (queda disponible como artefacto)
+            return send_artifact(output_path, f"recortado_{pdf_file.filename}", 'application/pdf')
             
         except Exception as e:
             logger.error(f"Error al recortar el PDF con método exacto: {str(e)}")
@@ -2643,10 +4903,11 @@ def add_page_numbers():
         output_path = os.path.join(UPLOAD_FOLDER, f"numbered_{uuid.uuid4()}_{input_filename}")
         
         # Guardar el archivo subido
-        file.save(temp_input_path)
+        save_upload(file, temp_input_path)
         
         # Procesar el PDF con PyMuPDF (fitz)
-        doc = fitz.open(temp_input_path)
+        with span('open'):
+            doc = fitz.open(temp_input_path)
         total_pages = len(doc)
         
         # Determinar qué páginas procesar (todas o excluir la primera)
@@ -2718,48 +4979,50 @@ def add_page_numbers():
                 return str(actual_number)
         
         # Añadir números de página a cada página en el documento
-        for page_num in pages_to_process:
-            page = doc[page_num]
-            page_text = format_number(page_num - (1 if exclude_first_page else 0), total_pages)
-            
-            # Determinar posición
-            rect = page.rect
-            text_width = font_size * len(page_text) * 0.5  # Estimación aproximada
-            margin_pts = margin * 2.83465  # Convertir mm a puntos (1mm ≈ 2.83465pt)
-            
-            if position == 'bottom-center':
-                x = (rect.width - text_width) / 2
-                y = rect.height - margin_pts
-            elif position == 'bottom-right':
-                x = rect.width - text_width - margin_pts
-                y = rect.height - margin_pts
-            elif position == 'bottom-left':
-                x = margin_pts
-                y = rect.height - margin_pts
-            elif position == 'top-center':
-                x = (rect.width - text_width) / 2
-                y = margin_pts
-            elif position == 'top-right':
-                x = rect.width - text_width - margin_pts
-                y = margin_pts
-            elif position == 'top-left':
-                x = margin_pts
-                y = margin_pts
-            else:  # Por defecto, abajo al centro
-                x = (rect.width - text_width) / 2
-                y = rect.height - margin_pts
-            
-            # Insertar el texto del número de página usando la fuente segura
-            page.insert_text(
-                point=(x, y),
-                text=page_text,
-                fontsize=font_size,
-                fontname=safe_font,
-                color=(0, 0, 0)  # Negro
+        with span('process_pages'):
+            for page_num in pages_to_process:
+                page = doc[page_num]
+                page_text = format_number(page_num - (1 if exclude_first_page else 0), total_pages)
+            
+                # Determinar posición
+                rect = page.rect
+                text_width = font_size * len(page_text) * 0.5  # Estimación aproximada
+                margin_pts = margin * 2.83465  # Convertir mm a puntos (1mm ≈ 2.83465pt)
+            
+                if position == 'bottom-center':
+                    x = (rect.width - text_width) / 2
+                    y = rect.height - margin_pts
+                elif position == 'bottom-right':
+                    x = rect.width - text_width - margin_pts
+                    y = rect.height - margin_pts
+                elif position == 'bottom-left':
+                    x = margin_pts
+                    y = rect.height - margin_pts
+                elif position == 'top-center':
+                    x = (rect.width - text_width) / 2
+                    y = margin_pts
+                elif position == 'top-right':
+                    x = rect.width - text_width - margin_pts
+                    y = margin_pts
+                elif position == 'top-left':
+                    x = margin_pts
+                    y = margin_pts
+                else:  # Por defecto, abajo al centro
+                    x = (rect.width - text_width) / 2
+                    y = rect.height - margin_pts
+            
+                # Insertar el texto del número de página usando la fuente segura
+                page.insert_text(
+                    point=(x, y),
+                    text=page_text,
+                    fontsize=font_size,
+                    fontname=safe_font,
+                    color=(0, 0, 0)  # Negro
             )
         
         # Guardar el documento modificado
-        doc.save(output_path)
+        with span('serialize'):
+            doc.save(output_path)
         doc.close()
         
         # Configurar respuesta para descargar el archivo
@@ -2768,15 +5031,10 @@ def add_page_numbers():
             # Solo iniciar el hilo de limpieza si la respuesta es exitosa
             if response.status_code == 200:
                 # Eliminar archivos después de un breve retraso para asegurar la descarga
-                delayed_file_cleanup([temp_input_path, output_path])
+                delayed_file_cleanup([temp_input_path])
             return response
         
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name=f"numerado_{input_filename}",
-            mimetype='application/pdf'
-        )
+        return send_artifact(output_path, f"numerado_{input_filename}", 'application/pdf')
         
     except Exception as e:
         logger.error(f"Error al añadir números de página: {str(e)}")
@@ -2814,20 +5072,22 @@ def protect_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"protected_{uuid.uuid4()}_{input_filename}")
         
         # Guardar el archivo subido
-        file.save(temp_input_path)
+        save_upload(file, temp_input_path)
         
         logger.info(f"Protegiendo PDF con contraseña")
         
         # Abrir el PDF y aplicar protección
-        doc = fitz.open(temp_input_path)
+        with span('open'):
+            doc = fitz.open(temp_input_path)
         
         # Configurar opciones de encriptación básicas sin especificar permisos
-        doc.save(
-            output_path,
-            encryption=fitz.PDF_ENCRYPT_AES_256,  # Usar AES 256
-            owner_pw=password,  # Contraseña de propietario (acceso completo)
-            user_pw=password    # Contraseña de usuario (acceso restringido)
-        )
+        with span('serialize'):
+            doc.save(
+                output_path,
+                encryption=fitz.PDF_ENCRYPT_AES_256,  # Usar AES 256
+                owner_pw=password,  # Contraseña de propietario (acceso completo)
+                user_pw=password    # Contraseña de usuario (acceso restringido)
+            )
         doc.close()
         
         # Configurar respuesta para descargar el archivo
@@ -2836,15 +5096,10 @@ def protect_pdf():
             # Solo iniciar el hilo de limpieza si la respuesta es exitosa
             if response.status_code == 200:
                 # Eliminar archivos después de un breve retraso para asegurar la descarga
-                delayed_file_cleanup([temp_input_path, output_path])
+                delayed_file_cleanup([temp_input_path])
             return response
         
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name=f"protegido_{input_filename}",
-            mimetype='application/pdf'
-        )
+        return send_artifact(output_path, f"protegido_{input_filename}", 'application/pdf')
         
     except Exception as e:
         logger.error(f"Error al proteger el PDF: {str(e)}")
@@ -2882,11 +5137,12 @@ def unlock_pdf():
         output_path = os.path.join(UPLOAD_FOLDER, f"unlocked_{uuid.uuid4()}_{input_filename}")
         
         # Guardar el archivo subido
-        file.save(temp_input_path)
+        save_upload(file, temp_input_path)
         
         try:
             # Intentar abrir el PDF con la contraseña proporcionada
-            doc = fitz.open(temp_input_path)
+            with span('open'):
+                doc = fitz.open(temp_input_path)
             
             # Verificar si el documento está encriptado
             if doc.is_encrypted:
@@ -2908,11 +5164,13 @@ def unlock_pdf():
                     new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
                 
                 # Guardar el nuevo documento sin encriptación
-                new_doc.save(output_path)
+                with span('serialize'):
+                    new_doc.save(output_path)
                 new_doc.close()
             else:
                 # Si el PDF no está encriptado, simplemente copiarlo
-                doc.save(output_path)
+                with span('serialize'):
+                    doc.save(output_path)
                 
             doc.close()
             
@@ -2922,15 +5180,10 @@ def unlock_pdf():
                 # Solo iniciar el hilo de limpieza si la respuesta es exitosa
                 if response.status_code == 200:
                     # Eliminar archivos después de un breve retraso para asegurar la descarga
-                    delayed_file_cleanup([temp_input_path, output_path])
+                    delayed_file_cleanup([temp_input_path])
                 return response
             
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=f"desbloqueado_{input_filename}",
-                mimetype='application/pdf'
-            )
+            return send_artifact(output_path, f"desbloqueado_{input_filename}", 'application/pdf')
             
         except fitz.FileDataError:
             return jsonify({'error': 'El archivo PDF está dañado o no es válido'}), 400
@@ -2941,6 +5194,1340 @@ def unlock_pdf():
         logger.error(f"Error al desbloquear el PDF: {str(e)}")
         return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 500
 
+# Progreso de operaciones largas: el cliente envía un job_id (UUID) con la solicitud y
+# consulta GET /progress/<job_id> mientras espera. Se guarda en disco para que cualquier
+# worker pueda responder.
+PROGRESS_FOLDER = os.path.join(UPLOAD_FOLDER, 'progress')
+PROGRESS_TTL_MINUTES = 60
+os.makedirs(PROGRESS_FOLDER, exist_ok=True)
+
+def progress_path(job_id):
+    try:
+        return os.path.join(PROGRESS_FOLDER, uuid.UUID(job_id).hex + '.json')
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def report_progress(job_id, stage, completed=0, total=0, **extra):
+    """Guarda el avance de una operación (sin efecto si la solicitud no trae job_id)"""
+    path = progress_path(job_id)
+    if not path:
+        return
+    progress = {'stage': stage, 'completed': completed, 'total': total,
+                'updated': datetime.now().isoformat(), **extra}
+    try:
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(progress, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f"No se pudo guardar el progreso de {job_id}: {e}")
+
+def cleanup_progress():
+    """Elimina los registros de progreso antiguos"""
+    cutoff = time.time() - PROGRESS_TTL_MINUTES * 60
+    for filename in os.listdir(PROGRESS_FOLDER):
+        path = os.path.join(PROGRESS_FOLDER, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except Exception:
+            pass
+
+@app.route('/progress/<job_id>', methods=['GET'])
+def get_progress(job_id):
+    """Avance de una operación iniciada con job_id"""
+    path = progress_path(job_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return jsonify(json.load(f))
+    except (OSError, ValueError, TypeError):
+        raise NotFound('No hay progreso registrado para esta operación')
+
+# LM Studio: un cliente por proceso reutiliza las conexiones (keep-alive), reintenta los
+# fallos de conexión y limita las llamadas simultáneas al modelo local. Las llamadas que
+# esperan turno se atienden por turno rotatorio entre solicitudes, para que un resumen con
+# muchas secciones no deje esperando a las preguntas del chat.
+LM_STUDIO_URL = os.environ.get('EVARIS_LM_STUDIO_URL', 'http://127.0.0.1:1234').rstrip('/')
+LM_STUDIO_CONNECT_TIMEOUT = float(os.environ.get('EVARIS_LM_STUDIO_CONNECT_TIMEOUT', '5'))
+# Segundos máximos sin recibir datos: la respuesta completa sin streaming o el siguiente fragmento con él
+LM_STUDIO_READ_TIMEOUT = float(os.environ.get('EVARIS_LM_STUDIO_READ_TIMEOUT', '300'))
+LM_STUDIO_RETRIES = int(os.environ.get('EVARIS_LM_STUDIO_RETRIES', '2'))
+# Respuestas que indican que LM Studio está ocupado o cargando el modelo
+LM_STUDIO_RETRY_STATUS = (502, 503, 504)
+LLM_MAX_IN_FLIGHT = int(os.environ.get('EVARIS_LLM_MAX_IN_FLIGHT', '2'))
+# Modelo de chat (vacío: el que esté cargado en LM Studio). Forma parte de la clave de la caché.
+LM_STUDIO_MODEL = os.environ.get('EVARIS_LM_STUDIO_MODEL', '')
+# Segundos durante los que se reutiliza el modelo cargado consultado a LM Studio
+LM_STUDIO_MODEL_TTL = 30
+
+class LMStudioError(Exception):
+    """Respuesta de error de LM Studio"""
+
+class FairSlots:
+    """
+    Semáforo cuyos turnos se reparten por turno rotatorio entre propietarios (una solicitud,
+    un resumen): cada propietario espera en su propia cola FIFO y, al liberarse un turno,
+    pasa al final de la rotación.
+    """
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.condition = threading.Condition()
+        self.in_use = 0
+        self.waiting = collections.OrderedDict()  # propietario -> deque de turnos
+    
+    def next_ticket(self):
+        return next(iter(self.waiting.values()))[0] if self.waiting else None
+    
+    def acquire(self, owner):
+        """Espera un turno; devuelve los segundos de espera"""
+        start = time.perf_counter()
+        with self.condition:
+            if self.waiting or self.in_use >= self.capacity:
+                ticket = object()
+                self.waiting.setdefault(owner, collections.deque()).append(ticket)
+                metrics.add('evaris_llm_queued', (), 1)
+                try:
+                    while self.next_ticket() is not ticket or self.in_use >= self.capacity:
+                        self.condition.wait()
+                finally:
+                    tickets = self.waiting[owner]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self.waiting[owner]
+                    else:
+                        self.waiting.move_to_end(owner)
+                    metrics.add('evaris_llm_queued', (), -1)
+                    self.condition.notify_all()
+            self.in_use += 1
+        return time.perf_counter() - start
+    
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify_all()
+    
+    def snapshot(self):
+        with self.condition:
+            return {
+                'capacity': self.capacity,
+                'in_use': self.in_use,
+                'queued': sum(len(tickets) for tickets in self.waiting.values()),
+                'owners_waiting': len(self.waiting),
+            }
+
+class LMStudioClient:
+    """
+    Cliente HTTP de LM Studio compartido por los hilos de un proceso. La sesión de requests
+    (y su pool de conexiones) se crea en cada proceso, porque las conexiones abiertas no se
+    pueden compartir tras el fork de Gunicorn.
+    """
+    
+    def __init__(self, base_url, max_in_flight):
+        self.base_url = base_url
+        self.slots = FairSlots(max_in_flight)
+        self.lock = threading.Lock()
+        self.session = None
+        self.pid = None
+        self.model = None
+        self.model_checked = 0
+    
+    def get_session(self):
+        with self.lock:
+            if self.session is None or self.pid != os.getpid():
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                # Una conexión por llamada simultánea más margen para los embeddings
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.slots.capacity + 4)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session, self.pid = session, os.getpid()
+        return self.session
+    
+    @contextmanager
+    def slot(self, owner=None):
+        """Turno para llamar al modelo; owner agrupa las llamadas de una misma solicitud"""
+        waited = self.slots.acquire(owner if owner is not None else threading.get_ident())
+        metrics.observe('evaris_llm_queue_wait_seconds', (), waited)
+        metrics.add('evaris_llm_in_flight', (), 1)
+        record_span('llm_queue', waited)
+        try:
+            yield
+        finally:
+            self.slots.release()
+            metrics.add('evaris_llm_in_flight', (), -1)
+    
+    def post(self, path, payload, stream=False):
+        """
+        POST a LM Studio con reintentos (con espera exponencial) si no se puede conectar o
+        responde 502/503/504. Devuelve la respuesta 200 o lanza LMStudioError.
+        """
+        url = self.base_url + path
+        session = self.get_session()
+        error = None
+        for attempt in range(LM_STUDIO_RETRIES + 1):
+            if attempt:
+                metrics.inc('evaris_llm_retries_total', ())
+                time.sleep(min(8, 0.5 * 2 ** (attempt - 1)))
+            try:
+                response = session.post(
+                    url, json=payload, stream=stream,
+                    timeout=(LM_STUDIO_CONNECT_TIMEOUT, LM_STUDIO_READ_TIMEOUT)
+                )
+            except requests.exceptions.ConnectionError as e:
+                error = f'No se pudo conectar con LM Studio en {self.base_url}: {e}'
+                continue
+            except requests.exceptions.Timeout:
+                # El modelo recibió la petición: repetirla solo duplicaría el trabajo
+                raise LMStudioError(f'LM Studio no respondió en {LM_STUDIO_READ_TIMEOUT:.0f} s')
+            if response.status_code == 200:
+                return response
+            error = response.text
+            response.close()
+            if response.status_code not in LM_STUDIO_RETRY_STATUS:
+                break
+        raise LMStudioError(error)
+    
+    def record_generation(self, endpoint, usage, generation_seconds, completion_tokens=None):
+        """Tokens procesados y tiempo de generación (para calcular tokens/s en /metrics)"""
+        usage = usage or {}
+        prompt_tokens = usage.get('prompt_tokens')
+        completion_tokens = usage.get('completion_tokens', completion_tokens)
+        if prompt_tokens:
+            metrics.inc('evaris_llm_tokens_total', (('endpoint', endpoint), ('kind', 'prompt')), prompt_tokens)
+        if completion_tokens:
+            metrics.inc('evaris_llm_tokens_total', (('endpoint', endpoint), ('kind', 'completion')), completion_tokens)
+            metrics.inc('evaris_llm_generation_seconds_total', (('endpoint', endpoint),), generation_seconds)
+    
+    def chat(self, messages, max_tokens=1000, temperature=0.2, owner=None):
+        """Envía una conversación a LM Studio y devuelve el texto de la respuesta"""
+        payload = {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": False
+        }
+        if LM_STUDIO_MODEL:
+            payload["model"] = LM_STUDIO_MODEL
+        with self.slot(owner):
+            with track_tool('lm_studio'):
+                response = self.post('/v1/chat/completions', payload)
+                data = response.json()
+                # elapsed: desde el envío del último intento hasta recibir la respuesta
+                self.record_generation('chat', data.get('usage'), response.elapsed.total_seconds())
+        self.observe_model(data.get('model'))
+        return data['choices'][0]['message']['content']
+    
+    def embeddings(self, model, texts):
+        """Embeddings (sin normalizar) de LM Studio para cada texto, en el mismo orden"""
+        with self.slot():
+            with track_tool('lm_studio'):
+                response = self.post('/v1/embeddings', {'model': model, 'input': texts})
+                data = response.json()
+                # elapsed: desde el envío del último intento hasta recibir la respuesta
+                self.record_generation('embeddings', data.get('usage'), response.elapsed.total_seconds())
+        return [item['embedding'] for item in sorted(data['data'], key=lambda item: item['index'])]
+    
+    def loaded_model(self):
+        """
+        Modelo cargado en LM Studio: el primero en estado loaded de su API nativa o, en
+        versiones sin ella, el primero de /v1/models. None si no se puede consultar.
+        """
+        session = self.get_session()
+        for path in ('/api/v0/models', '/v1/models'):
+            try:
+                response = session.get(
+                    self.base_url + path, timeout=(LM_STUDIO_CONNECT_TIMEOUT, LM_STUDIO_CONNECT_TIMEOUT)
+                )
+                if response.status_code != 200:
+                    continue
+                entries = response.json().get('data') or []
+            except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+                logger.debug(f"No se pudo consultar {path} en LM Studio: {str(e)}")
+                continue
+            if path == '/api/v0/models':
+                entries = [entry for entry in entries if entry.get('state') == 'loaded' and entry.get('type') != 'embeddings']
+            if entries and entries[0].get('id'):
+                return entries[0]['id']
+        return None
+    
+    def model_id(self):
+        """
+        Modelo que responde las llamadas, para la clave de la caché: EVARIS_LM_STUDIO_MODEL
+        o, si está vacío, el cargado en LM Studio (consultado como mucho cada
+        LM_STUDIO_MODEL_TTL segundos y corregido con el campo model de cada respuesta). Si
+        LM Studio no responde se usa el último conocido.
+        """
+        if LM_STUDIO_MODEL:
+            return LM_STUDIO_MODEL
+        with self.lock:
+            if time.monotonic() - self.model_checked < LM_STUDIO_MODEL_TTL:
+                return self.model or ''
+            self.model_checked = time.monotonic()
+        model = self.loaded_model()
+        with self.lock:
+            if model:
+                self.model = model
+            return self.model or ''
+    
+    def observe_model(self, model):
+        """Modelo indicado en una respuesta de LM Studio"""
+        if model and not LM_STUDIO_MODEL:
+            with self.lock:
+                self.model = model
+    
+    def snapshot(self):
+        return {'url': self.base_url, 'worker_pid': os.getpid(), 'model': self.model, **self.slots.snapshot()}
+
+lm_studio = LMStudioClient(LM_STUDIO_URL, LLM_MAX_IN_FLIGHT)
+
+def lm_studio_chat(messages, max_tokens=1000, temperature=0.2, owner=None):
+    """Envía una conversación a LM Studio y devuelve el texto de la respuesta"""
+    return lm_studio.chat(messages, max_tokens, temperature, owner)
+
+# Caché de respuestas de LM Studio en SQLite, compartida entre workers: resúmenes parciales
+# por hash de su texto y respuestas del chat por documento y pregunta normalizada. Cuando
+# las respuestas guardadas superan LLM_CACHE_MAX_MB se eliminan las usadas hace más tiempo.
+LLM_CACHE_PATH = os.path.join(CACHE_FOLDER, 'llm_responses.sqlite3')
+LLM_CACHE_MAX_MB = float(os.environ.get('EVARIS_LLM_CACHE_MB', '100'))
+# Similitud mínima (0-1) para reutilizar la respuesta a una pregunta parecida sobre el mismo
+# documento; 0 solo reutiliza las preguntas iguales (sin contar mayúsculas, tildes ni signos)
+LLM_CACHE_SIMILARITY = float(os.environ.get('EVARIS_LLM_CACHE_SIMILARITY', '0'))
+# Preguntas anteriores del mismo documento que se comparan con la nueva
+LLM_CACHE_CANDIDATES = 200
+# Cada worker comprueba el tamaño total de la caché una vez cada tantas escrituras
+LLM_CACHE_EVICT_EVERY = 50
+# Palabras que cambian el sentido de una pregunta aunque sean palabras vacías
+NEGATION_WORDS = frozenset(('no', 'ni', 'sin', 'nunca', 'not'))
+
+LLM_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    document TEXT NOT NULL,
+    model TEXT NOT NULL,
+    temperature REAL NOT NULL,
+    prompt TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_document ON responses (document, kind);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+def normalize_prompt(text):
+    """Texto en minúsculas, sin tildes ni signos y con los espacios simplificados"""
+    import unicodedata
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'\w+', text))
+
+def prompt_terms(prompt):
+    """Palabras significativas de un prompt normalizado, conservando las negaciones"""
+    return set(tokenize(prompt)) | (NEGATION_WORDS & set(prompt.split()))
+
+def text_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class LLMCache:
+    """
+    Respuestas de LM Studio por (tipo, hash del documento, prompt normalizado, modelo,
+    temperatura). Cada hilo abre su propia conexión (también tras el fork de Gunicorn);
+    con el modo WAL los workers pueden leer mientras otro escribe. Los errores de la
+    caché se registran y se tratan como un fallo de caché.
+    """
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.writes = 0
+        self.writes_lock = threading.Lock()
+    
+    def connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # auto_vacuum solo tiene efecto al crear la base de datos
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.executescript(LLM_CACHE_SCHEMA)
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+    
+    @staticmethod
+    def key(kind, document, prompt, model, temperature):
+        return text_digest(f"{kind}\0{document}\0{prompt}\0{model}\0{temperature}")
+    
+    def get(self, kind, document, prompt, temperature, similarity=0):
+        """
+        Respuesta guardada para el mismo prompt o, con similarity > 0, para el prompt más
+        parecido del mismo documento (Jaccard de sus palabras significativas); None si no hay.
+        """
+        result = 'miss'
+        try:
+            connection = self.connection()
+            model = lm_studio.model_id()
+            key = self.key(kind, document, prompt, model, temperature)
+            row = connection.execute('SELECT key, response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row:
+                result = 'hit'
+            elif similarity > 0:
+                terms = prompt_terms(prompt)
+                best = 0
+                for candidate in connection.execute(
+                    'SELECT key, response, prompt FROM responses WHERE document = ? AND kind = ? AND model = ? '
+                    'AND temperature = ? ORDER BY last_used DESC LIMIT ?',
+                    (document, kind, model, temperature, LLM_CACHE_CANDIDATES)
+                ):
+                    candidate_terms = prompt_terms(candidate[2])
+                    union = terms | candidate_terms
+                    score = len(terms & candidate_terms) / len(union) if union else 0
+                    if score >= similarity and score > best:
+                        best, row = score, candidate
+                if row:
+                    result = 'similar'
+            if row:
+                connection.execute(
+                    'UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?', (time.time(), row[0])
+                )
+        except Exception as e:
+            logger.warning(f"Error al leer la caché de respuestas: {e}")
+            row = None
+        metrics.inc('evaris_llm_cache_requests_total', (('kind', kind), ('result', result)))
+        return row[1] if row else None
+    
+    def put(self, kind, document, prompt, temperature, response):
+        try:
+            connection = self.connection()
+            model = lm_studio.model_id()
+            now = time.time()
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, kind, document, model, temperature, prompt, response, '
+                'size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.key(kind, document, prompt, model, temperature), kind, document, model,
+                 temperature, prompt, response, len(prompt) + len(response.encode('utf-8')), now, now)
+            )
+            # Sumar el tamaño recorre toda la tabla: no se hace en cada escritura
+            with self.writes_lock:
+                check = self.writes % LLM_CACHE_EVICT_EVERY == 0
+                self.writes += 1
+            if check:
+                self.evict(connection)
+        except Exception as e:
+            logger.warning(f"Error al guardar en la caché de respuestas: {e}")
+    
+    def evict(self, connection):
+        """Elimina las respuestas usadas hace más tiempo hasta quedar en el 90 % del límite"""
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes * 0.9
+        keys = []
+        for key, size in connection.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+        connection.execute('PRAGMA incremental_vacuum')
+        metrics.inc('evaris_llm_cache_evictions_total', (), len(keys))
+    
+    def snapshot(self):
+        try:
+            entries, size = self.connection().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+        except Exception:
+            return None
+        return {'entries': entries, 'size_mb': round(size / (1024 * 1024), 2), 'max_mb': LLM_CACHE_MAX_MB}
+
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_MB * 1024 * 1024)
+
+# Respuestas en streaming (Server-Sent Events). Mientras el modelo no genera texto se
+# envía un comentario cada SSE_KEEPALIVE_SECONDS: así se detecta que el cliente se ha ido
+# y se corta la generación en LM Studio.
+SSE_KEEPALIVE_SECONDS = 5
+
+def clean_markdown_format(text):
+    """Elimina los asteriscos dobles (negrita) pero mantiene el texto"""
+    return text.replace("**", "")
+
+class MarkdownCleaner:
+    """
+    clean_markdown_format aplicado a un texto que llega por partes: un asterisco al final
+    de una parte se retiene hasta saber si forma "**" con el siguiente.
+    """
+    
+    def __init__(self):
+        self.pending = ''
+    
+    def feed(self, text):
+        text = self.pending + text
+        trailing = len(text) - len(text.rstrip('*'))
+        # "**" se elimina de izquierda a derecha: solo un número impar deja un "*" suelto
+        if trailing % 2:
+            text, self.pending = text[:-1], '*'
+        else:
+            self.pending = ''
+        return clean_markdown_format(text)
+    
+    def flush(self):
+        text, self.pending = self.pending, ''
+        return text
+
+def sse_event(data, event=None):
+    """Evento de Server-Sent Events con datos JSON"""
+    prefix = f"event: {event}\n" if event else ''
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events):
+    """Respuesta text/event-stream sin búfer intermedio (proxies incluidos)"""
+    from flask import Response, stream_with_context
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def wants_stream(value):
+    return str(value).lower() in ('1', 'true', 'yes') or 'text/event-stream' in request.headers.get('Accept', '')
+
+def abort_upstream(response):
+    """Cierra la conexión con LM Studio aunque otro hilo esté bloqueado leyendo de ella"""
+    import socket
+    connection = getattr(response.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            logger.debug(f"No se pudo cerrar el socket de LM Studio: {str(e)}")
+    else:
+        logger.debug("La respuesta de LM Studio no expone su socket; solo se cierra la respuesta")
+    response.close()
+
+def lm_studio_stream(messages, max_tokens=1000, temperature=0.2, owner=None):
+    """
+    Generador con los fragmentos de texto de una respuesta de LM Studio en streaming.
+    Produce None cuando no llega nada en SSE_KEEPALIVE_SECONDS. Si se cierra antes de
+    terminar (el cliente se desconectó), se corta la conexión con LM Studio.
+    """
+    import queue
+    payload = {
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": True
+    }
+    if LM_STUDIO_MODEL:
+        payload["model"] = LM_STUDIO_MODEL
+    finished = object()
+    received = queue.Queue()
+    usage = {}
+    
+    with lm_studio.slot(owner):
+        with track_tool('lm_studio') as call:
+            start = time.perf_counter()
+            response = lm_studio.post('/v1/chat/completions', payload, stream=True)
+            
+            def read_events():
+                try:
+                    for line in response.iter_lines():
+                        if not line.startswith(b'data:'):
+                            continue
+                        data = line[5:].strip()
+                        if data == b'[DONE]':
+                            # Leer hasta el final para devolver la conexión al pool
+                            continue
+                        event = json.loads(data)
+                        lm_studio.observe_model(event.get('model'))
+                        # Algunas versiones envían el recuento de tokens en el último evento
+                        usage.update(event.get('usage') or {})
+                        choices = event.get('choices') or [{}]
+                        delta = choices[0].get('delta', {}).get('content')
+                        if delta:
+                            received.put(delta)
+                    received.put(finished)
+                except Exception as e:
+                    received.put(e)
+            
+            threading.Thread(target=read_events, daemon=True).start()
+            first_token = None
+            chunks = 0
+            completed = False
+            try:
+                while True:
+                    try:
+                        item = received.get(timeout=SSE_KEEPALIVE_SECONDS)
+                    except queue.Empty:
+                        yield None
+                        continue
+                    if item is finished:
+                        completed = True
+                        break
+                    if isinstance(item, Exception):
+                        call['outcome'] = 'error'
+                        raise LMStudioError(str(item))
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        metrics.observe('evaris_llm_time_to_first_token_seconds', (), first_token - start)
+                    chunks += 1
+                    yield item
+            finally:
+                if completed:
+                    response.close()
+                else:
+                    abort_upstream(response)
+                if first_token is not None:
+                    # Sin recuento del servidor, cada fragmento es aproximadamente un token
+                    lm_studio.record_generation('chat', usage, time.perf_counter() - first_token, chunks)
+
+# Texto de los PDF por páginas, guardado por hash del archivo para no volver a extraerlo
+# al subir el mismo documento (resumen, chat y futuras búsquedas). Los documentos largos
+# se extraen en paralelo en procesos aparte, cada uno con su propio documento de PyMuPDF.
+TEXT_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'text')
+TEXT_CACHE_DAYS = int(os.environ.get('EVARIS_TEXT_CACHE_DAYS', '7'))
+TEXT_WORKERS = int(os.environ.get('EVARIS_TEXT_WORKERS', str(os.cpu_count() or 1)))
+# Por debajo de este número de páginas no compensa repartir la extracción
+TEXT_PARALLEL_MIN_PAGES = 64
+os.makedirs(TEXT_CACHE_FOLDER, exist_ok=True)
+_text_pool = None
+_text_pool_pid = None
+_text_pool_lock = threading.Lock()
+
+def text_pool():
+    """
+    Procesos de extracción de texto del worker actual. Se crean con forkserver (spawn en
+    Windows) para no heredar el estado de los hilos del worker.
+    """
+    global _text_pool, _text_pool_pid
+    with _text_pool_lock:
+        if _text_pool is None or _text_pool_pid != os.getpid():
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _text_pool = ProcessPoolExecutor(max_workers=TEXT_WORKERS, mp_context=multiprocessing.get_context(method))
+            _text_pool_pid = os.getpid()
+    return _text_pool
+
+def extract_text_range(path, start, stop):
+    """Texto de las páginas [start, stop) de un PDF (se ejecuta en los procesos de extracción)"""
+    with fitz.open(path) as document:
+        return [document[number].get_text() for number in range(start, stop)]
+
+def extract_pdf_pages(path):
+    """Texto de cada página de un PDF; en paralelo si es largo y hay varios procesos"""
+    global _text_pool
+    with span('open'):
+        document = fitz.open(path)
+    with document:
+        page_count = len(document)
+        if TEXT_WORKERS < 2 or page_count < TEXT_PARALLEL_MIN_PAGES:
+            with span('extract_text'):
+                return [page.get_text() for page in document]
+    
+    from concurrent.futures.process import BrokenProcessPool
+    # Varios rangos por proceso para que las páginas pesadas no dejen procesos ociosos
+    step = math.ceil(page_count / (TEXT_WORKERS * 4))
+    with span('extract_text'):
+        try:
+            futures = [
+                text_pool().submit(extract_text_range, path, start, min(start + step, page_count))
+                for start in range(0, page_count, step)
+            ]
+            pages = []
+            for future in futures:
+                pages.extend(future.result())
+            return pages
+        except BrokenProcessPool:
+            # Un proceso terminó de forma inesperada: recrear el pool la próxima vez
+            logger.warning("El pool de extracción de texto se ha roto; se extrae en este proceso")
+            with _text_pool_lock:
+                _text_pool = None
+            return extract_text_range(path, 0, page_count)
+
+def text_cache_path(sha256):
+    return os.path.join(TEXT_CACHE_FOLDER, f"{sha256}.json")
+
+def get_pdf_pages(path, sha256=None):
+    """Texto de cada página de un PDF, desde la caché si ya se extrajo antes"""
+    if sha256:
+        cache_path = text_cache_path(sha256)
+        try:
+            with span('text_cache'):
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    pages = json.load(f)['pages']
+            os.utime(cache_path)
+            return pages
+        except (OSError, ValueError, KeyError):
+            pass
+    
+    pages = extract_pdf_pages(path)
+    if sha256:
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'pages': pages}, f, ensure_ascii=False)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar el texto extraído en la caché: {e}")
+    return pages
+
+def cleanup_text_cache():
+    """Elimina el texto extraído de los documentos que no se han usado en TEXT_CACHE_DAYS días"""
+    cutoff = time.time() - TEXT_CACHE_DAYS * 86400
+    for filename in os.listdir(TEXT_CACHE_FOLDER):
+        path = os.path.join(TEXT_CACHE_FOLDER, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except Exception:
+            pass
+
+# Sesiones de documentos: /summarize-document guarda en el servidor el texto extraído y
+# sus fragmentos, y devuelve un session_id que /document-chat recibe en lugar de reenviar
+# el documento completo en cada pregunta. Se guardan en disco (compartidas entre workers)
+# y cada uso renueva su tiempo de vida.
+DOCUMENT_SESSION_FOLDER = os.path.join(UPLOAD_FOLDER, 'sessions')
+DOCUMENT_SESSION_TTL_MINUTES = int(os.environ.get('EVARIS_SESSION_TTL_MINUTES', '120'))
+# Tamaño aproximado de los fragmentos del documento y solapamiento entre ellos (caracteres)
+DOCUMENT_CHUNK_CHARS = 2000
+DOCUMENT_CHUNK_OVERLAP = 200
+# Contexto máximo (en caracteres, unos 3000 tokens) que se envía al modelo en el chat
+CHAT_CONTEXT_CHARS = 12000
+CHAT_TEMPERATURE = 0.3
+os.makedirs(DOCUMENT_SESSION_FOLDER, exist_ok=True)
+
+def document_session_paths(session_id):
+    """Rutas de metadatos y texto de una sesión de documento (None si el id no es válido)"""
+    try:
+        session_id = uuid.UUID(session_id).hex
+    except (ValueError, TypeError, AttributeError):
+        return None
+    base = os.path.join(DOCUMENT_SESSION_FOLDER, session_id)
+    return {
+        'meta': base + '.json',
+        'text': base + '.txt',
+        'index': base + '.index.json',
+        'vectors': base + '.vectors',
+    }
+
+def split_into_chunks(pages, paged=True, overlap=DOCUMENT_CHUNK_OVERLAP):
+    """
+    Divide el texto en fragmentos de unos DOCUMENT_CHUNK_CHARS caracteres que no cruzan
+    páginas, cortando preferentemente en párrafos, líneas o frases, con solapamiento.
+    Cada fragmento guarda su página (si el documento tiene páginas) y sus posiciones
+    en el texto completo.
+    """
+    chunks = []
+    offset = 0
+    for page_number, text in enumerate(pages, 1):
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + DOCUMENT_CHUNK_CHARS)
+            # Un resto corto se une al fragmento actual en lugar de formar uno propio
+            if len(text) - end < DOCUMENT_CHUNK_CHARS // 4:
+                end = len(text)
+            if end < len(text):
+                for separator in ('\n\n', '\n', '. ', ' '):
+                    cut = text.rfind(separator, start + DOCUMENT_CHUNK_CHARS // 2, end)
+                    if cut != -1:
+                        end = cut + len(separator)
+                        break
+            if text[start:end].strip():
+                chunks.append({
+                    'page': page_number if paged else None,
+                    'start': offset + start,
+                    'end': offset + end,
+                })
+            if end >= len(text):
+                break
+            start = max(end - overlap, start + 1)
+        offset += len(text)
+    return chunks
+
+def create_document_session(filename, pages, paged=True):
+    """Guarda el texto de un documento y sus fragmentos; devuelve (session_id, metadatos)"""
+    session_id = uuid.uuid4().hex
+    paths = document_session_paths(session_id)
+    # Sin traducir saltos de línea: los fragmentos guardan posiciones en el texto original
+    with open(paths['text'], 'w', encoding='utf-8', newline='') as f:
+        f.write(''.join(pages))
+    meta = {
+        'session_id': session_id,
+        'filename': filename,
+        'created': datetime.now().isoformat(),
+        'characters': sum(len(text) for text in pages),
+        'sha256': text_digest(''.join(pages)),
+        'pages': len(pages) if paged else None,
+        'chunks': split_into_chunks(pages, paged),
+    }
+    save_document_index(paths, meta, ''.join(pages))
+    temp_path = paths['meta'] + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, paths['meta'])
+    return session_id, meta
+
+def document_session_expires():
+    return (datetime.now() + timedelta(minutes=DOCUMENT_SESSION_TTL_MINUTES)).isoformat()
+
+def load_document_session(session_id):
+    """
+    Devuelve (metadatos, texto) de una sesión y renueva su tiempo de vida,
+    o (None, None) si no existe o ha expirado.
+    """
+    paths = document_session_paths(session_id)
+    if not paths:
+        return None, None
+    try:
+        if os.path.getmtime(paths['meta']) < time.time() - DOCUMENT_SESSION_TTL_MINUTES * 60:
+            return None, None
+        with open(paths['meta'], 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(paths['text'], 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
+    except (OSError, ValueError):
+        return None, None
+    os.utime(paths['meta'])
+    return meta, text
+
+def delete_document_session(session_id):
+    paths = document_session_paths(session_id)
+    with _document_indexes_lock:
+        _document_indexes.pop(session_id, None)
+    removed = False
+    for path in (paths or {}).values():
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    return removed
+
+def session_not_found():
+    return jsonify({
+        'error': 'La sesión del documento no existe o ha expirado. Vuelva a procesar el documento.',
+        'code': 'session_expired'
+    }), 404
+
+def cleanup_document_sessions():
+    """Elimina las sesiones de documentos que superaron su tiempo de vida"""
+    cutoff = time.time() - DOCUMENT_SESSION_TTL_MINUTES * 60
+    for filename in os.listdir(DOCUMENT_SESSION_FOLDER):
+        if not filename.endswith('.json') or filename.endswith('.index.json'):
+            continue
+        meta_path = os.path.join(DOCUMENT_SESSION_FOLDER, filename)
+        try:
+            if os.path.getmtime(meta_path) < cutoff:
+                delete_document_session(filename[:-len('.json')])
+        except Exception:
+            pass
+
+def truncate_context(context, max_length=CHAT_CONTEXT_CHARS):
+    """Limita el contexto del chat al inicio (70%) y el final (30%) del documento"""
+    if len(context) <= max_length:
+        return context
+    first_part = context[:int(max_length * 0.7)]
+    last_part = context[-int(max_length * 0.3):]
+    return first_part + "\n...[Contenido omitido por longitud]...\n" + last_part
+
+# Recuperación de fragmentos para el chat: cada sesión tiene un índice invertido BM25
+# de sus fragmentos y, si se configura EVARIS_EMBEDDING_MODEL, los embeddings de LM
+# Studio de cada fragmento. Cada pregunta recibe los fragmentos más relevantes que caben
+# en CHAT_CONTEXT_CHARS, en el orden del documento.
+EMBEDDING_MODEL = os.environ.get('EVARIS_EMBEDDING_MODEL', '')
+EMBEDDING_BATCH = 32
+# Parámetros de BM25 y candidatos que se reordenan con embeddings
+BM25_K1 = 1.5
+BM25_B = 0.75
+RETRIEVAL_CANDIDATES = 50
+# Índices cargados en memoria (por proceso), para no leerlos del disco en cada pregunta
+DOCUMENT_INDEX_CACHE_SIZE = 16
+
+# Palabras vacías que no aportan a la búsqueda
+STOPWORDS = frozenset('''
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun bajo bien cada como con contra cual
+cuales cuando de del desde donde dos el ella ellas ellos en entre era eran es esa esas ese eso esos esta
+estas este esto estos fue fueron ha han hasta hay la las le les lo los mas me mi mientras muy ni no nos o
+otra otras otro otros para pero poco por porque que quien quienes se sea segun ser si sin sino sobre son
+su sus tal tambien tan tanto te tiene tienen todo todos tu un una unas uno unos y ya cual cuanto the of
+and to in is
+'''.split())
+
+def tokenize(text):
+    """Palabras normalizadas: minúsculas, sin tildes, sin palabras vacías y sin plural simple"""
+    import unicodedata
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    tokens = []
+    for token in re.findall(r'\w+', text):
+        if len(token) < 2 or token in STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith('es'):
+            token = token[:-2]
+        elif len(token) > 3 and token.endswith('s'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+class DocumentIndex:
+    """
+    Índice de búsqueda de los fragmentos de un documento: BM25 sobre un índice invertido
+    (término -> [(fragmento, frecuencia)]) y, opcionalmente, embeddings normalizados para
+    reordenar los candidatos por similitud semántica.
+    """
+    
+    def __init__(self, postings, lengths, vectors=None):
+        self.postings = postings
+        self.lengths = lengths
+        self.vectors = vectors
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 0
+        count = len(lengths)
+        self.idf = {
+            term: math.log(1 + (count - len(entries) + 0.5) / (len(entries) + 0.5))
+            for term, entries in postings.items()
+        }
+    
+    @classmethod
+    def build(cls, texts):
+        postings = {}
+        lengths = []
+        for chunk_index, text in enumerate(texts):
+            counts = collections.Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                postings.setdefault(term, []).append((chunk_index, frequency))
+        return cls(postings, lengths)
+    
+    def to_json(self):
+        return {'postings': self.postings, 'lengths': self.lengths}
+    
+    @classmethod
+    def from_json(cls, data, vectors=None):
+        return cls(data['postings'], data['lengths'], vectors)
+    
+    def bm25(self, query):
+        """Puntuación BM25 de los fragmentos que contienen algún término de la pregunta"""
+        scores = {}
+        average = self.average_length or 1
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for chunk_index, frequency in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_index] / average)
+                scores[chunk_index] = scores.get(chunk_index, 0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return scores
+    
+    def search(self, query, query_vector=None, limit=RETRIEVAL_CANDIDATES):
+        """Índices de los fragmentos más relevantes, de mayor a menor relevancia"""
+        scores = self.bm25(query)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+        if query_vector is None or not self.vectors:
+            return ranked
+        
+        # Con embeddings: se reordenan los candidatos de BM25 por fusión de rangos (RRF);
+        # si ningún término coincide, se busca solo por similitud en todos los fragmentos
+        candidates = ranked or range(len(self.vectors))
+        similarity = {index: sum(map(float.__mul__, query_vector, self.vectors[index])) for index in candidates}
+        by_vector = sorted(similarity, key=similarity.get, reverse=True)
+        fused = {index: 1 / (60 + rank) for rank, index in enumerate(by_vector)}
+        for rank, index in enumerate(ranked):
+            fused[index] += 1 / (60 + rank)
+        return sorted(fused, key=fused.get, reverse=True)[:limit]
+
+def normalize_vector(values):
+    norm = math.sqrt(sum(value * value for value in values)) or 1
+    return [value / norm for value in values]
+
+def embed_texts(texts):
+    """Embeddings normalizados de LM Studio para cada texto (None si no están configurados o fallan)"""
+    if not EMBEDDING_MODEL or not texts:
+        return None
+    vectors = []
+    try:
+        for start in range(0, len(texts), EMBEDDING_BATCH):
+            embeddings = lm_studio.embeddings(EMBEDDING_MODEL, texts[start:start + EMBEDDING_BATCH])
+            vectors.extend(normalize_vector(embedding) for embedding in embeddings)
+    except Exception as e:
+        logger.warning(f"No se pudieron obtener los embeddings: {e}")
+        return None
+    return vectors
+
+def chunk_texts(meta, text):
+    return [text[chunk['start']:chunk['end']] for chunk in meta['chunks']]
+
+def save_document_index(paths, meta, text):
+    """Construye y guarda el índice BM25 (y los embeddings, si están configurados) de una sesión"""
+    from array import array
+    texts = chunk_texts(meta, text)
+    with span('index'):
+        index = DocumentIndex.build(texts)
+        with open(paths['index'], 'w', encoding='utf-8') as f:
+            json.dump(index.to_json(), f)
+    vectors = embed_texts(texts)
+    if vectors:
+        with open(paths['vectors'], 'wb') as f:
+            array('f', [value for vector in vectors for value in vector]).tofile(f)
+        meta['embedding_dimensions'] = len(vectors[0])
+
+_document_indexes = collections.OrderedDict()
+_document_indexes_lock = threading.Lock()
+
+def get_document_index(session_id, meta):
+    """Índice de una sesión, desde la caché del proceso o cargado del disco"""
+    from array import array
+    with _document_indexes_lock:
+        index = _document_indexes.get(session_id)
+        if index is not None:
+            _document_indexes.move_to_end(session_id)
+            return index
+    
+    paths = document_session_paths(session_id)
+    try:
+        with open(paths['index'], 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    vectors = None
+    dimensions = meta.get('embedding_dimensions')
+    if dimensions and os.path.exists(paths['vectors']):
+        values = array('f')
+        with open(paths['vectors'], 'rb') as f:
+            values.frombytes(f.read())
+        vectors = [values[start:start + dimensions].tolist() for start in range(0, len(values), dimensions)]
+    index = DocumentIndex.from_json(data, vectors)
+    
+    with _document_indexes_lock:
+        _document_indexes[session_id] = index
+        while len(_document_indexes) > DOCUMENT_INDEX_CACHE_SIZE:
+            _document_indexes.popitem(last=False)
+    return index
+
+def select_context(question, meta, text, index, max_length=CHAT_CONTEXT_CHARS):
+    """
+    Contexto del chat con los fragmentos más relevantes para la pregunta que caben en
+    max_length, en el orden del documento e identificados por página. Sin fragmentos
+    relevantes (p. ej. "¿de qué trata?") se usa el inicio y el final del documento.
+    """
+    if len(text) <= max_length:
+        return text
+    
+    query_vector = None
+    if index.vectors:
+        vectors = embed_texts([question])
+        query_vector = vectors[0] if vectors else None
+    
+    with span('retrieve'):
+        ranked = index.search(question, query_vector)
+    if not ranked:
+        return truncate_context(text, max_length)
+    
+    selected = []
+    used = 0
+    for chunk_index in ranked:
+        chunk = meta['chunks'][chunk_index]
+        size = chunk['end'] - chunk['start']
+        if used + size > max_length:
+            continue
+        selected.append(chunk_index)
+        used += size
+    
+    parts = []
+    for chunk_index in sorted(selected):
+        chunk = meta['chunks'][chunk_index]
+        label = f"[Página {chunk['page']}]\n" if chunk['page'] else ''
+        parts.append(label + text[chunk['start']:chunk['end']].strip())
+    return "\n...\n".join(parts)
+
+@app.route('/document-sessions/<session_id>', methods=['GET'])
+def document_session_status(session_id):
+    """Datos de una sesión de documento (sin el texto) y su nueva fecha de expiración"""
+    meta, text = load_document_session(session_id)
+    if meta is None:
+        return session_not_found()
+    return jsonify({
+        'session_id': meta['session_id'],
+        'filename': meta['filename'],
+        'created': meta['created'],
+        'expires': document_session_expires(),
+        'characters': meta['characters'],
+        'pages': meta['pages'],
+        'chunks': len(meta['chunks']),
+        'embeddings': bool(meta.get('embedding_dimensions')),
+    })
+
+@app.route('/document-sessions/<session_id>', methods=['DELETE'])
+def close_document_session(session_id):
+    """Elimina una sesión de documento antes de que expire"""
+    if not delete_document_session(session_id):
+        return session_not_found()
+    return jsonify({'deleted': True})
+
+# Resumen jerárquico (map-reduce) de documentos largos: el texto se divide en secciones
+# que caben en el contexto del modelo, cada sección se resume en paralelo (con como mucho
+# LLM_MAX_IN_FLIGHT llamadas a la vez por proceso) y los resúmenes parciales se combinan
+# en una o varias rondas. Los resúmenes parciales se guardan en la caché de respuestas por
+# hash de su texto y los cortes entre secciones dependen del contenido (ver pack_sections),
+# así que volver a resumir un documento editado solo repite las secciones que cambiaron.
+SUMMARY_CHUNK_CHARS = int(os.environ.get('EVARIS_SUMMARY_CHUNK_CHARS', '8000'))
+SUMMARY_TEMPERATURE = 0.2
+# Cambiar al modificar los prompts para no reutilizar resúmenes antiguos
+SUMMARY_PROMPT_VERSION = '2'
+
+SUMMARY_SYSTEM_PROMPT = "Eres un asistente especializado en crear resúmenes concisos y precisos de documentos."
+
+SUMMARY_PROMPTS = {
+    'final': """
+            Por favor, genera un resumen conciso del siguiente documento.
+            Identifica los puntos principales, las ideas clave y la información más relevante.
+            El resumen debe ser claro y mantener la estructura lógica original.
+            
+            DOCUMENTO:
+            {text}
+            """,
+    'map': """
+            Resume la siguiente sección de un documento más largo.
+            Conserva los datos concretos: cifras, fechas, nombres, definiciones y conclusiones.
+            No añadas introducciones ni información que no esté en la sección.
+            
+            SECCIÓN:
+            {text}
+            """,
+    'reduce': """
+            Los siguientes son resúmenes parciales y consecutivos de un mismo documento.
+            Genera un resumen conciso del documento completo a partir de ellos.
+            Identifica los puntos principales, las ideas clave y la información más relevante.
+            El resumen debe ser claro y mantener la estructura lógica original.
+            
+            RESÚMENES PARCIALES:
+            {text}
+            """,
+}
+
+def pack_sections(texts, max_chars=SUMMARY_CHUNK_CHARS):
+    """
+    Agrupa textos consecutivos en secciones de como mucho max_chars caracteres. Los cortes
+    dependen del contenido: a partir de la mitad de max_chars, una sección termina tras un
+    texto cuyo hash es par. Editar un texto solo cambia su sección y, como mucho, alguna de
+    las siguientes hasta que los cortes vuelven a coincidir; al agrupar por tamaño, cambiar
+    la longitud de un texto desplazaría todos los cortes posteriores.
+    """
+    sections = []
+    current = []
+    size = 0
+    for text in texts:
+        if current and size + len(text) > max_chars:
+            sections.append(''.join(current))
+            current, size = [], 0
+        current.append(text)
+        size += len(text)
+        if size >= max_chars // 2 and int(text_digest(text)[-1], 16) % 2 == 0:
+            sections.append(''.join(current))
+            current, size = [], 0
+    if current:
+        sections.append(''.join(current))
+    return sections
+
+def read_summary_cache(kind, text):
+    return llm_cache.get('summary_' + kind, text_digest(text), SUMMARY_PROMPT_VERSION, SUMMARY_TEMPERATURE)
+
+def write_summary_cache(kind, text, summary):
+    llm_cache.put('summary_' + kind, text_digest(text), SUMMARY_PROMPT_VERSION, SUMMARY_TEMPERATURE, summary)
+
+def summary_messages(kind, text):
+    # El prompt solo depende del texto: la misma sección se reutiliza desde la caché
+    # aunque cambie su posición en el documento
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": SUMMARY_PROMPTS[kind].format(text=text)}
+    ]
+
+def summarize_text(kind, text, cached=None, owner=None):
+    """
+    Resume un texto con el prompt indicado ('map', 'reduce' o 'final'), usando la caché
+    de resúmenes. cached es un contador de las respuestas obtenidas de la caché; owner
+    agrupa las llamadas del mismo documento en la cola de LM Studio.
+    """
+    summary = read_summary_cache(kind, text)
+    if summary is not None:
+        if cached is not None:
+            cached.append(kind)
+        return summary
+    summary = lm_studio_chat(summary_messages(kind, text), max_tokens=1000, temperature=SUMMARY_TEMPERATURE, owner=owner)
+    write_summary_cache(kind, text, summary)
+    return summary
+
+def prepare_summary(pages, paged=True, job_id=None, cached=None, on_progress=None, cancelled=None):
+    """
+    Fases previas a la última llamada del resumen. Devuelve (tipo, texto, estadísticas) de
+    esa llamada: el documento con el prompt 'final' si cabe en una sección, o los resúmenes
+    parciales (map y, si hace falta, rondas de reduce intermedias) con el prompt 'reduce'.
+    on_progress recibe el mismo avance que report_progress; con cancelled activado no se
+    empiezan más secciones.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def notify(stage, completed, total, **extra):
+        report_progress(job_id, stage, completed, total, **extra)
+        if on_progress:
+            on_progress(stage, completed, total, **extra)
+    
+    # Las secciones se resumen en varios hilos, pero cuentan como una sola solicitud en
+    # el reparto de turnos de LM Studio
+    owner = object()
+    
+    def summarize_section(kind, text):
+        if cancelled is not None and cancelled.is_set():
+            return ''
+        return summarize_text(kind, text, cached, owner)
+    
+    full_text = ''.join(pages)
+    if len(full_text) <= SUMMARY_CHUNK_CHARS:
+        notify('reduce', 0, 1)
+        return 'final', full_text, {'sections': 1, 'reduce_rounds': 0}
+    
+    # Map: secciones formadas por fragmentos consecutivos del documento, sin solapamiento
+    chunks = split_into_chunks(pages, paged, overlap=0)
+    sections = pack_sections([full_text[chunk['start']:chunk['end']] for chunk in chunks])
+    completed = 0
+    notify('map', 0, len(sections))
+    with span('summarize_map'), ThreadPoolExecutor(max_workers=LLM_MAX_IN_FLIGHT) as executor:
+        futures = [executor.submit(summarize_section, 'map', section) for section in sections]
+        partials = []
+        for future in futures:
+            partials.append(future.result())
+            completed += 1
+            notify('map', completed, len(sections))
+    
+    # Reduce: combinar resúmenes parciales hasta que quepan en una sola llamada
+    reduce_round = 0
+    with span('summarize_reduce'):
+        while len('\n\n'.join(partials)) > SUMMARY_CHUNK_CHARS:
+            groups = pack_sections([partial + '\n\n' for partial in partials])
+            if len(groups) >= len(partials):
+                # Resúmenes parciales demasiado largos para agruparlos: se recortan
+                partials = [partial[:SUMMARY_CHUNK_CHARS // 2] for partial in partials]
+                continue
+            reduce_round += 1
+            notify('reduce', 0, len(groups), round=reduce_round)
+            with ThreadPoolExecutor(max_workers=LLM_MAX_IN_FLIGHT) as executor:
+                partials = list(executor.map(lambda group: summarize_section('reduce', group), groups))
+    notify('reduce', 0, 1, round=reduce_round + 1)
+    return 'reduce', '\n\n'.join(partials), {'sections': len(sections), 'reduce_rounds': reduce_round + 1}
+
+def summarize_document_text(pages, paged=True, job_id=None):
+    """Resumen de un documento completo. Devuelve (resumen, estadísticas)."""
+    cached = []
+    kind, text, stats = prepare_summary(pages, paged, job_id, cached)
+    with span('summarize_reduce'):
+        summary = summarize_text(kind, text, cached=cached)
+    report_progress(job_id, 'done', 1, 1)
+    stats['cached'] = len(cached)
+    return summary, stats
+
+def stream_summary(kind, text, cached=None):
+    """Última llamada del resumen en streaming (desde la caché, de una vez, si ya existe)"""
+    summary = read_summary_cache(kind, text)
+    if summary is not None:
+        if cached is not None:
+            cached.append(kind)
+        yield summary
+        return
+    parts = []
+    for delta in lm_studio_stream(summary_messages(kind, text), max_tokens=1000, temperature=SUMMARY_TEMPERATURE):
+        if delta:
+            parts.append(delta)
+        yield delta
+    write_summary_cache(kind, text, ''.join(parts))
+
+def stream_document_summary(pages, filename, paged, input_file_path, job_id, include_text):
+    """
+    Eventos del resumen: "progress" con el avance de las secciones, {"delta"} con cada
+    parte del resumen final (sin negritas), y "done" con los mismos datos que la respuesta
+    JSON, o "error". Si el cliente se desconecta no se empiezan más secciones y se corta
+    la generación en LM Studio.
+    """
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+    
+    events = queue.Queue()
+    cancelled = threading.Event()
+    cached = []
+    
+    def on_progress(stage, completed, total, **extra):
+        events.put(sse_event({'stage': stage, 'completed': completed, 'total': total, **extra}, 'progress'))
+    
+    def prepare():
+        try:
+            return prepare_summary(pages, paged, job_id, cached, on_progress, cancelled)
+        finally:
+            events.put(None)
+    
+    executor = ThreadPoolExecutor(max_workers=1)
+    preparing = executor.submit(prepare)
+    executor.shutdown(wait=False)
+    try:
+        # Fases map y reduce intermedias: avance y comentarios para mantener viva la conexión
+        while True:
+            try:
+                event = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                break
+            yield event
+        kind, text, stats = preparing.result()
+        
+        # Última llamada, enviada a medida que el modelo la genera
+        cleaner = MarkdownCleaner()
+        summary = []
+        with span('summarize_reduce'):
+            for delta in stream_summary(kind, text, cached):
+                if delta is None:
+                    yield ": keepalive\n\n"
+                    continue
+                part = cleaner.feed(delta)
+                if part:
+                    summary.append(part)
+                    yield sse_event({'delta': part})
+        part = cleaner.flush()
+        if part:
+            summary.append(part)
+            yield sse_event({'delta': part})
+        
+        session_id, session = create_document_session(filename, pages, paged=paged)
+        report_progress(job_id, 'done', 1, 1)
+        result_data = {
+            'summary': ''.join(summary),
+            'original_filename': filename,
+            'session_id': session_id,
+            'session_expires': document_session_expires(),
+            'pages': session['pages'],
+            'characters': session['characters'],
+            'summary_sections': stats['sections'],
+            'summary_cached_parts': len(cached)
+        }
+        if include_text:
+            result_data['full_text'] = ''.join(pages)
+        yield sse_event(result_data, 'done')
+    except LMStudioError as e:
+        report_progress(job_id, 'error')
+        yield sse_event({'error': f'Error al comunicarse con LM Studio: {str(e)}'}, 'error')
+    except Exception as e:
+        report_progress(job_id, 'error')
+        yield sse_event({'error': f'Error al procesar el resumen: {str(e)}'}, 'error')
+    finally:
+        cancelled.set()
+        try:
+            os.remove(input_file_path)
+        except OSError:
+            pass
+
 @app.route('/summarize-document', methods=['POST'])
 def summarize_document():
     """
@@ -2949,6 +6536,8 @@ def summarize_document():
     # Ejecutar limpieza automática en cada solicitud
     cleanup_temp_files()
     
+    input_file_path = None
+    streaming = False
     try:
         # Verificar si se ha enviado un archivo
         if 'file' not in request.files:
@@ -2968,26 +6557,25 @@ def summarize_document():
         input_file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
         
         # Guardar el archivo
-        file.save(input_file_path)
+        file_sha256 = upload_sha256(file)
+        save_upload(file, input_file_path)
         
-        # Extraer texto del archivo según su tipo
-        extracted_text = ""
+        # Extraer texto del archivo según su tipo (por páginas en los PDF)
+        pages = []
         
         if file_extension == '.pdf':
             try:
-                # Usar PyMuPDF para extraer texto de PDFs
-                pdf_document = fitz.open(input_file_path)
-                for page_num in range(len(pdf_document)):
-                    page = pdf_document[page_num]
-                    extracted_text += page.get_text()
-                pdf_document.close()
+                # Usar PyMuPDF para extraer texto de PDFs (o el texto ya extraído del mismo archivo)
+                pages = get_pdf_pages(input_file_path, file_sha256)
+                # Las páginas escaneadas, con OCR (solo esas)
+                pages = ocr_scanned_pages(input_file_path, pages, file_sha256, request.form.get('job_id'))
             except Exception as e:
                 return jsonify({'error': f'Error al extraer texto del PDF: {str(e)}'}), 500
         
         elif file_extension in ['.txt', '.md', '.html']:
             # Para archivos de texto, simplemente leer el contenido
             with open(input_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                extracted_text = f.read()
+                pages.append(f.read())
         
         elif file_extension in ['.doc', '.docx', '.rtf']:
             # Para documentos Word, podríamos usar una biblioteca como python-docx
@@ -2998,106 +6586,145 @@ def summarize_document():
             return jsonify({'error': 'Formato de archivo no soportado'}), 400
         
         # Guardar el texto extraído completo
-        full_document_text = extracted_text
-        
-        # Limitar el texto para el resumen para evitar problemas con el modelo
-        max_tokens = 5000
-        if len(extracted_text) > max_tokens:
-            extracted_text = extracted_text[:max_tokens] + "..."
-        
-        # Preparar la solicitud para LM Studio
+        full_document_text = ''.join(pages)
+        
+        # Con stream=true el avance y el resumen se envían por partes (Server-Sent Events)
+        if wants_stream(request.form.get('stream')):
+            # El generador elimina el archivo temporal al terminar
+            streaming = True
+            return sse_response(stream_document_summary(
+                pages, file.filename, file_extension == '.pdf', input_file_path,
+                request.form.get('job_id'), request.form.get('include_text', 'true').lower() != 'false'
+            ))
+        
+        # Resumir el documento completo: por secciones si no cabe en una sola llamada
         try:
-            import requests
-            
-            # URL de la API de LM Studio
-            lm_studio_url = "http://127.0.0.1:1234/v1/chat/completions"
-            
-            # Preparar la solicitud
-            prompt = f"""
-            Por favor, genera un resumen conciso del siguiente documento.
-            Identifica los puntos principales, las ideas clave y la información más relevante.
-            El resumen debe ser claro y mantener la estructura lógica original.
-            
-            DOCUMENTO:
-            {extracted_text}
-            """
-            
-            payload = {
-                "messages": [
-                    {"role": "system", "content": "Eres un asistente especializado en crear resúmenes concisos y precisos de documentos."},
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": 1000,
-                "temperature": 0.2,
-                "stream": False
+            try:
+                summary, summary_stats = summarize_document_text(
+                    pages, paged=file_extension == '.pdf', job_id=request.form.get('job_id')
+                )
+            except LMStudioError as e:
+                report_progress(request.form.get('job_id'), 'error')
+                return jsonify({'error': f'Error al comunicarse con LM Studio: {str(e)}'}), 500
+            
+            # Procesar el resumen para eliminar el formato Markdown
+            summary = clean_markdown_format(summary)
+            
+            # Guardar el documento en una sesión para el chat
+            session_id, session = create_document_session(file.filename, pages, paged=file_extension == '.pdf')
+            
+            # Crear respuesta
+            result_data = {
+                'summary': summary,
+                'original_filename': file.filename,
+                'session_id': session_id,
+                'session_expires': document_session_expires(),
+                'pages': session['pages'],
+                'characters': session['characters'],
+                'summary_sections': summary_stats['sections'],
+                'summary_cached_parts': summary_stats['cached']
             }
+            # Texto completo para los clientes que todavía lo reenvían como contexto
+            if request.form.get('include_text', 'true').lower() != 'false':
+                result_data['full_text'] = full_document_text
             
-            # Realizar la solicitud a LM Studio
-            response = requests.post(lm_studio_url, json=payload)
-            
-            if response.status_code == 200:
-                result = response.json()
-                summary = result['choices'][0]['message']['content']
-                
-                # Procesar el resumen para eliminar el formato Markdown
-                def clean_markdown_format(text):
-                    # Eliminar asteriscos dobles (negrita) pero mantener el texto
-                    cleaned_text = text.replace("**", "")
-                    # Eliminar otros formatos Markdown si es necesario
-                    # cleaned_text = cleaned_text.replace("*", "")  # Cursiva
-                    # cleaned_text = cleaned_text.replace("###", "").replace("##", "").replace("#", "")  # Títulos
-                    return cleaned_text
-                
-                summary = clean_markdown_format(summary)
-                
-                # Crear respuesta
-                result_data = {
-                    'summary': summary,
-                    'original_filename': file.filename,
-                    'full_text': full_document_text  # Incluir el texto completo
-                }
-                
-                # Eliminar el archivo temporal
-                try:
-                    os.remove(input_file_path)
-                except:
-                    pass
-                    
-                return jsonify(result_data)
-            else:
-                return jsonify({'error': f'Error al comunicarse con LM Studio: {response.text}'}), 500
+            return jsonify(result_data)
                 
         except Exception as e:
+            report_progress(request.form.get('job_id'), 'error')
             return jsonify({'error': f'Error al procesar el resumen: {str(e)}'}), 500
             
     except Exception as e:
         return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+    
+    finally:
+        # Eliminar el archivo temporal (también si falla la extracción o LM Studio)
+        if input_file_path and not streaming:
+            try:
+                os.remove(input_file_path)
+            except OSError:
+                pass
+
+def stream_chat_answer(messages, document_hash, question):
+    """
+    Eventos de la respuesta del chat: {"delta"} con cada parte del texto (sin negritas),
+    "done" con la respuesta completa o "error". La respuesta completa se guarda en la caché.
+    """
+    cleaner = MarkdownCleaner()
+    answer = []
+    try:
+        for delta in lm_studio_stream(messages, max_tokens=1024, temperature=CHAT_TEMPERATURE):
+            if delta is None:
+                yield ": keepalive\n\n"
+                continue
+            text = cleaner.feed(delta)
+            if text:
+                answer.append(text)
+                yield sse_event({'delta': text})
+        text = cleaner.flush()
+        if text:
+            answer.append(text)
+            yield sse_event({'delta': text})
+        llm_cache.put('chat', document_hash, question, CHAT_TEMPERATURE, ''.join(answer))
+        yield sse_event({'answer': ''.join(answer)}, 'done')
+    except LMStudioError as e:
+        yield sse_event({'error': f'Error en la comunicación con LM Studio: {str(e)}'}, 'error')
+    except Exception as e:
+        logger.error(f"Error en document_chat: {str(e)}")
+        yield sse_event({'error': str(e)}, 'error')
 
 # Endpoint para chat con contexto del documento
 @app.route('/document-chat', methods=['POST'])
 def document_chat():
     """
-    Recibe una pregunta y el contexto de un documento, y genera una respuesta basada en el contexto
-    utilizando LM Studio.
+    Recibe una pregunta y el id de la sesión del documento (o, en clientes antiguos, el texto
+    del documento en context), y genera una respuesta basada en el documento utilizando LM Studio.
     """
     try:
-        data = request.json
-        if not data or 'question' not in data or 'context' not in data:
-            return jsonify({'error': 'Se requiere una pregunta y el contexto del documento'}), 400
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or 'question' not in data or ('session_id' not in data and 'context' not in data):
+            return jsonify({'error': 'Se requiere una pregunta y la sesión o el contexto del documento'}), 400
             
         question = data['question']
-        context = data['context']
-        
-        # Limitar el contexto si es demasiado grande para evitar problemas con el modelo
-        max_context_length = 12000  # Aproximadamente 3000 tokens
-        if len(context) > max_context_length:
-            # Tomamos la primera parte y la última parte del documento
-            first_part = context[:int(max_context_length * 0.7)]  # 70% del inicio
-            last_part = context[-int(max_context_length * 0.3):]  # 30% del final
-            context = first_part + "\n...[Contenido omitido por longitud]...\n" + last_part
-        
-        # URL de LM Studio
-        lm_studio_url = "http://127.0.0.1:1234/v1/chat/completions"
+        if not isinstance(question, str) or not question.strip():
+            return jsonify({'error': 'La pregunta debe ser un texto no vacío'}), 400
+        if not data.get('session_id') and not isinstance(data['context'], str):
+            return jsonify({'error': 'El contexto del documento debe ser un texto'}), 400
+        if data.get('session_id'):
+            session, document_text = load_document_session(data['session_id'])
+            if session is None:
+                return session_not_found()
+        else:
+            # Clientes antiguos: el documento llega completo y se indexa para esta pregunta
+            document_text = data['context']
+            session = {'chunks': split_into_chunks([document_text], paged=False)}
+        
+        # La misma pregunta sobre el mismo documento se responde desde la caché, sin el modelo
+        document_hash = session.get('sha256') or text_digest(document_text)
+        normalized_question = normalize_prompt(question)
+        cached_answer = llm_cache.get(
+            'chat', document_hash, normalized_question, CHAT_TEMPERATURE, similarity=LLM_CACHE_SIMILARITY
+        )
+        if cached_answer is not None:
+            if wants_stream(data.get('stream')):
+                return sse_response(iter([
+                    sse_event({'delta': cached_answer}),
+                    sse_event({'answer': cached_answer, 'cached': True}, 'done'),
+                ]))
+            return jsonify({'answer': cached_answer, 'cached': True})
+        
+        index = None
+        if data.get('session_id'):
+            index = get_document_index(data['session_id'], session)
+        elif len(document_text) > CHAT_CONTEXT_CHARS:
+            with span('index'):
+                index = DocumentIndex.build(chunk_texts(session, document_text))
+        
+        # Enviar al modelo solo los fragmentos relevantes para la pregunta
+        if index is not None:
+            context = select_context(question, session, document_text, index)
+        else:
+            context = truncate_context(document_text)
         
         # Construir el prompt con la pregunta y el contexto
         prompt = f"""Basado en el siguiente contenido del documento, responde a la pregunta del usuario.
@@ -3112,41 +6739,387 @@ def document_chat():
         
         RESPUESTA:"""
         
-        # Parámetros para la solicitud a LM Studio
-        payload = {
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.3,
-            "max_tokens": 1024
-        }
+        messages = [{"role": "user", "content": prompt}]
+        
+        # Con stream=true la respuesta se envía por partes (Server-Sent Events)
+        if wants_stream(data.get('stream')):
+            return sse_response(stream_chat_answer(messages, document_hash, normalized_question))
         
         # Realizar la solicitud a LM Studio
-        response = requests.post(lm_studio_url, json=payload)
+        try:
+            answer = lm_studio_chat(messages, max_tokens=1024, temperature=CHAT_TEMPERATURE)
+        except LMStudioError as e:
+            return jsonify({'error': f'Error en la comunicación con LM Studio: {str(e)}'}), 500
         
-        if response.status_code == 200:
-            result = response.json()
-            answer = result['choices'][0]['message']['content']
-            
-            # Procesar la respuesta para eliminar el formato Markdown
-            def clean_markdown_format(text):
-                # Eliminar asteriscos dobles (negrita) pero mantener el texto
-                cleaned_text = text.replace("**", "")
-                return cleaned_text
-                
-            cleaned_answer = clean_markdown_format(answer)
-            
-            return jsonify({
-                'answer': cleaned_answer
-            })
-        else:
-            return jsonify({'error': f'Error en la comunicación con LM Studio: {response.status_code}'}), 500
+        # Procesar la respuesta para eliminar el formato Markdown
+        cleaned_answer = clean_markdown_format(answer)
+        llm_cache.put('chat', document_hash, normalized_question, CHAT_TEMPERATURE, cleaned_answer)
+        
+        return jsonify({
+            'answer': cleaned_answer
+        })
             
     except Exception as e:
         logger.error(f"Error en document_chat: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Códigos QR por lotes (pulseras, etiquetas de inventario, muestras). segno es opcional:
+# sin él /qr-batch responde 503. Las matrices se guardan en una caché del proceso por
+# contenido y, en los lotes grandes, se codifican en procesos aparte. El dibujo recorre
+# cada fila por tramos de módulos negros en lugar de módulo a módulo.
+QR_BATCH_MAX = int(os.environ.get('EVARIS_QR_BATCH_MAX', '10000'))
+QR_WORKERS = int(os.environ.get('EVARIS_QR_WORKERS', str(os.cpu_count() or 1)))
+QR_PARALLEL_MIN = 200
+QR_CACHE_ENTRIES = int(os.environ.get('EVARIS_QR_CACHE_ENTRIES', '20000'))
+QR_ERROR_LEVELS = ('L', 'M', 'Q', 'H')
+QR_FORMATS = ('png', 'svg', 'pdf')
+QR_MAX_SCALE = 40
+# Zona de silencio alrededor de cada código, en módulos
+QR_BORDER = 4
+QR_PAGE_SIZES = {'a4': (595.28, 841.89), 'letter': (612, 792)}
+QR_SHEET_MARGIN = 28.35  # 1 cm
+QR_LABEL_SIZE = 8
+QR_PAYLOAD_COLUMNS = ('payload', 'contenido', 'datos', 'data', 'codigo', 'código', 'url', 'texto', 'text')
+QR_LABEL_COLUMNS = ('label', 'etiqueta', 'nombre', 'name', 'descripcion', 'descripción')
+QR_RUN = re.compile(rb'\x01+')
+QR_PNG_LEVELS = bytes.maketrans(b'\x00\x01', b'\xff\x00')
+
+_qr_cache = collections.OrderedDict()
+_qr_cache_lock = threading.Lock()
+_qr_pool = None
+_qr_pool_pid = None
+_qr_pool_lock = threading.Lock()
+_qr_label_widths = {}
+
+def qr_pool():
+    """Procesos de codificación de QR del worker actual (forkserver, como text_pool)"""
+    global _qr_pool, _qr_pool_pid
+    with _qr_pool_lock:
+        if _qr_pool is None or _qr_pool_pid != os.getpid():
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _qr_pool = ProcessPoolExecutor(max_workers=QR_WORKERS, mp_context=multiprocessing.get_context(method))
+            _qr_pool_pid = os.getpid()
+    return _qr_pool
+
+def encode_qr_matrices(payloads, error, mask):
+    """
+    Matrices de los códigos QR de payloads como (lado, módulos fila a fila con 1 = negro),
+    o None si el contenido no cabe en un código QR (se ejecuta en los procesos de QR)
+    """
+    import segno
+    matrices = []
+    for payload in payloads:
+        try:
+            qr = segno.make_qr(payload, error=error, mask=mask)
+        except segno.DataOverflowError:
+            matrices.append(None)
+            continue
+        matrices.append((len(qr.matrix), b''.join(qr.matrix)))
+    return matrices
+
+def get_qr_matrices(payloads, error, mask):
+    """
+    Matrices de cada contenido, desde la caché si ya se codificaron; los contenidos
+    repetidos del lote se codifican una vez. Devuelve (matrices, número de aciertos).
+    """
+    global _qr_pool
+    keys = [(payload, error, mask) for payload in payloads]
+    found = {}
+    with _qr_cache_lock:
+        for key in keys:
+            if key not in found and key in _qr_cache:
+                _qr_cache.move_to_end(key)
+                found[key] = _qr_cache[key]
+    cached = sum(1 for key in keys if key in found)
+    missing = [key[0] for key in dict.fromkeys(keys) if key not in found]
+    
+    if missing:
+        from concurrent.futures.process import BrokenProcessPool
+        with span('encode'):
+            if QR_WORKERS < 2 or len(missing) < QR_PARALLEL_MIN:
+                encoded = encode_qr_matrices(missing, error, mask)
+            else:
+                # Varios bloques por proceso para repartir los contenidos largos
+                step = math.ceil(len(missing) / (QR_WORKERS * 4))
+                try:
+                    futures = [
+                        qr_pool().submit(encode_qr_matrices, missing[start:start + step], error, mask)
+                        for start in range(0, len(missing), step)
+                    ]
+                    encoded = []
+                    for future in futures:
+                        encoded.extend(future.result())
+                except BrokenProcessPool:
+                    logger.warning("El pool de codificación de QR se ha roto; se codifica en este proceso")
+                    with _qr_pool_lock:
+                        _qr_pool = None
+                    encoded = encode_qr_matrices(missing, error, mask)
+        with _qr_cache_lock:
+            for payload, matrix in zip(missing, encoded):
+                found[(payload, error, mask)] = matrix
+                if matrix is not None:
+                    _qr_cache[(payload, error, mask)] = matrix
+            while len(_qr_cache) > QR_CACHE_ENTRIES:
+                _qr_cache.popitem(last=False)
+    return [found[key] for key in keys], cached
+
+def qr_runs(matrix):
+    """Tramos de módulos negros de cada fila de una matriz: (x, y, longitud)"""
+    size, modules = matrix
+    for y in range(size):
+        row = y * size
+        for run in QR_RUN.finditer(modules, row, row + size):
+            yield run.start() - row, y, run.end() - run.start()
+
+def qr_png(matrix, scale):
+    """PNG de un código en blanco y negro (1 bit), con scale píxeles por módulo"""
+    size, modules = matrix
+    img = Image.frombytes('L', (size, size), modules.translate(QR_PNG_LEVELS))
+    img = ImageOps.expand(img, QR_BORDER, fill=255)
+    side = (size + 2 * QR_BORDER) * scale
+    img = img.resize((side, side), Image.NEAREST).convert('1', dither=Image.Dither.NONE)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def qr_svg(matrix, scale):
+    """SVG de un código como un único trazado con un rectángulo por tramo"""
+    side = matrix[0] + 2 * QR_BORDER
+    path = ''.join(
+        f"M{x + QR_BORDER} {y + QR_BORDER}h{length}v1h-{length}z" for x, y, length in qr_runs(matrix)
+    )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{side * scale}" height="{side * scale}" '
+        f'viewBox="0 0 {side} {side}" shape-rendering="crispEdges">'
+        f'<rect width="{side}" height="{side}" fill="#fff"/><path fill="#000" d="{path}"/></svg>\n'
+    ).encode('utf-8')
+
+def qr_filename(index, item, extension):
+    name = secure_filename(item[1] or item[0])[:40]
+    return f"{index + 1:05d}_{name}.{extension}" if name else f"{index + 1:05d}.{extension}"
+
+def label_width(text, font):
+    """Ancho de una etiqueta; medir con la fuente es lento, así que se guarda el de cada carácter"""
+    total = 0
+    for char in text:
+        width = _qr_label_widths.get(char)
+        if width is None:
+            width = _qr_label_widths[char] = font.text_length(char, QR_LABEL_SIZE)
+        total += width
+    return total
+
+def fit_label(text, font, max_width):
+    """Recorta una etiqueta (con puntos suspensivos) para que quepa en max_width"""
+    text = ' '.join(text.split())[:200]
+    if label_width(text, font) <= max_width:
+        return text
+    while text and label_width(text + '…', font) > max_width:
+        text = text[:-1]
+    return text + '…'
+
+def build_qr_sheet(items, matrices, page_size, columns, rows, labels, destination, on_page=None):
+    """
+    Hoja de etiquetas en PDF: los códigos en una cuadrícula de columns x rows por página,
+    cada uno con su etiqueta debajo. Los módulos se escriben directamente en el contenido
+    de la página (un rectángulo por tramo, en unidades de módulo) y las etiquetas con un
+    único TextWriter por página.
+    """
+    import zlib
+    width, height = QR_PAGE_SIZES[page_size]
+    cell_width = (width - 2 * QR_SHEET_MARGIN) / columns
+    cell_height = (height - 2 * QR_SHEET_MARGIN) / rows
+    label_height = QR_LABEL_SIZE * 1.5 if labels else 0
+    # Lado del código con su zona de silencio
+    side = min(cell_width, cell_height - label_height)
+    font = fitz.Font('helv')
+    per_page = columns * rows
+    
+    document = fitz.open()
+    for start in range(0, len(matrices), per_page):
+        page = document.new_page(width=width, height=height)
+        writer = fitz.TextWriter(page.rect)
+        content = ['0 g']
+        for slot, index in enumerate(range(start, min(start + per_page, len(matrices)))):
+            size = matrices[index][0]
+            module = side / (size + 2 * QR_BORDER)
+            left = QR_SHEET_MARGIN + (slot % columns) * cell_width
+            top = QR_SHEET_MARGIN + (slot // columns) * cell_height + (cell_height - side - label_height) / 2
+            x = left + (cell_width - side) / 2 + QR_BORDER * module
+            y = top + QR_BORDER * module
+            # El contenido usa el origen abajo a la izquierda: se invierte el eje y para
+            # dibujar las filas de la matriz de arriba abajo
+            runs = ' '.join(f"{run_x} {run_y} {length} 1 re" for run_x, run_y, length in qr_runs(matrices[index]))
+            content.append(f"q {module:.5f} 0 0 {-module:.5f} {x:.3f} {height - y:.3f} cm {runs} f Q")
+            if labels:
+                label = fit_label(items[index][1] or items[index][0], font, cell_width - 4)
+                label_x = left + (cell_width - label_width(label, font)) / 2
+                writer.append((label_x, top + side + QR_LABEL_SIZE), label, font=font, fontsize=QR_LABEL_SIZE)
+        
+        xref = document.get_new_xref()
+        document.update_object(xref, '<<>>')
+        document.update_stream(xref, zlib.compress('\n'.join(content).encode('ascii')), compress=False)
+        document.xref_set_key(xref, 'Filter', '/FlateDecode')
+        document.xref_set_key(page.xref, 'Contents', f'{xref} 0 R')
+        if labels:
+            writer.write_text(page)
+        if on_page:
+            on_page(min(start + per_page, len(matrices)))
+    
+    with span('serialize'):
+        document.save(destination, deflate=True)
+    document.close()
+
+def parse_qr_items(text, extension):
+    """
+    Lista de (contenido, etiqueta) de un lote: CSV (con o sin cabecera; sin cabecera la
+    segunda columna es la etiqueta), JSON (lista de textos o de objetos con payload y
+    label) o texto con un contenido por línea. ValueError si el formato no es válido.
+    """
+    items = []
+    if extension == '.json':
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get('items')
+        if not isinstance(data, list):
+            raise ValueError('El JSON debe ser una lista de contenidos o un objeto con la lista en "items"')
+        for entry in data:
+            if isinstance(entry, dict):
+                payload = entry.get('payload', entry.get('data', entry.get('text', '')))
+                items.append((str(payload if payload is not None else ''), str(entry.get('label') or '')))
+            elif entry is not None:
+                items.append((str(entry), ''))
+    elif extension == '.csv':
+        import csv
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        rows = [row for row in csv.reader(io.StringIO(text), dialect) if row]
+        payload_column, label_column = 0, 1
+        if rows:
+            header = [cell.strip().lower() for cell in rows[0]]
+            if any(name in header for name in QR_PAYLOAD_COLUMNS):
+                payload_column = next(header.index(name) for name in QR_PAYLOAD_COLUMNS if name in header)
+                label_column = next((header.index(name) for name in QR_LABEL_COLUMNS if name in header), None)
+                rows = rows[1:]
+        for row in rows:
+            payload = row[payload_column] if payload_column < len(row) else ''
+            label = row[label_column] if label_column is not None and label_column < len(row) else ''
+            items.append((payload, label.strip()))
+    else:
+        items = [(line, '') for line in text.splitlines()]
+    return [(payload.strip(), label) for payload, label in items if payload.strip()]
+
+@app.route('/qr-batch', methods=['POST'])
+def qr_batch():
+    """
+    Genera códigos QR por lotes a partir de un archivo (CSV, JSON o texto) o del campo
+    items (JSON). Devuelve un ZIP de PNG o SVG, o una hoja de etiquetas en PDF.
+    """
+    cleanup_temp_files()
+    
+    try:
+        import segno
+    except ImportError:
+        logger.error("segno no está instalado para generar códigos QR")
+        return jsonify({'error': 'La generación de QR por lotes no está disponible en el servidor (falta segno).'}), 503
+    
+    if 'file' in request.files and request.files['file'].filename:
+        file = request.files['file']
+        extension = os.path.splitext(file.filename)[1].lower()
+        raw = file.read()
+        try:
+            text = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            # CSV exportados desde Excel en Windows
+            text = raw.decode('cp1252', errors='replace')
+    elif request.form.get('items'):
+        text, extension = request.form['items'], '.json'
+    else:
+        return jsonify({'error': 'No se ha proporcionado ningún archivo ni lista de contenidos'}), 400
+    
+    output_format = request.form.get('format', 'png').lower()
+    if output_format not in QR_FORMATS:
+        return jsonify({'error': f'Formato de salida no válido. Use: {", ".join(QR_FORMATS)}'}), 400
+    error = request.form.get('error_correction', 'M').upper()
+    if error not in QR_ERROR_LEVELS:
+        return jsonify({'error': f'Nivel de corrección no válido. Use: {", ".join(QR_ERROR_LEVELS)}'}), 400
+    page_size = request.form.get('page_size', 'a4').lower()
+    if page_size not in QR_PAGE_SIZES:
+        return jsonify({'error': f'Tamaño de página no válido. Use: {", ".join(QR_PAGE_SIZES)}'}), 400
+    try:
+        scale = min(QR_MAX_SCALE, max(1, int(request.form.get('scale', 10))))
+        columns = min(10, max(1, int(request.form.get('columns', 4))))
+        rows = min(20, max(1, int(request.form.get('rows', 6))))
+        # Sin máscara fija segno evalúa las ocho y elige la mejor (unas cinco veces más lento)
+        mask = request.form.get('mask', 'auto')
+        mask = None if mask == 'auto' else int(mask)
+    except ValueError:
+        return jsonify({'error': 'scale, columns, rows y mask deben ser números enteros'}), 400
+    if mask is not None and not 0 <= mask <= 7:
+        return jsonify({'error': 'La máscara debe estar entre 0 y 7 (o "auto")'}), 400
+    labels = request.form.get('labels', 'true').lower() != 'false'
+    job_id = request.form.get('job_id')
+    
+    try:
+        with span('parse'):
+            items = parse_qr_items(text, extension)
+    except ValueError as e:
+        return jsonify({'error': f'Lista de contenidos no válida: {str(e)}'}), 400
+    if not items:
+        return jsonify({'error': 'La lista no contiene ningún contenido'}), 400
+    if len(items) > QR_BATCH_MAX:
+        return jsonify({'error': f'El lote tiene {len(items)} códigos; el máximo es {QR_BATCH_MAX}'}), 400
+    
+    try:
+        report_progress(job_id, 'encode', 0, len(items))
+        matrices, cached = get_qr_matrices([payload for payload, _ in items], error, mask)
+        overflow = [index + 1 for index, matrix in enumerate(matrices) if matrix is None]
+        if overflow:
+            listed = ', '.join(str(number) for number in overflow[:10]) + (', …' if len(overflow) > 10 else '')
+            return jsonify({'error': f'Contenido demasiado largo para un código QR en las filas: {listed}'}), 400
+        logger.info(f"QR por lotes: {len(items)} códigos ({cached} en caché), formato {output_format}")
+        
+        def rendered(completed):
+            report_progress(job_id, 'render', completed, len(items))
+        
+        if output_format == 'pdf':
+            output_path = os.path.join(UPLOAD_FOLDER, f"qr_{uuid.uuid4().hex}.pdf")
+            with span('render'):
+                build_qr_sheet(items, matrices, page_size, columns, rows, labels, output_path, rendered)
+            report_progress(job_id, 'done', len(items), len(items))
+            return send_artifact(output_path, 'codigos_qr.pdf', 'application/pdf')
+        
+        # Los PNG ya están comprimidos; los SVG son texto y se comprimen en el ZIP
+        render = qr_png if output_format == 'png' else qr_svg
+        compression = zipfile.ZIP_STORED if output_format == 'png' else zipfile.ZIP_DEFLATED
+        zip_buffer = spooled_output()
+        try:
+            with span('render'), zipfile.ZipFile(zip_buffer, 'w', compression) as archive:
+                futures = bounded_map(lambda matrix: render(matrix, scale), matrices)
+                for index, future in enumerate(futures):
+                    archive.writestr(qr_filename(index, items[index], output_format), future.result())
+                    if (index + 1) % 500 == 0:
+                        rendered(index + 1)
+            zip_buffer.seek(0)
+            report_progress(job_id, 'done', len(items), len(items))
+            return send_artifact(zip_buffer, 'codigos_qr.zip', 'application/zip')
+        finally:
+            zip_buffer.close()
+    
+    except Exception as e:
+        report_progress(job_id, 'error')
+        logger.error(f"Error en qr_batch: {str(e)}")
+        return jsonify({'error': f'Error al generar los códigos QR: {str(e)}'}), 500
+
 if __name__ == '__main__':
+    # Servidor de desarrollo de Werkzeug (con depurador y recarga automática).
+    # En producción usar serve.py o gunicorn -c gunicorn.conf.py wsgi:app
+    debug = os.environ.get('EVARIS_DEBUG', '1') == '1'
     print("Iniciando el servidor en http://localhost:5000...")
+    if debug:
+        print("Modo desarrollo: para producción ejecute 'python serve.py'")
     print("Presiona CTRL+C para detenerlo")
-    app.run(debug=True, port=5000, host='0.0.0.0') 
+    app.run(debug=debug, port=5000, host='0.0.0.0')
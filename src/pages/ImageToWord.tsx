@@ -1,8 +1,9 @@
-import React, { useState, useRef } from 'react';
+import React, { useState, useRef, useEffect } from 'react';
 import { Link } from 'react-router-dom';
 import Tesseract from 'tesseract.js';
 import { Document, Packer, Paragraph, TextRun, HeadingLevel } from 'docx';
 import { saveAs } from 'file-saver';
+import config from '../config';
 
 interface ImageItem {
   file: File;
@@ -40,9 +41,28 @@ const ImageToWord: React.FC = () => {
   const [enhanceContrast, setEnhanceContrast] = useState<boolean>(true);
   const [enableDeskew, setEnableDeskew] = useState<boolean>(true);
   const [preprocessingMode, setPreprocessingMode] = useState<string>('1');
+  // OCR con el Tesseract del servidor: la corrección de inclinación solo aplica en el navegador
+  const [serverOcr, setServerOcr] = useState<boolean>(false);
 
   const fileInputRef = useRef<HTMLInputElement>(null);
 
+  // Comprobar si el servidor tiene OCR al cargar el componente
+  useEffect(() => {
+    const checkServerOcr = async () => {
+      try {
+        const response = await fetch(`${config.apiUrl}/system-info`);
+        if (response.ok) {
+          const info = await response.json();
+          setServerOcr(Boolean(info.services?.ocr?.available));
+        }
+      } catch (err) {
+        console.error('Error al verificar el servidor:', err);
+      }
+    };
+    
+    checkServerOcr();
+  }, []);
+
   // Lista de idiomas soportados
   const languages = [
     { code: 'spa', name: 'Español' },
@@ -89,6 +109,33 @@ const ImageToWord: React.FC = () => {
     });
   };
 
+  // OCR de una imagen en el servidor (Tesseract local). Devuelve null si el servidor
+  // no tiene OCR o no responde, para usar el reconocimiento en el navegador.
+  const recognizeOnServer = async (file: File): Promise<string | null> => {
+    const formData = new FormData();
+    formData.append('file', file);
+    formData.append('language', ocrLanguage);
+    formData.append('format', 'text');
+    formData.append('psm', preprocessingMode);
+
+    let response: Response;
+    try {
+      response = await fetch(`${config.apiUrl}/ocr`, { method: 'POST', body: formData });
+    } catch {
+      setServerOcr(false);
+      return null;
+    }
+    if (response.status === 503) {
+      setServerOcr(false);
+      return null;
+    }
+    const data = await response.json();
+    if (!response.ok) {
+      throw new Error(data.error || 'Error al reconocer el texto en el servidor');
+    }
+    return data.text;
+  };
+
   // Función para convertir imágenes a Word con OCR
   const convertImagesToWord = async () => {
     if (images.length === 0) {
@@ -142,6 +189,14 @@ const ImageToWord: React.FC = () => {
         
         const baseProgress = i * progressPerImage;
         
+        // Primero en el servidor; si no tiene OCR, en el navegador
+        const serverText = await recognizeOnServer(processedImages[i].file);
+        if (serverText !== null) {
+          processedImages[i].text = serverText;
+          setCurrentProgress(Math.floor(baseProgress + progressPerImage));
+          continue;
+        }
+        
         // Reconocer la imagen actual
         const result = await Tesseract.recognize(
           processedImages[i].file,
@@ -498,12 +553,14 @@ const ImageToWord: React.FC = () => {
                           <input
                             type="checkbox"
                             id="enable-deskew"
-                            checked={enableDeskew}
+                            checked={enableDeskew && !serverOcr}
+                            disabled={serverOcr}
                             onChange={(e) => setEnableDeskew(e.target.checked)}
-                            className="w-4 h-4 text-primary border-2 border-input rounded focus:ring-2 focus:ring-ring"
+                            className="w-4 h-4 text-primary border-2 border-input rounded focus:ring-2 focus:ring-ring disabled:opacity-50"
                           />
-                          <label htmlFor="enable-deskew" className="text-sm text-foreground cursor-pointer">
+                          <label htmlFor="enable-deskew" className={`text-sm text-foreground ${serverOcr ? 'opacity-50' : 'cursor-pointer'}`}>
                             Corregir inclinación del texto (deskew)
+                            {serverOcr && ' — no necesario: el OCR del servidor ya sigue las líneas inclinadas'}
                           </label>
                         </div>
 
@@ -1,7 +1,8 @@
-import React, { useState, useRef, ChangeEvent } from 'react';
+import React, { useState, useRef, useEffect, ChangeEvent } from 'react';
 import { Link } from 'react-router-dom';
 import Tesseract from 'tesseract.js';
 import * as pdfjsLib from 'pdfjs-dist';
+import config from '../config';
 
 // Configuración del worker ahora está centralizada en main.tsx
 
@@ -45,9 +46,28 @@ const OcrTool: React.FC = () => {
   const [enhanceContrast, setEnhanceContrast] = useState<boolean>(true);
   const [enableDeskew, setEnableDeskew] = useState<boolean>(true);
   const [preprocessingMode, setPreprocessingMode] = useState<string>('1');
+  // OCR con el Tesseract del servidor: la corrección de inclinación solo aplica en el navegador
+  const [serverOcr, setServerOcr] = useState<boolean>(false);
 
   const fileInputRef = useRef<HTMLInputElement>(null);
 
+  // Comprobar si el servidor tiene OCR al cargar el componente
+  useEffect(() => {
+    const checkServerOcr = async () => {
+      try {
+        const response = await fetch(`${config.apiUrl}/system-info`);
+        if (response.ok) {
+          const info = await response.json();
+          setServerOcr(Boolean(info.services?.ocr?.available));
+        }
+      } catch (err) {
+        console.error('Error al verificar el servidor:', err);
+      }
+    };
+    
+    checkServerOcr();
+  }, []);
+
   const handleFileChange = (event: ChangeEvent<HTMLInputElement>) => {
     if (event.target.files && event.target.files[0]) {
       const file = event.target.files[0];
@@ -171,6 +191,55 @@ const OcrTool: React.FC = () => {
     return result.data.text;
   };
 
+  // OCR en el servidor (Tesseract local, páginas en paralelo). Devuelve null si el
+  // servidor no tiene OCR o no responde, para usar el reconocimiento en el navegador.
+  const recognizeOnServer = async (file: File): Promise<string | null> => {
+    const jobId = crypto.randomUUID();
+    const formData = new FormData();
+    formData.append('file', file);
+    formData.append('language', language);
+    formData.append('format', 'text');
+    formData.append('psm', preprocessingMode);
+    formData.append('job_id', jobId);
+
+    // Avance por páginas mientras el servidor reconoce el documento
+    const poller = setInterval(async () => {
+      try {
+        const response = await fetch(`${config.apiUrl}/progress/${jobId}`);
+        if (response.ok) {
+          const status = await response.json();
+          if (status.stage === 'ocr' && status.total > 0) {
+            setProgress(5 + Math.round((status.completed / status.total) * 90));
+          }
+        }
+      } catch {
+        // El progreso es orientativo: se ignoran los fallos de consulta
+      }
+    }, 1000);
+
+    try {
+      setProgress(5);
+      let response: Response;
+      try {
+        response = await fetch(`${config.apiUrl}/ocr`, { method: 'POST', body: formData });
+      } catch {
+        setServerOcr(false);
+        return null;
+      }
+      if (response.status === 503) {
+        setServerOcr(false);
+        return null;
+      }
+      const data = await response.json();
+      if (!response.ok) {
+        throw new Error(data.error || 'Error al reconocer el texto en el servidor');
+      }
+      return data.text;
+    } finally {
+      clearInterval(poller);
+    }
+  };
+
   const handleProcessFile = async () => {
     if (!selectedFile) {
       setError('Por favor, seleccione un archivo para procesar');
@@ -187,8 +256,11 @@ const OcrTool: React.FC = () => {
       // Verificar tipos de archivo soportados
       const supportedImageTypes = ['image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/webp', 'image/tiff'];
       
-      // Procesar según el tipo de archivo
-      if (supportedImageTypes.includes(selectedFile.type)) {
+      // Primero en el servidor; si no tiene OCR, en el navegador
+      const serverText = await recognizeOnServer(selectedFile);
+      if (serverText !== null) {
+        extractedText = serverText;
+      } else if (supportedImageTypes.includes(selectedFile.type)) {
         // Procesar imágenes con OCR
         extractedText = await processImageWithOCR(selectedFile);
       } else if (fileType === 'pdf') {
@@ -384,12 +456,14 @@ const OcrTool: React.FC = () => {
                       <input
                         type="checkbox"
                         id="enable-deskew"
-                        checked={enableDeskew}
+                        checked={enableDeskew && !serverOcr}
+                        disabled={serverOcr}
                         onChange={(e) => setEnableDeskew(e.target.checked)}
-                        className="w-4 h-4 text-primary border-2 border-input rounded focus:ring-2 focus:ring-ring"
+                        className="w-4 h-4 text-primary border-2 border-input rounded focus:ring-2 focus:ring-ring disabled:opacity-50"
                       />
-                      <label htmlFor="enable-deskew" className="text-sm text-foreground cursor-pointer">
+                      <label htmlFor="enable-deskew" className={`text-sm text-foreground ${serverOcr ? 'opacity-50' : 'cursor-pointer'}`}>
                         Corregir inclinación del texto (deskew)
+                        {serverOcr && ' — no necesario: el OCR del servidor ya sigue las líneas inclinadas'}
                       </label>
                     </div>
 
@@ -14,6 +14,35 @@ interface ChatMessage {
   content: string;
 }
 
+// Lee una respuesta Server-Sent Events y entrega cada evento con su nombre y datos
+const readEventStream = async (
+  response: Response,
+  onEvent: (event: string, data: any) => void
+) => {
+  const reader = response.body!.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf('\n\n');
+      let event = 'message';
+      const dataLines: string[] = [];
+      for (const line of block.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+      }
+      // Las líneas de comentario (": keepalive") no llevan datos
+      if (dataLines.length) onEvent(event, JSON.parse(dataLines.join('\n')));
+    }
+  }
+};
+
 const SummarizeDocument: React.FC = () => {
   const [file, setFile] = useState<File | null>(null);
   const [dragActive, setDragActive] = useState<boolean>(false);
@@ -21,7 +50,7 @@ const SummarizeDocument: React.FC = () => {
   const [error, setError] = useState<string>('');
   const [success, setSuccess] = useState<string | null>(null);
   const [summary, setSummary] = useState<string>('');
-  const [fullDocumentText, setFullDocumentText] = useState<string>('');
+  const [sessionId, setSessionId] = useState<string>('');
   const [originalFilename, setOriginalFilename] = useState<string>('');
   const [processingStatus, setProcessingStatus] = useState('');
   
@@ -114,6 +143,10 @@ const SummarizeDocument: React.FC = () => {
     try {
       const formData = new FormData();
       formData.append('file', file);
+      // El texto completo queda en la sesión del servidor; no hace falta descargarlo
+      formData.append('include_text', 'false');
+      // El avance y el resumen llegan por Server-Sent Events a medida que se generan
+      formData.append('stream', 'true');
 
       setProcessingStatus('Enviando documento al servidor...');
 
@@ -122,21 +155,39 @@ const SummarizeDocument: React.FC = () => {
         body: formData,
       });
 
-      setProcessingStatus('Analizando documento...');
-
-      const data = await response.json();
-
       if (!response.ok) {
+        const data = await response.json();
         throw new Error(data.error || 'Error al procesar el documento');
       }
 
+      let streamError = '';
+      await readEventStream(response, (event, data) => {
+        if (event === 'progress') {
+          if (data.stage === 'map') {
+            setProcessingStatus(`Resumiendo sección ${data.completed} de ${data.total}...`);
+          } else if (data.stage === 'reduce') {
+            setProcessingStatus('Combinando los resúmenes de las secciones...');
+          }
+        } else if (event === 'done') {
+          setSummary(data.summary);
+          setSessionId(data.session_id);
+          setOriginalFilename(data.original_filename);
+        } else if (event === 'error') {
+          streamError = data.error;
+        } else if (data.delta) {
+          setSummary(prevSummary => prevSummary + data.delta);
+        }
+      });
+
+      if (streamError) {
+        throw new Error(streamError);
+      }
+
       setProcessingStatus('¡Resumen generado correctamente!');
-      setSummary(data.summary);
-      setFullDocumentText(data.full_text);
-      setOriginalFilename(data.original_filename);
       setSuccess('Documento procesado correctamente');
 
     } catch (error) {
+      setSummary('');
       setError(error instanceof Error ? error.message : 'Error al procesar el archivo');
     } finally {
       setLoading(false);
@@ -149,6 +200,7 @@ const SummarizeDocument: React.FC = () => {
     setError('');
     setSuccess(null);
     setOriginalFilename('');
+    setSessionId('');
     if (inputRef.current) {
       inputRef.current.value = '';
     }
@@ -175,7 +227,7 @@ const SummarizeDocument: React.FC = () => {
     setChatError('');
     
     try {
-      // Enviar la pregunta y el contexto al servidor
+      // Enviar la pregunta y la sesión del documento al servidor
       const response = await fetch(`${config.apiUrl}/document-chat`, {
         method: 'POST',
         headers: {
@@ -183,23 +235,41 @@ const SummarizeDocument: React.FC = () => {
         },
         body: JSON.stringify({
           question: userMessage.content,
-          context: fullDocumentText
+          session_id: sessionId,
+          stream: true
         })
       });
       
-      const data = await response.json();
-      
       if (!response.ok) {
+        const data = await response.json();
         throw new Error(data.error || 'Error al procesar la pregunta');
       }
       
-      // Añadir la respuesta del asistente
-      const assistantMessage: ChatMessage = {
-        type: 'assistant',
-        content: data.answer
+      // Añadir la respuesta del asistente e ir completándola con cada fragmento
+      setChatMessages(prevMessages => [...prevMessages, { type: 'assistant', content: '' }]);
+      const updateAnswer = (update: (content: string) => string) => {
+        setChatMessages(prevMessages => {
+          const last = prevMessages[prevMessages.length - 1];
+          return [...prevMessages.slice(0, -1), { ...last, content: update(last.content) }];
+        });
       };
       
-      setChatMessages(prevMessages => [...prevMessages, assistantMessage]);
+      let streamError = '';
+      await readEventStream(response, (event, data) => {
+        if (event === 'done') {
+          updateAnswer(() => data.answer);
+        } else if (event === 'error') {
+          streamError = data.error;
+        } else if (data.delta) {
+          setIsChatLoading(false);
+          updateAnswer(content => content + data.delta);
+        }
+      });
+      
+      if (streamError) {
+        setChatMessages(prevMessages => prevMessages[prevMessages.length - 1].content ? prevMessages : prevMessages.slice(0, -1));
+        throw new Error(streamError);
+      }
       
     } catch (error) {
       setChatError(error instanceof Error ? error.message : 'Error al procesar la pregunta');
@@ -472,6 +542,7 @@ const SummarizeDocument: React.FC = () => {
 
                     <button
                       onClick={() => setChatActive(true)}
+                      disabled={!sessionId}
                       className="inline-flex items-center justify-center gap-2 px-4 py-2 text-sm font-medium rounded-lg bg-secondary text-secondary-foreground hover:bg-secondary/80 transition-colors"
                     >
                       <svg className="w-4 h-4" fill="none" stroke="currentColor" viewBox="0 0 24 24">
@@ -0,0 +1,69 @@
+"""Caché de respuestas de LM Studio y comparación de preguntas parecidas"""
+import pytest
+
+import server
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    model = {'id': 'modelo-a'}
+    monkeypatch.setattr(server.lm_studio, 'model_id', lambda: model['id'])
+    cache = server.LLMCache(str(tmp_path / 'cache.sqlite3'), 1024 * 1024)
+    cache.model = model
+    return cache
+
+
+def test_normalize_prompt():
+    assert server.normalize_prompt('¿Cuál es  el PLAZO de entrega?') == 'cual es el plazo de entrega'
+    assert server.normalize_prompt('Ñandú, acción!') == 'nandu accion'
+
+
+def test_prompt_terms_conserva_las_negaciones():
+    assert server.prompt_terms('que plazos tiene el contrato') == {'plazo', 'contrato'}
+    assert server.prompt_terms('que plazos no tiene el contrato') == {'plazo', 'contrato', 'no'}
+
+
+def test_misma_pregunta_normalizada(cache):
+    prompt = server.normalize_prompt('¿Cuál es el plazo?')
+    cache.put('chat', 'doc', prompt, 0.7, 'Diez días')
+    assert cache.get('chat', 'doc', server.normalize_prompt('cual es el PLAZO'), 0.7) == 'Diez días'
+    assert cache.get('chat', 'otro', prompt, 0.7) is None
+    assert cache.get('chat', 'doc', prompt, 0.2) is None
+
+
+def test_pregunta_parecida_segun_jaccard(cache):
+    cache.put('chat', 'doc', 'cual es el plazo de entrega del proyecto', 0.7, 'Marzo')
+    similar = 'cual es el plazo de entrega de los proyectos'
+    assert cache.get('chat', 'doc', similar, 0.7) is None
+    assert cache.get('chat', 'doc', similar, 0.7, similarity=0.8) == 'Marzo'
+    # Solo comparten «proyecto» (Jaccard 1/4)
+    assert cache.get('chat', 'doc', 'cual es el coste del proyecto', 0.7, similarity=0.5) is None
+
+
+def test_la_negacion_cambia_la_pregunta(cache):
+    cache.put('chat', 'doc', 'que incluye el contrato', 0.7, 'Mantenimiento')
+    # Sin la negación las palabras significativas serían las mismas (Jaccard 1)
+    assert cache.get('chat', 'doc', 'que no incluye el contrato', 0.7, similarity=0.8) is None
+
+
+def test_cambiar_de_modelo_no_reutiliza_respuestas(cache):
+    cache.put('chat', 'doc', 'resumen', 0.7, 'Respuesta del modelo A')
+    cache.model['id'] = 'modelo-b'
+    assert cache.get('chat', 'doc', 'resumen', 0.7) is None
+    assert cache.get('chat', 'doc', 'resumen', 0.7, similarity=0.5) is None
+    cache.model['id'] = 'modelo-a'
+    assert cache.get('chat', 'doc', 'resumen', 0.7) == 'Respuesta del modelo A'
+
+
+def test_el_tamano_queda_acotado(cache, monkeypatch):
+    monkeypatch.setattr(server, 'LLM_CACHE_EVICT_EVERY', 5)
+    cache.max_bytes = 20_000
+    for number in range(200):
+        cache.put('chat', 'doc', f'pregunta {number}', 0.7, 'x' * 1000)
+    connection = cache.connection()
+    total = connection.execute('SELECT SUM(size) FROM responses').fetchone()[0]
+    # Entre dos comprobaciones el límite se puede superar en LLM_CACHE_EVICT_EVERY escrituras
+    assert total <= cache.max_bytes + 5 * 1012
+    # Se eliminan las usadas hace más tiempo
+    assert cache.get('chat', 'doc', 'pregunta 199', 0.7) is not None
+    assert cache.get('chat', 'doc', 'pregunta 0', 0.7) is None
@@ -0,0 +1,57 @@
+"""Unión del hOCR por páginas y caché del OCR"""
+import re
+
+import server
+
+PAGE_HOCR = """<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+  <meta name='ocr-system' content='tesseract 5.3.0' />
+ </head>
+ <body>
+  <div class='ocr_page' id='page_1' title='image "/tmp/ocr_x/page_{n}.png"; bbox 0 0 2480 3508; ppageno 0'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 100 100 900 150">
+    <span class='ocr_line' id='line_1_1' title="bbox 100 100 900 150">
+     <span class='ocrx_word' id='word_1_1' title='bbox 100 100 400 150; x_wconf 95'>Página</span>
+     <span class='ocrx_word' id='word_1_12' title='bbox 420 100 900 150; x_wconf 93'>{n}</span>
+    </span>
+   </div>
+  </div>
+ </body>
+</html>
+"""
+
+
+def test_combine_hocr_renumera_las_paginas(tmp_path):
+    bases = []
+    for number in range(3):
+        base = tmp_path / f"base{number}"
+        (tmp_path / f"base{number}.hocr").write_text(PAGE_HOCR.format(n=number), encoding='utf-8')
+        bases.append(str(base))
+    
+    combined = server.combine_hocr(bases, 'escaneo.pdf')
+    assert combined.count('<body>') == 1 and combined.count('</body>') == 1
+    assert combined.startswith('<?xml') and "content='tesseract 5.3.0'" in combined
+    assert re.findall(r"id='page_\d+'", combined) == ["id='page_1'", "id='page_2'", "id='page_3'"]
+    assert re.findall(r'ppageno \d+', combined) == ['ppageno 0', 'ppageno 1', 'ppageno 2']
+    # Identificadores únicos en todo el documento, incluidos los de dos cifras
+    ids = re.findall(r"id='(\w+)'", combined)
+    assert len(ids) == len(set(ids))
+    assert "id='word_3_12'" in combined
+    # La ruta temporal de la imagen no aparece en la respuesta
+    assert '/tmp/ocr_x' not in combined
+    assert combined.count('image "escaneo.pdf"') == 3
+
+
+def test_ocr_cache_base_depende_de_las_opciones():
+    base = server.ocr_cache_base('abc', 0, 300, 'spa')
+    assert base == server.ocr_cache_base('abc', 0, 300, 'spa', server.OCR_DEFAULT_PSM)
+    assert base.startswith(server.OCR_CACHE_FOLDER)
+    others = {
+        server.ocr_cache_base('abc', 1, 300, 'spa'),
+        server.ocr_cache_base('abc', 0, 200, 'spa'),
+        server.ocr_cache_base('abc', 0, 300, 'eng'),
+        server.ocr_cache_base('abc', 0, 300, 'spa', 6),
+    }
+    assert base not in others and len(others) == 4
@@ -0,0 +1,39 @@
+"""Lectura de los lotes de /qr-batch"""
+import pytest
+
+import server
+
+
+def test_texto_un_contenido_por_linea():
+    assert server.parse_qr_items('https://a.es\n\n  B  \r\nC', '.txt') == [
+        ('https://a.es', ''), ('B', ''), ('C', ''),
+    ]
+
+
+def test_csv_sin_cabecera_segunda_columna_es_la_etiqueta():
+    assert server.parse_qr_items('https://a.es,Aula 1\nhttps://b.es\n', '.csv') == [
+        ('https://a.es', 'Aula 1'), ('https://b.es', ''),
+    ]
+
+
+def test_csv_con_cabecera_y_punto_y_coma():
+    text = 'Nombre;Código;Otra\n Aula 1 ;A-001;x\nAula 2;A-002;y\n;;\n'
+    assert server.parse_qr_items(text, '.csv') == [('A-001', 'Aula 1'), ('A-002', 'Aula 2')]
+
+
+def test_csv_con_campos_entre_comillas():
+    text = 'url,label\n"https://a.es/?q=1,2","Sala, planta 1"\n'
+    assert server.parse_qr_items(text, '.csv') == [('https://a.es/?q=1,2', 'Sala, planta 1')]
+
+
+def test_json_lista_de_textos_y_de_objetos():
+    text = '["uno", {"payload": "dos", "label": "Dos"}, {"text": 3}, null, {"payload": ""}]'
+    assert server.parse_qr_items(text, '.json') == [('uno', ''), ('dos', 'Dos'), ('3', '')]
+    assert server.parse_qr_items('{"items": ["a"]}', '.json') == [('a', '')]
+
+
+def test_json_no_valido():
+    with pytest.raises(ValueError):
+        server.parse_qr_items('{"datos": ["a"]}', '.json')
+    with pytest.raises(ValueError):
+        server.parse_qr_items('[1, 2', '.json')
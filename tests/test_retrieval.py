@@ -0,0 +1,49 @@
+"""Índice BM25 de los fragmentos de una sesión de chat"""
+import json
+
+import server
+
+
+def test_tokenize_normaliza_tildes_plurales_y_palabras_vacias():
+    assert server.tokenize('Las CANCIONES de la Educación') == ['cancion', 'educacion']
+    assert server.tokenize('los gatos y el sol') == ['gato', 'sol']
+
+
+def test_tokenize_descarta_palabras_de_una_letra():
+    assert server.tokenize('a b c d') == []
+
+
+def test_bm25_ordena_por_relevancia():
+    index = server.DocumentIndex.build([
+        'El contrato de arrendamiento vence en marzo.',
+        'La factura del contrato se paga en marzo; el contrato incluye mantenimiento.',
+        'Horario de la biblioteca municipal.',
+    ])
+    assert index.search('contrato') == [1, 0]
+    assert index.search('biblioteca') == [2]
+    assert index.search('palabra inexistente') == []
+
+
+def test_bm25_penaliza_fragmentos_largos():
+    index = server.DocumentIndex.build([
+        'presupuesto anual',
+        'presupuesto ' + ' '.join(f'relleno{n}' for n in range(50)),
+    ])
+    scores = index.bm25('presupuesto')
+    assert scores[0] > scores[1] > 0
+
+
+def test_indice_se_conserva_al_pasar_por_json():
+    texts = ['Acta de la reunión del consejo', 'Presupuestos del consejo escolar', 'Calendario']
+    index = server.DocumentIndex.build(texts)
+    restored = server.DocumentIndex.from_json(json.loads(json.dumps(index.to_json())))
+    for query in ('consejo', 'presupuesto escolar', 'calendario'):
+        assert restored.bm25(query) == index.bm25(query)
+
+
+def test_embeddings_reordenan_los_candidatos():
+    index = server.DocumentIndex.build(['informe de ventas', 'ventas del trimestre'])
+    # Sin términos en común la búsqueda usa solo la similitud con todos los fragmentos
+    index.vectors = [[1.0, 0.0], [0.0, 1.0]]
+    assert index.search('ingresos', query_vector=[0.0, 1.0]) == [1, 0]
+    assert index.search('ventas', query_vector=[1.0, 0.0])[0] == 0
@@ -0,0 +1,42 @@
+"""Limpieza del Markdown de las respuestas que llegan por partes (SSE)"""
+import itertools
+
+import pytest
+
+import server
+
+
+def stream(pieces):
+    cleaner = server.MarkdownCleaner()
+    return ''.join(cleaner.feed(piece) for piece in pieces) + cleaner.flush()
+
+
+@pytest.mark.parametrize('text', [
+    '**negrita** normal',
+    'a * b ** c *** d **** e',
+    '***',
+    '*',
+    'fin con asterisco *',
+    'fin con negrita **',
+    '',
+])
+def test_cualquier_particion_da_el_mismo_resultado(text):
+    expected = server.clean_markdown_format(text)
+    # Todas las formas de partir el texto en hasta cuatro trozos consecutivos
+    for count in range(4):
+        for cuts in itertools.combinations(range(1, len(text)), count):
+            bounds = (0,) + cuts + (len(text),)
+            pieces = [text[start:end] for start, end in zip(bounds, bounds[1:])]
+            assert stream(pieces) == expected, pieces
+
+
+def test_el_asterisco_pendiente_se_retiene_hasta_el_siguiente_trozo():
+    cleaner = server.MarkdownCleaner()
+    assert cleaner.feed('hola *') == 'hola '
+    assert cleaner.feed('*mundo**') == 'mundo'
+    assert cleaner.flush() == ''
+
+
+def test_sse_event():
+    assert server.sse_event({'text': 'á'}) == 'data: {"text": "á"}\n\n'
+    assert server.sse_event({'done': True}, event='end') == 'event: end\ndata: {"done": true}\n\n'
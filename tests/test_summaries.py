@@ -0,0 +1,38 @@
+"""Secciones de los resúmenes por partes de documentos largos"""
+import random
+
+import server
+
+
+def paragraphs(count, seed=1):
+    rng = random.Random(seed)
+    words = ['acta', 'consejo', 'presupuesto', 'informe', 'anexo', 'plazo', 'centro', 'curso']
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(40, 120))) + '\n\n' for _ in range(count)]
+
+
+def test_pack_sections_conserva_el_texto_y_respeta_el_limite():
+    texts = paragraphs(300)
+    sections = server.pack_sections(texts, max_chars=4000)
+    assert ''.join(sections) == ''.join(texts)
+    assert all(len(section) <= 4000 for section in sections)
+    assert len(sections) > 1
+
+
+def test_pack_sections_texto_mayor_que_el_limite_va_solo():
+    texts = ['a' * 100, 'b' * 5000, 'c' * 100]
+    assert server.pack_sections(texts, max_chars=1000) == texts
+
+
+def test_pack_sections_editar_un_texto_solo_cambia_secciones_cercanas():
+    texts = paragraphs(300)
+    before = server.pack_sections(texts, max_chars=4000)
+    edited = list(texts)
+    edited[150] = edited[150].replace('\n\n', ' plazo ampliado hasta diciembre\n\n')
+    after = server.pack_sections(edited, max_chars=4000)
+    changed = set(after) - set(before)
+    assert 1 <= len(changed) <= 3
+    assert len(set(after) & set(before)) >= len(before) - 3
+
+
+def test_pack_sections_vacio():
+    assert server.pack_sections([]) == []
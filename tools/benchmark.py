@@ -0,0 +1,415 @@
+"""
+Benchmark reproducible de los endpoints de server.py.
+
+Genera un corpus sintético (PDFs de texto, PDFs escaneados con imágenes, un documento
+de 1000 páginas, un DOCX y un lote de JPEG grandes), ejecuta cada caso contra la
+aplicación Flask con el cliente de pruebas en un proceso propio (para medir su pico de
+memoria con ru_maxrss) y guarda tiempo, memoria y tamaño de la salida en JSON.
+
+Uso:
+    python tools/benchmark.py corpus  [--corpus DIR] [--quick]
+    python tools/benchmark.py run     [--corpus DIR] [--quick] [--repeat 3] [--cases split_text,merge_mixed] [--output resultados.json]
+    python tools/benchmark.py compare base.json nuevo.json [--threshold 0.10]
+
+compare termina con código 1 si algún caso empeora más que el umbral (10 %) en tiempo o
+en memoria y la diferencia absoluta supera --min-delta-ms / --min-delta-mb.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import zipfile
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS = os.path.join(ROOT_DIR, 'temp', 'benchmarks', 'corpus')
+DEFAULT_RESULTS = os.path.join(ROOT_DIR, 'temp', 'benchmarks')
+
+# Tamaño del corpus: completo y reducido (--quick) para comprobaciones rápidas
+CORPUS_SIZES = {
+    'full': {'text_pages': 50, 'long_pages': 1000, 'scanned_pages': 20, 'scan_dpi': 150,
+             'jpeg_count': 30, 'jpeg_size': (3000, 2000)},
+    'quick': {'text_pages': 10, 'long_pages': 200, 'scanned_pages': 4, 'scan_dpi': 100,
+              'jpeg_count': 5, 'jpeg_size': (1500, 1000)},
+}
+
+PROTECTED_PASSWORD = 'benchmark'
+
+LOREM = (
+    "El procesamiento de documentos en EvarisTools combina PyMuPDF, PyPDF2 y pikepdf. "
+    "Este párrafo se repite para generar páginas con una cantidad de texto realista, con "
+    "acentos, eñes y números como 1234.56 que ejercitan la extracción y las fuentes. "
+)
+
+def text_pdf(path, pages, fitz):
+    """PDF de texto con un marcador por cada diez páginas"""
+    document = fitz.open()
+    toc = []
+    for number in range(pages):
+        page = document.new_page()
+        page.insert_textbox(fitz.Rect(56, 56, 540, 786), f"Página {number + 1}\n\n" + LOREM * 12, fontsize=10)
+        if number % 10 == 0:
+            toc.append([1, f"Sección {number // 10 + 1}", number + 1])
+    document.set_toc(toc)
+    document.save(path, garbage=3, deflate=True)
+    document.close()
+
+def scanned_pdf(path, pages, dpi, fitz, Image):
+    """PDF "escaneado": cada página es un JPEG de página completa con ruido de escáner"""
+    source = fitz.open()
+    page = source.new_page()
+    page.insert_textbox(fitz.Rect(56, 56, 540, 786), LOREM * 12, fontsize=10)
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    base = Image.frombytes('L', (pixmap.width, pixmap.height), pixmap.samples)
+    source.close()
+    
+    document = fitz.open()
+    for number in range(pages):
+        noise = Image.effect_noise(base.size, 24 + number % 8)
+        scan = Image.blend(base, noise, 0.15).convert('RGB')
+        buffer = io.BytesIO()
+        scan.save(buffer, format='JPEG', quality=85)
+        page = document.new_page()
+        page.insert_image(page.rect, stream=buffer.getvalue())
+    document.save(path, deflate=True)
+    document.close()
+
+def jpeg_set(folder, count, size, Image):
+    """Fotografías sintéticas (degradado + ruido) que no se comprimen trivialmente"""
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    for number in range(count):
+        noise = Image.effect_noise(size, 40 + number)
+        channels = [gradient, noise, Image.blend(gradient, noise, 0.5).rotate(180)]
+        Image.merge('RGB', channels).save(os.path.join(folder, f"foto_{number + 1:03d}.jpg"), quality=90)
+
+def minimal_docx(path, paragraphs):
+    """DOCX mínimo válido escrito a mano (sin depender de python-docx)"""
+    body = ''.join(f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>' for text in paragraphs)
+    files = {
+        '[Content_Types].xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ),
+        '_rels/.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/></Relationships>'
+        ),
+        'word/document.xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>'
+        ),
+    }
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as docx:
+        for name, content in files.items():
+            docx.writestr(name, content)
+
+def build_corpus(corpus_dir, quick=False):
+    """Genera el corpus (si falta o cambió su tamaño) y devuelve su descripción"""
+    size_name = 'quick' if quick else 'full'
+    sizes = CORPUS_SIZES[size_name]
+    manifest_path = os.path.join(corpus_dir, 'manifest.json')
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['size'] == size_name:
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    import pymupdf as fitz
+    from PIL import Image
+    
+    os.makedirs(corpus_dir, exist_ok=True)
+    print(f"Generando corpus '{size_name}' en {corpus_dir}...")
+    start = time.perf_counter()
+    
+    text_pdf(os.path.join(corpus_dir, 'texto.pdf'), sizes['text_pages'], fitz)
+    text_pdf(os.path.join(corpus_dir, 'largo.pdf'), sizes['long_pages'], fitz)
+    scanned_pdf(os.path.join(corpus_dir, 'escaneado.pdf'), sizes['scanned_pages'], sizes['scan_dpi'], fitz, Image)
+    jpeg_set(os.path.join(corpus_dir, 'fotos'), sizes['jpeg_count'], sizes['jpeg_size'], Image)
+    minimal_docx(os.path.join(corpus_dir, 'documento.docx'), [LOREM] * 200)
+    
+    document = fitz.open(os.path.join(corpus_dir, 'texto.pdf'))
+    document.save(
+        os.path.join(corpus_dir, 'protegido.pdf'),
+        encryption=fitz.PDF_ENCRYPT_AES_256,
+        owner_pw=PROTECTED_PASSWORD,
+        user_pw=PROTECTED_PASSWORD
+    )
+    document.close()
+    
+    manifest = {
+        'size': size_name,
+        'sizes': sizes,
+        'files': {
+            name: os.path.getsize(os.path.join(corpus_dir, name))
+            for name in ('texto.pdf', 'largo.pdf', 'escaneado.pdf', 'documento.docx', 'protegido.pdf')
+        },
+        'generated': datetime.now().isoformat(),
+    }
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Corpus generado en {time.perf_counter() - start:.1f} s")
+    return manifest
+
+def benchmark_cases(corpus_dir, manifest):
+    """
+    Casos de benchmark: nombre -> (ruta, {campo: [archivos]}, formulario).
+    Los archivos son rutas relativas al corpus.
+    """
+    long_pages = manifest['sizes']['long_pages']
+    text_pages = manifest['sizes']['text_pages']
+    photos = sorted(
+        os.path.join('fotos', name) for name in os.listdir(os.path.join(corpus_dir, 'fotos'))
+    )
+    half = long_pages // 2
+    return {
+        'split_text': ('/split-pdf', {'file': ['texto.pdf']}, {'mode': 'all'}),
+        'split_long_ranges': ('/split-pdf', {'file': ['largo.pdf']}, {
+            'mode': 'range',
+            'ranges': json.dumps([{'start': 1, 'end': half}, {'start': half + 1, 'end': long_pages}])
+        }),
+        'merge_mixed': ('/merge-pdf', {'files[]': ['texto.pdf', 'escaneado.pdf', 'largo.pdf']}, {}),
+        'compress_text': ('/compress-pdf', {'file': ['texto.pdf']}, {'compressionLevel': 'medium'}),
+        'compress_scanned': ('/compress-pdf', {'file': ['escaneado.pdf']}, {'compressionLevel': 'high'}),
+        'pdf_to_jpg_scanned': ('/pdf-to-jpg', {'file': ['escaneado.pdf']}, {'imageQuality': 'medium', 'pageRange': 'all'}),
+        'jpg_to_pdf_set': ('/jpg-to-pdf', {'images': photos}, {'pageSize': 'a4', 'documentTitle': 'Fotos'}),
+        'watermark_text': ('/watermark-pdf', {'file': ['texto.pdf']}, {'watermarkType': 'text', 'watermarkText': 'BORRADOR'}),
+        'rotate_long': ('/rotate-pdf', {'file': ['largo.pdf']}, {'rotationAngle': '90', 'rotateAllPages': 'true'}),
+        'sort_text': ('/sort-pdf', {'file': ['texto.pdf']}, {
+            'pageOrder': json.dumps(list(range(text_pages, 0, -1)))
+        }),
+        'page_numbers_long': ('/add-page-numbers', {'file': ['largo.pdf']}, {'format': '1 de N'}),
+        'protect_text': ('/protect-pdf', {'file': ['texto.pdf']}, {'password': PROTECTED_PASSWORD}),
+        'unlock_protected': ('/unlock-pdf', {'file': ['protegido.pdf']}, {'password': PROTECTED_PASSWORD}),
+        'thumbnails_text': ('/get-pdf-thumbnails', {'file': ['texto.pdf']}, {}),
+        'info_long': ('/get-pdf-info', {'file': ['largo.pdf']}, {}),
+        'word_to_pdf': ('/convert-word-to-pdf', {'file': ['documento.docx']}, {}),
+        'pdfa_text': ('/pdf-to-pdfa', {'file': ['texto.pdf']}, {'conformanceLevel': 'pdfa-2b'}),
+    }
+
+def peak_rss_kb():
+    """Pico de memoria residente del proceso en KB (None si el sistema no lo expone)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa en KB, macOS en bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def run_case(name, corpus_dir, repeat, quick):
+    """Ejecuta un caso en el proceso actual e imprime su resultado en JSON (proceso hijo)"""
+    import logging
+    sys.path.insert(0, ROOT_DIR)
+    import server
+    server.preload_engines()
+    logging.disable(logging.INFO)
+    
+    manifest = build_corpus(corpus_dir, quick)
+    route, files, form = benchmark_cases(corpus_dir, manifest)[name]
+    result = {'case': name, 'route': route}
+    
+    if route.startswith('/convert-') and not server.LIBREOFFICE_PATH:
+        result['skipped'] = 'LibreOffice no está disponible'
+    elif route == '/pdf-to-pdfa' and not server.GHOSTSCRIPT_PATH:
+        result['skipped'] = 'Ghostscript no está disponible'
+    if 'skipped' in result:
+        print(json.dumps(result))
+        return
+    
+    payloads = {
+        field: [(open(os.path.join(corpus_dir, path), 'rb').read(), os.path.basename(path)) for path in paths]
+        for field, paths in files.items()
+    }
+    result['input_bytes'] = sum(len(data) for items in payloads.values() for data, _ in items)
+    baseline_kb = peak_rss_kb()
+    
+    client = server.app.test_client()
+    timings = []
+    for _ in range(repeat):
+        data = dict(form)
+        for field, items in payloads.items():
+            data[field] = [(io.BytesIO(content), filename) for content, filename in items]
+        start = time.perf_counter()
+        response = client.post(route, data=data, content_type='multipart/form-data')
+        body = response.get_data()
+        response.close()
+        timings.append(time.perf_counter() - start)
+        result['status'] = response.status_code
+        result['output_bytes'] = len(body)
+        if response.status_code != 200:
+            result['error'] = body[:300].decode('utf-8', 'replace')
+            break
+    
+    peak_kb = peak_rss_kb()
+    result.update({
+        'wall_s': timings,
+        'wall_median_s': statistics.median(timings),
+        'wall_min_s': min(timings),
+        'peak_rss_kb': peak_kb,
+        'peak_rss_delta_kb': peak_kb - baseline_kb if peak_kb is not None else None,
+    })
+    print(json.dumps(result))
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_all(args):
+    manifest = build_corpus(args.corpus, args.quick)
+    cases = list(benchmark_cases(args.corpus, manifest))
+    if args.cases:
+        selected = args.cases.split(',')
+        unknown = set(selected) - set(cases)
+        if unknown:
+            print(f"Casos desconocidos: {', '.join(sorted(unknown))}. Disponibles: {', '.join(cases)}")
+            sys.exit(2)
+        cases = selected
+    
+    results = {
+        'generated': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': manifest,
+        'repeat': args.repeat,
+        'cases': {},
+    }
+    
+    print(f"{'caso':<22} {'estado':>6} {'mediana':>10} {'pico RSS':>12} {'salida':>12}")
+    for name in cases:
+        command = [sys.executable, os.path.abspath(__file__), 'case', name,
+                   '--corpus', args.corpus, '--repeat', str(args.repeat)]
+        if args.quick:
+            command.append('--quick')
+        process = subprocess.run(command, cwd=ROOT_DIR, capture_output=True, text=True)
+        try:
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            result = {'case': name, 'error': (process.stderr or process.stdout)[-500:]}
+        results['cases'][name] = result
+        
+        if 'skipped' in result:
+            print(f"{name:<22} {'omit.':>6}  {result['skipped']}")
+        elif 'wall_median_s' in result:
+            rss = f"{result['peak_rss_kb'] / 1024:.0f} MB" if result['peak_rss_kb'] else '-'
+            print(f"{name:<22} {result['status']:>6} {result['wall_median_s'] * 1000:>8.0f} ms "
+                  f"{rss:>12} {result['output_bytes'] / 1024:>9.0f} KB")
+        else:
+            print(f"{name:<22} {'error':>6}  {result.get('error', '')[:80]}")
+    
+    output = args.output or os.path.join(
+        DEFAULT_RESULTS, f"resultados-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Resultados guardados en {output}")
+
+def compare(args):
+    """Compara dos ejecuciones y marca las regresiones de tiempo y memoria"""
+    with open(args.base, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    
+    if base.get('corpus', {}).get('size') != new.get('corpus', {}).get('size'):
+        print("AVISO: las ejecuciones usan corpus de distinto tamaño")
+    
+    regressions = []
+    print(f"{'caso':<22} {'tiempo (base → nuevo)':>28} {'pico RSS':>9} {'salida':>9}")
+    for name, before in base['cases'].items():
+        after = new['cases'].get(name)
+        if not after or 'wall_median_s' not in before or 'wall_median_s' not in after:
+            continue
+        
+        time_ratio = after['wall_median_s'] / before['wall_median_s'] if before['wall_median_s'] else 1
+        rss_ratio = None
+        if before.get('peak_rss_delta_kb') and after.get('peak_rss_delta_kb') is not None:
+            # Se compara el aumento sobre la memoria base del proceso, no el total
+            rss_ratio = after['peak_rss_delta_kb'] / max(before['peak_rss_delta_kb'], 1024)
+        size_ratio = after['output_bytes'] / before['output_bytes'] if before.get('output_bytes') else 1
+        
+        # Diferencias absolutas pequeñas son ruido de medición aunque la proporción sea alta
+        time_delta_ms = (after['wall_median_s'] - before['wall_median_s']) * 1000
+        rss_delta_mb = ((after.get('peak_rss_delta_kb') or 0) - (before.get('peak_rss_delta_kb') or 0)) / 1024
+        flags = []
+        if time_ratio > 1 + args.threshold and time_delta_ms > args.min_delta_ms:
+            flags.append('tiempo')
+        if rss_ratio is not None and rss_ratio > 1 + args.threshold and rss_delta_mb > args.min_delta_mb:
+            flags.append('memoria')
+        if flags:
+            regressions.append((name, flags))
+        
+        rss_text = f"{rss_ratio:.2f}x" if rss_ratio is not None else '-'
+        print(f"{name:<22} {before['wall_median_s'] * 1000:>7.0f} → {after['wall_median_s'] * 1000:>6.0f} ms "
+              f"{time_ratio:>6.2f}x {rss_text:>9} {size_ratio:>8.2f}x"
+              + (f"  REGRESIÓN ({', '.join(flags)})" if flags else ''))
+    
+    if regressions:
+        print(f"\n{len(regressions)} caso(s) empeoraron más de un {args.threshold:.0%}")
+        sys.exit(1)
+    print(f"\nSin regresiones por encima del {args.threshold:.0%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    corpus_parser = subparsers.add_parser('corpus', help='Generar el corpus de prueba')
+    run_parser = subparsers.add_parser('run', help='Ejecutar los casos y guardar los resultados')
+    case_parser = subparsers.add_parser('case', help='Ejecutar un caso (uso interno, proceso hijo)')
+    for sub in (corpus_parser, run_parser, case_parser):
+        sub.add_argument('--corpus', default=DEFAULT_CORPUS)
+        sub.add_argument('--quick', action='store_true', help='Corpus reducido')
+    for sub in (run_parser, case_parser):
+        sub.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--cases', help='Casos separados por comas (por defecto, todos)')
+    run_parser.add_argument('--output', help='Archivo JSON de resultados')
+    case_parser.add_argument('name')
+    
+    compare_parser = subparsers.add_parser('compare', help='Comparar dos ejecuciones')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help='Empeoramiento relativo tolerado (0.10 = 10%%)')
+    compare_parser.add_argument('--min-delta-ms', type=float, default=25,
+                                help='Diferencia de tiempo mínima para considerar una regresión')
+    compare_parser.add_argument('--min-delta-mb', type=float, default=5,
+                                help='Diferencia de memoria mínima para considerar una regresión')
+    
+    args = parser.parse_args()
+    if args.command == 'corpus':
+        build_corpus(args.corpus, args.quick)
+    elif args.command == 'run':
+        run_all(args)
+    elif args.command == 'case':
+        run_case(args.name, args.corpus, args.repeat, args.quick)
+    else:
+        compare(args)
+
+if __name__ == '__main__':
+    main()
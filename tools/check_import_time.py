@@ -0,0 +1,66 @@
+"""
+Comprueba el presupuesto de tiempo de arranque de server.py.
+
+Ejecuta `python -X importtime -c "import server"` en un proceso nuevo y falla si:
+  - la importación de server supera el presupuesto (EVARIS_IMPORT_BUDGET_MS, 500 ms), o
+  - alguna biblioteca pesada se importa al arrancar en lugar de con el primer uso.
+
+Uso:
+    python tools/check_import_time.py [--budget-ms 500]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bibliotecas que deben cargarse de forma diferida (ver LazyModule en server.py)
+HEAVY_MODULES = ['pymupdf', 'PIL.Image', 'PyPDF2', 'requests', 'pikepdf', 'reportlab']
+
+def measure_imports():
+    """Devuelve {módulo: (propio_us, acumulado_us)} de la importación de server"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import server'],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+    
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('EVARIS_IMPORT_BUDGET_MS', '500')))
+    args = parser.parse_args()
+    
+    timings = measure_imports()
+    total_ms = timings['server'][1] / 1000
+    
+    print(f"Importación de server: {total_ms:.0f} ms (presupuesto: {args.budget_ms:.0f} ms)")
+    print("Módulos más costosos (acumulado):")
+    for name, (_, cumulative_us) in sorted(timings.items(), key=lambda item: -item[1][1])[1:11]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+    
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f"la importación supera el presupuesto ({total_ms:.0f} ms > {args.budget_ms:.0f} ms)")
+    eager = [name for name in HEAVY_MODULES if name in timings]
+    if eager:
+        failures.append(f"bibliotecas pesadas importadas al arrancar: {', '.join(eager)}")
+    
+    for failure in failures:
+        print(f"ERROR: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
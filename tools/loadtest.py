@@ -0,0 +1,204 @@
+"""
+Prueba de carga concurrente contra un servidor en ejecución.
+
+Simula N usuarios que repiten una mezcla ponderada de llamadas a los endpoints (los
+mismos casos y corpus que tools/benchmark.py) y resume latencias p50/p95/p99, tasa de
+errores y rendimiento, por caso y en total.
+
+Uso:
+    python tools/loadtest.py [--url http://localhost:5000] [--users 50] [--duration 60]
+                             [--mix word_to_pdf=2,compress_text=3,...] [--quick] [--output carga.json]
+
+Para probar la concurrencia de LibreOffice y Ghostscript sin instalarlos, arrancar el
+servidor con los ejecutables simulados de tools/stubs (ver stubtool.py para su latencia):
+
+    EVARIS_SOFFICE_PATH=tools/stubs/soffice EVARIS_GS_PATH=tools/stubs/gs python serve.py
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import requests
+
+from benchmark import DEFAULT_CORPUS, benchmark_cases, build_corpus
+
+# Mezcla por defecto: conversiones con herramientas externas y ediciones habituales
+DEFAULT_MIX = {
+    'word_to_pdf': 2,
+    'pdfa_text': 1,
+    'compress_text': 2,
+    'compress_scanned': 1,
+    'merge_mixed': 1,
+    'split_text': 2,
+    'rotate_long': 1,
+    'watermark_text': 1,
+    'page_numbers_long': 1,
+    'protect_text': 1,
+    'thumbnails_text': 2,
+    'info_long': 3,
+}
+
+def parse_mix(text, available):
+    if not text:
+        return {name: weight for name, weight in DEFAULT_MIX.items() if name in available}
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in available:
+            print(f"Caso desconocido: {name}. Disponibles: {', '.join(available)}")
+            sys.exit(2)
+        mix[name] = float(weight or 1)
+    return mix
+
+def percentile(values, fraction):
+    """Percentil por rango más cercano (values ordenados)"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+class LoadTest:
+    def __init__(self, args, cases, payloads, mix):
+        self.args = args
+        self.cases = cases
+        self.payloads = payloads
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)  # caso -> [(latencia_s, estado, bytes)]
+        self.stop_at = None
+    
+    def user(self, number):
+        # Arranque escalonado durante el periodo de subida
+        time.sleep(self.args.ramp_up * number / max(1, self.args.users))
+        session = requests.Session()
+        rng = random.Random(number)
+        while time.time() < self.stop_at:
+            name = rng.choices(self.names, self.weights)[0]
+            route, files, form = self.cases[name]
+            upload = [
+                (field, (filename, content))
+                for field, items in self.payloads[name].items()
+                for content, filename in items
+            ]
+            start = time.perf_counter()
+            try:
+                response = session.post(self.args.url + route, files=upload, data=form, timeout=self.args.timeout)
+                status, size = response.status_code, len(response.content)
+            except requests.RequestException as e:
+                status, size = type(e).__name__, 0
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.samples[name].append((elapsed, status, size))
+            if self.args.think_ms:
+                time.sleep(self.args.think_ms / 1000)
+    
+    def run(self):
+        self.stop_at = time.time() + self.args.ramp_up + self.args.duration
+        threads = [threading.Thread(target=self.user, args=(number,), daemon=True) for number in range(self.args.users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for latency, _, _ in samples)
+    statuses = Counter(str(status) for _, status, _ in samples)
+    errors = sum(count for status, count in statuses.items() if status != '200')
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': errors / len(samples) if samples else 0,
+        'statuses': dict(statuses),
+        'throughput_rps': len(samples) / elapsed if elapsed else 0,
+        'bytes_received': sum(size for _, _, size in samples),
+        'p50_s': percentile(latencies, 0.50),
+        'p95_s': percentile(latencies, 0.95),
+        'p99_s': percentile(latencies, 0.99),
+        'max_s': latencies[-1] if latencies else None,
+    }
+
+def format_ms(seconds):
+    return f"{seconds * 1000:>8.0f}" if seconds is not None else f"{'-':>8}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=50, help='Usuarios concurrentes')
+    parser.add_argument('--duration', type=float, default=60, help='Segundos de carga sostenida')
+    parser.add_argument('--ramp-up', type=float, default=5, help='Segundos para arrancar a todos los usuarios')
+    parser.add_argument('--think-ms', type=float, default=0, help='Pausa de cada usuario entre llamadas')
+    parser.add_argument('--timeout', type=float, default=300, help='Tiempo máximo por solicitud (s)')
+    parser.add_argument('--mix', help='Casos y pesos: caso=peso,caso=peso (por defecto, una mezcla variada)')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--quick', action='store_true', help='Corpus reducido')
+    parser.add_argument('--output', help='Guardar el resumen en JSON')
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+    
+    try:
+        info = requests.get(args.url + '/system-info', timeout=10).json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"No se pudo contactar con el servidor en {args.url}: {e}")
+        sys.exit(1)
+    
+    manifest = build_corpus(args.corpus, args.quick)
+    cases = benchmark_cases(args.corpus, manifest)
+    mix = parse_mix(args.mix, list(cases))
+    
+    # Omitir las conversiones cuyas herramientas no tiene el servidor
+    services = info.get('services', {})
+    unavailable = {
+        'word_to_pdf': not services.get('document_conversion', {}).get('available'),
+        'pdfa_text': not services.get('pdf_conversion', {}).get('available'),
+    }
+    for name, missing in unavailable.items():
+        if missing and name in mix:
+            print(f"Se omite {name}: la herramienta no está disponible en el servidor")
+            del mix[name]
+    
+    payloads = {
+        name: {
+            field: [(open(os.path.join(args.corpus, path), 'rb').read(), os.path.basename(path)) for path in paths]
+            for field, paths in cases[name][1].items()
+        }
+        for name in mix
+    }
+    
+    print(f"{args.users} usuarios durante {args.duration:.0f} s (+{args.ramp_up:.0f} s de subida) contra {args.url}")
+    test = LoadTest(args, cases, payloads, mix)
+    elapsed = test.run()
+    
+    results = {
+        'generated': datetime.now().isoformat(),
+        'url': args.url,
+        'users': args.users,
+        'duration_s': elapsed,
+        'mix': mix,
+        'cases': {name: summarize(samples, elapsed) for name, samples in sorted(test.samples.items())},
+        'total': summarize([sample for samples in test.samples.values() for sample in samples], elapsed),
+    }
+    
+    print(f"\n{'caso':<20} {'solic.':>7} {'errores':>8} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, summary in list(results['cases'].items()) + [('TOTAL', results['total'])]:
+        print(f"{name:<20} {summary['requests']:>7} {summary['error_rate']:>7.1%} {summary['throughput_rps']:>7.2f} "
+              f"{format_ms(summary['p50_s'])} {format_ms(summary['p95_s'])} {format_ms(summary['p99_s'])}")
+    statuses = results['total']['statuses']
+    if set(statuses) - {'200'}:
+        print(f"\nCódigos de respuesta: {', '.join(f'{status}: {count}' for status, count in sorted(statuses.items()))}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Resultados guardados en {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Utilidades comunes de los ejecutables simulados (soffice, gs, tesseract) para pruebas de carga.
+
+Variables de entorno:
+    EVARIS_STUB_LATENCY_MS   duración de cada llamada (por defecto 1500 ms)
+    EVARIS_STUB_SOFFICE_MS   duración solo para soffice (tiene prioridad)
+    EVARIS_STUB_GS_MS        duración solo para gs (tiene prioridad)
+    EVARIS_STUB_TESSERACT_MS duración solo para tesseract, por página (tiene prioridad)
+    EVARIS_STUB_JITTER_MS    variación aleatoria ± sobre la duración (por defecto 0)
+    EVARIS_STUB_MODE         'sleep' (espera) o 'cpu' (ocupa un núcleo, como la herramienta real)
+    EVARIS_STUB_FAIL_RATE    fracción de llamadas que terminan con error (0-1, por defecto 0)
+"""
+import os
+import random
+import sys
+import time
+
+def simulate_work(tool):
+    """Espera u ocupa la CPU durante la latencia configurada; falla según FAIL_RATE"""
+    latency_ms = float(os.environ.get(f'EVARIS_STUB_{tool.upper()}_MS',
+                                      os.environ.get('EVARIS_STUB_LATENCY_MS', '1500')))
+    jitter_ms = float(os.environ.get('EVARIS_STUB_JITTER_MS', '0'))
+    duration = max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000
+    
+    if os.environ.get('EVARIS_STUB_MODE', 'sleep') == 'cpu':
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            sum(range(10000))
+    else:
+        time.sleep(duration)
+    
+    if random.random() < float(os.environ.get('EVARIS_STUB_FAIL_RATE', '0')):
+        print(f"{tool} (simulado): error provocado por EVARIS_STUB_FAIL_RATE", file=sys.stderr)
+        sys.exit(1)
+
+def minimal_pdf(text, width=612, height=792, invisible=False):
+    """
+    PDF de una página escrito a mano (sin dependencias) con un texto. Con invisible, el
+    texto no se pinta pero puede buscarse y copiarse (como la capa de texto del OCR).
+    """
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    mode = "3 Tr " if invisible else ""
+    content = f"BT /F1 12 Tf {mode}72 {height - 72:g} Td ({text}) Tj ET".encode('latin-1', 'replace')
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>" % (f"{width:g}".encode(), f"{height:g}".encode()),
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(output)
@@ -0,0 +1,17 @@
+"""
+Punto de entrada WSGI para producción.
+
+    gunicorn -c gunicorn.conf.py wsgi:app     (Linux/macOS)
+    python serve.py                           (cualquier sistema, elige el servidor)
+"""
+import os
+
+from server import app, preload_engines
+
+# Con preload_app, este módulo se carga en el maestro de Gunicorn: importar aquí las
+# bibliotecas pesadas hace que los workers nazcan (y renazcan) con ellas ya cargadas.
+# EVARIS_PRELOAD_ENGINES=0 las deja diferidas hasta la primera solicitud de cada worker.
+if os.environ.get('EVARIS_PRELOAD_ENGINES', '1') == '1':
+    preload_engines()
+
+application = app